@@ -0,0 +1,8 @@
+"""Benchmarks reproducibles de la API de Hakari.
+
+Uso:
+    python -m bench correr --usuarios 200 --peticiones 5000 --salida antes.json
+    python -m bench comparar antes.json despues.json
+
+Siempre trabaja sobre una base de datos temporal: nunca toca hakari.db.
+"""
@@ -0,0 +1,143 @@
+# bench/__main__.py - CLI: python -m bench {correr,comparar}
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+def parsear_mezcla(texto: str) -> dict:
+    mezcla = {}
+    for parte in texto.split(','):
+        endpoint, peso = parte.split('=')
+        mezcla[endpoint.strip()] = int(peso)
+    return mezcla
+
+def commit_actual() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return 'desconocido'
+
+def correr(args) -> dict:
+    directorio = tempfile.mkdtemp(prefix='hakari-bench-')
+    ruta_db = os.path.join(directorio, 'hakari.db')
+    # main lee la configuración al importarse: la BD temporal va antes
+    os.environ['HAKARI_DB'] = ruta_db
+    # Se mide el throughput sin los límites de tasa (se pueden activar a mano)
+    os.environ.setdefault('HAKARI_LIMITE_SESION', '0')
+    os.environ.setdefault('HAKARI_LIMITE_IP', '0')
+    if args.generador:
+        os.environ['HAKARI_GENERADOR'] = args.generador
+        os.environ['HAKARI_GENERADOR_LATENCIA_MS'] = str(args.generador_latencia_ms)
+    sys.path.insert(0, os.getcwd())
+    import main
+    logging.getLogger(main.__name__).setLevel(logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    main.hakari_db.iniciar()  # crea el esquema antes de sembrar
+
+    from bench.carga import correr_carga
+    from bench.micro import correr_micro
+    from bench.semilla import sembrar
+
+    emails = sembrar(ruta_db, args.usuarios, args.conversaciones, args.logros, args.semilla)
+    random.seed(args.semilla)
+
+    async def carga():
+        async with main.app.router.lifespan_context(main.app):
+            return await correr_carga(main.app, emails, parsear_mezcla(args.mezcla),
+                                      args.peticiones, args.concurrencia, args.semilla)
+
+    resultados = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit_actual(),
+        'python': platform.python_version(),
+        'parametros': {**vars(args), 'durabilidad': main.DB_DURABILIDAD},
+        'carga': asyncio.run(carga()),
+        'generador': main.chat_engine.estadisticas(),
+        'micro': correr_micro(main, args.iteraciones)
+    }
+    return resultados
+
+def imprimir(resultados: dict):
+    carga = resultados['carga']
+    print(f"Commit {resultados['commit']} - {carga['rps_total']} req/s en {carga['duracion_s']} s")
+    print(f"{'endpoint':<12}{'req':>8}{'err':>6}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for endpoint, r in carga['endpoints'].items():
+        print(f"{endpoint:<12}{r['peticiones']:>8}{r['errores']:>6}{r['rps']:>10}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+    generador = resultados.get('generador')
+    if generador and generador['generador']:
+        print(f"\ngenerador {generador['generador']}: " + ', '.join(
+            f"{clave} {valor}" for clave, valor in generador.items() if clave != 'generador'))
+    print(f"\n{'micro':<28}{'mejor us':>12}{'media us':>12}")
+    for nombre, r in resultados['micro'].items():
+        print(f"{nombre:<28}{r['mejor_us']:>12}{r['media_us']:>12}")
+
+def delta(antes: float, despues: float) -> str:
+    if not antes:
+        return 'n/a'
+    return f"{(despues - antes) / antes * 100:+.1f}%"
+
+def comparar(args):
+    with open(args.antes) as f:
+        antes = json.load(f)
+    with open(args.despues) as f:
+        despues = json.load(f)
+
+    print(f"{antes['commit']} -> {despues['commit']}")
+    print(f"{'endpoint':<12}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for endpoint, b in despues['carga']['endpoints'].items():
+        a = antes['carga']['endpoints'].get(endpoint)
+        if not a:
+            continue
+        print(f"{endpoint:<12}{delta(a['rps'], b['rps']):>10}{delta(a['p50_ms'], b['p50_ms']):>10}"
+              f"{delta(a['p95_ms'], b['p95_ms']):>10}{delta(a['p99_ms'], b['p99_ms']):>10}")
+    print(f"\n{'micro':<28}{'mejor':>10}")
+    for nombre, b in despues['micro'].items():
+        a = antes['micro'].get(nombre)
+        if a:
+            print(f"{nombre:<28}{delta(a['mejor_us'], b['mejor_us']):>10}")
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Benchmarks de la API de Hakari')
+    sub = parser.add_subparsers(dest='comando', required=True)
+
+    p = sub.add_parser('correr', help='Siembra una BD temporal y mide carga y micro-benchmarks')
+    p.add_argument('--usuarios', type=int, default=100)
+    p.add_argument('--conversaciones', type=int, default=50, help='Conversaciones sembradas por usuario')
+    p.add_argument('--logros', type=int, default=2, help='Logros sembrados por usuario (0-5)')
+    p.add_argument('--peticiones', type=int, default=2000)
+    p.add_argument('--concurrencia', type=int, default=16)
+    p.add_argument('--mezcla', default='registrar=5,login=10,chat=55,estado=15,historial=15',
+                   help='Pesos por endpoint, p. ej. chat=60,estado=40')
+    p.add_argument('--iteraciones', type=int, default=20000, help='Iteraciones por micro-benchmark')
+    p.add_argument('--semilla', type=int, default=42)
+    p.add_argument('--generador', default='', help="Generador en línea para /chat, p. ej. 'simulado'")
+    p.add_argument('--generador-latencia-ms', type=int, default=200, help='Latencia del generador simulado')
+    p.add_argument('--salida', help='Archivo JSON donde guardar los resultados')
+
+    c = sub.add_parser('comparar', help='Compara dos archivos de resultados')
+    c.add_argument('antes')
+    c.add_argument('despues')
+
+    args = parser.parse_args()
+    if args.comando == 'comparar':
+        comparar(args)
+        return
+
+    resultados = correr(args)
+    imprimir(resultados)
+    if args.salida:
+        with open(args.salida, 'w') as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados guardados en {args.salida}")
+
+if __name__ == '__main__':
+    main()
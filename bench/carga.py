@@ -0,0 +1,97 @@
+# bench/carga.py - Prueba de carga en proceso (transporte ASGI, sin red)
+import asyncio
+import random
+import time
+from typing import Dict, List
+
+import httpx
+
+from bench.semilla import MENSAJES
+
+ENDPOINTS = ['registrar', 'login', 'chat', 'estado', 'historial']
+
+def percentil(valores: List[float], p: float) -> float:
+    """Percentil por rango más cercano (valores ya ordenados)"""
+    if not valores:
+        return 0.0
+    indice = max(0, min(len(valores) - 1, int(round(p / 100 * len(valores) + 0.5)) - 1))
+    return valores[indice]
+
+def resumir(latencias: Dict[str, List[float]], errores: Dict[str, int], duracion: float) -> Dict:
+    resumen = {}
+    for endpoint, valores in latencias.items():
+        if not valores and not errores[endpoint]:
+            continue
+        valores.sort()
+        resumen[endpoint] = {
+            'peticiones': len(valores),
+            'errores': errores[endpoint],
+            'rps': round(len(valores) / duracion, 1),
+            'p50_ms': round(percentil(valores, 50) * 1000, 3),
+            'p95_ms': round(percentil(valores, 95) * 1000, 3),
+            'p99_ms': round(percentil(valores, 99) * 1000, 3),
+            'media_ms': round(sum(valores) / len(valores) * 1000, 3) if valores else 0.0
+        }
+    return resumen
+
+async def correr_carga(app, emails: List[str], mezcla: Dict[str, int], peticiones: int,
+                       concurrencia: int, semilla: int = 42) -> Dict:
+    """Lanza `peticiones` requests repartidas en `concurrencia` clientes.
+
+    Cada cliente elige el endpoint según los pesos de `mezcla` con su propio
+    RNG sembrado, así dos corridas con los mismos parámetros hacen la misma
+    secuencia de requests.
+    """
+    transporte = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transporte, base_url='http://bench') as cliente:
+        # Sesiones de los usuarios sembrados (no se miden)
+        sesiones = []
+        for email in emails[:max(concurrencia, 1)]:
+            r = await cliente.post('/login', json={'email': email})
+            sesiones.append(r.json()['session_id'])
+
+        nombres = [e for e in ENDPOINTS if mezcla.get(e)]
+        pesos = [mezcla[e] for e in nombres]
+        latencias = {e: [] for e in ENDPOINTS}
+        errores = {e: 0 for e in ENDPOINTS}
+        pendientes = [peticiones]
+        registrados = [0]
+
+        async def cliente_virtual(n: int):
+            rng = random.Random(semilla * 1000 + n)
+            session_id = sesiones[n % len(sesiones)]
+            while pendientes[0] > 0:
+                pendientes[0] -= 1
+                endpoint = rng.choices(nombres, pesos)[0]
+                if endpoint == 'registrar':
+                    registrados[0] += 1
+                    peticion = cliente.post('/registrar', json={
+                        'nombre': 'Nuevo', 'email': f'nuevo{n}-{registrados[0]}@bench.local'})
+                elif endpoint == 'login':
+                    peticion = cliente.post('/login', json={'email': rng.choice(emails)})
+                elif endpoint == 'chat':
+                    peticion = cliente.post('/chat', json={
+                        'session_id': session_id, 'message': rng.choice(MENSAJES)})
+                elif endpoint == 'estado':
+                    peticion = cliente.get(f'/estado/{session_id}')
+                else:
+                    peticion = cliente.get(f'/historial/{session_id}', params={'limite': 20})
+
+                inicio = time.perf_counter()
+                respuesta = await peticion
+                transcurrido = time.perf_counter() - inicio
+                if respuesta.status_code >= 400:
+                    errores[endpoint] += 1
+                else:
+                    latencias[endpoint].append(transcurrido)
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(cliente_virtual(n) for n in range(concurrencia)))
+        duracion = time.perf_counter() - inicio
+
+    total = sum(len(v) for v in latencias.values())
+    return {
+        'duracion_s': round(duracion, 3),
+        'rps_total': round(total / duracion, 1),
+        'endpoints': resumir(latencias, errores, duracion)
+    }
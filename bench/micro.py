@@ -0,0 +1,37 @@
+# bench/micro.py - Micro-benchmarks de la lógica de personalidad
+import time
+from typing import Callable, Dict
+
+from bench.semilla import MENSAJES
+
+def medir(funcion: Callable, iteraciones: int, repeticiones: int = 5) -> Dict:
+    """Mejor tiempo por llamada entre varias repeticiones, en microsegundos"""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        for i in range(iteraciones):
+            funcion(i)
+        tiempos.append((time.perf_counter() - inicio) / iteraciones)
+    return {
+        'iteraciones': iteraciones,
+        'mejor_us': round(min(tiempos) * 1e6, 3),
+        'media_us': round(sum(tiempos) / len(tiempos) * 1e6, 3)
+    }
+
+def correr_micro(main, iteraciones: int) -> Dict:
+    hakari = main.hakari
+    chat_engine = main.chat_engine
+    sistema_logros = main.sistema_logros
+    usuario = {'nombre': 'Bench', 'email': 'bench@bench.local', 'confianza': 55, 'interacciones': 12,
+               'energia': 60, 'relacion': 65}
+    estadisticas = {'interacciones': 12, 'confianza': 55}
+    n = len(MENSAJES)
+
+    return {
+        'obtener_respuesta_rapida': medir(
+            lambda i: hakari.obtener_respuesta_rapida(MENSAJES[i % n], usuario), iteraciones),
+        'generar_respuesta_oflline': medir(
+            lambda i: chat_engine.generar_respuesta_oflline(MENSAJES[i % n], usuario), iteraciones),
+        'verificar_logros': medir(
+            lambda i: sistema_logros.verificar_logros(estadisticas, MENSAJES[i % n], 0), iteraciones)
+    }
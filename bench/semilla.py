@@ -0,0 +1,59 @@
+# bench/semilla.py - Datos de prueba para una hakari.db temporal
+import random
+import sqlite3
+from datetime import datetime, timedelta
+from typing import List
+
+MENSAJES = [
+    'hola', 'hey, qué tal?', 'cuantos años tienes', 'cómo está mochi?',
+    'me encanta el anime', 'te quiero', 'jaja qué divertido', 'hoy estoy triste',
+    'estoy molesto con todo', 'qué hiciste hoy?', 'ok', 'buenas noches hakari',
+    'ayer fui al parque y vi un montón de gatos, me acordé de vos y de mochi'
+]
+
+def email_usuario(i: int) -> str:
+    return f'usuario{i}@bench.local'
+
+def sembrar(ruta: str, usuarios: int, conversaciones: int, logros: int, semilla: int = 42) -> List[str]:
+    """Llena la BD (con el esquema ya creado) y devuelve los emails sembrados.
+
+    `conversaciones` y `logros` son por usuario.
+    """
+    rng = random.Random(semilla)
+    emails = [email_usuario(i) for i in range(usuarios)]
+    ids_logros = ['primer_conversacion', '10_interacciones', 'confianza_50', 'descubrir_anime', 'cumpleanos']
+    inicio = datetime(2024, 1, 1)
+
+    conn = sqlite3.connect(ruta)
+    conn.executemany('''
+        INSERT OR REPLACE INTO usuarios (email, nombre, confianza, interacciones, energia, relacion, ultima_visita)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (email, f'Usuario {i}', min(100, 30 + conversaciones), conversaciones,
+         max(0, 70 - conversaciones), min(100, 50 + conversaciones), inicio.isoformat(' '))
+        for i, email in enumerate(emails)
+    ])
+
+    def filas_conversaciones():
+        for email in emails:
+            for n in range(conversaciones):
+                fecha = inicio + timedelta(minutes=n)
+                yield (email, rng.choice(MENSAJES), 'Interesante... ¿puedes contarme más?',
+                       rng.choice(['feliz', 'triste', 'reflexiva']), fecha.isoformat(' '))
+
+    conn.executemany('''
+        INSERT INTO conversaciones (usuario_email, mensaje_usuario, mensaje_hakari, estado_emocional, fecha)
+        VALUES (?, ?, ?, ?, ?)
+    ''', filas_conversaciones())
+
+    conn.executemany('''
+        INSERT OR IGNORE INTO logros (usuario_email, logro_id, nombre, descripcion)
+        VALUES (?, ?, ?, ?)
+    ''', [
+        (email, logro_id, logro_id, '')
+        for email in emails
+        for logro_id in ids_logros[:min(logros, len(ids_logros))]
+    ])
+    conn.commit()
+    conn.close()
+    return emails
@@ -1,25 +1,479 @@
 # main.py - Hakari Backend API
-from fastapi import FastAPI, HTTPException
+import time
+_INICIO_IMPORTACION = time.perf_counter()  # para el informe de arranque
+
+from fastapi import FastAPI, HTTPException, Query, Header, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import cached_property
+from abc import ABC, abstractmethod
+import asyncio
+import math
+import bisect
+import gzip
+import hashlib
+import html
+import itertools
+import json
+import queue
+import re
 import sqlite3
+import threading
+import zlib
 import random
 from datetime import datetime, date, timedelta
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple, Callable, Any, FrozenSet, NamedTuple, Iterable, Iterator
 import secrets
+import string
+import sys
 import os
 import logging
 
+try:
+    import brotli  # opcional: sin él los estáticos se sirven solo con gzip
+except ImportError:
+    brotli = None
+
 # Configuración logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Configuración base de datos
+DB_PATH = os.getenv('HAKARI_DB', 'hakari.db')
+DB_LECTORES = int(os.getenv('HAKARI_DB_LECTORES', '4'))
+# 'estricta': /chat responde después del commit. 'lotes': /chat encola la
+# escritura y responde enseguida; el escritor hace commit por lotes.
+DB_DURABILIDAD = os.getenv('HAKARI_DURABILIDAD', 'estricta')
+DB_LOTE_MAX = int(os.getenv('HAKARI_LOTE_MAX', '256'))
+DB_LOTE_MS = int(os.getenv('HAKARI_LOTE_MS', '20'))
+DB_COLA_MAX = int(os.getenv('HAKARI_COLA_MAX', '10000'))
+
+# Configuración sesiones
+SESION_TTL = int(os.getenv('HAKARI_SESION_TTL', str(12 * 3600)))  # segundos de inactividad
+SESIONES_MAX = int(os.getenv('HAKARI_SESIONES_MAX', '100000'))
+
+# Configuración multi-worker: con más de un worker las sesiones y el estado
+# de Hakari se comparten a través de hakari.db
+WORKERS = int(os.getenv('HAKARI_WORKERS', os.getenv('WEB_CONCURRENCY', '1')))
+ESTADO_COMPARTIDO = os.getenv('HAKARI_ESTADO_COMPARTIDO', '1' if WORKERS > 1 else '0') == '1'
+ESTADO_REFRESCO_MS = int(os.getenv('HAKARI_ESTADO_REFRESCO_MS', '250'))
+ESTADO_REINTENTOS = 5  # compare-and-set del estado de Hakari entre workers
+
+# Estado de Hakari por usuario: cuántos usuarios se mantienen en memoria
+PERSONALIDADES_MAX = int(os.getenv('HAKARI_PERSONALIDADES_MAX', '100000'))
+
+# Usuarios cuyo bitmap de logros se mantiene en memoria
+LOGROS_CACHE_MAX = int(os.getenv('HAKARI_LOGROS_CACHE_MAX', '50000'))
+
+# Historial: tope de filas por página y tamaño de bloque al hacer streaming
+HISTORIAL_MAX_PAGINA = int(os.getenv('HAKARI_HISTORIAL_MAX_PAGINA', '100'))
+HISTORIAL_BLOQUE_STREAM = 500
+
+# Memoria de conversaciones: últimos turnos de cada usuario en memoria
+MEMORIA_TURNOS = int(os.getenv('HAKARI_MEMORIA_TURNOS', '50'))  # por usuario; 0 desactiva
+MEMORIA_MB = float(os.getenv('HAKARI_MEMORIA_MB', '64'))  # entre todos los usuarios
+BUSQUEDA_MAX_PAGINA = 50
+
+# Mantenimiento: archivo mensual de conversaciones viejas, retención,
+# checkpoint del WAL y vacuum incremental en momentos de poco tráfico
+ARCHIVAR_DIAS = int(os.getenv('HAKARI_ARCHIVAR_DIAS', '0'))  # 0 = no archivar
+ARCHIVO_DIR = os.getenv('HAKARI_ARCHIVO_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'archivo'))
+RETENCION_MESES = int(os.getenv('HAKARI_RETENCION_MESES', '0'))  # 0 = conservar archivos siempre
+MANTENIMIENTO_S = int(os.getenv('HAKARI_MANTENIMIENTO_S', '3600'))
+MANTENIMIENTO_INACTIVIDAD_S = float(os.getenv('HAKARI_MANTENIMIENTO_INACTIVIDAD_S', '5'))
+ARCHIVO_BLOQUE = 2000
+ARCHIVO_TURNO_S = 600  # vencimiento del turno de archivado si el worker que lo tiene muere
+
+# Exportación/importación masiva (endpoints /admin deshabilitados sin token)
+ADMIN_TOKEN = os.getenv('HAKARI_ADMIN_TOKEN', '')
+TRANSFERENCIA_BLOQUE = 5000
+TRANSFERENCIA_FILAS_POR_INSERCION = 1000
+TRANSFERENCIA_MS_POR_TRANSACCION = 300  # muy por debajo del busy_timeout de 5 s
+TRANSFERENCIA_PAUSA_S = 0.05  # entre transacciones, para que entre el escritor de la API
+
+# Límites de tasa (token bucket, en memoria de cada worker) y control de admisión.
+# Tasa en peticiones por segundo; 0 desactiva el límite.
+LIMITE_SESION = float(os.getenv('HAKARI_LIMITE_SESION', '2'))
+RAFAGA_SESION = int(os.getenv('HAKARI_RAFAGA_SESION', '20'))
+LIMITE_IP = float(os.getenv('HAKARI_LIMITE_IP', '20'))
+RAFAGA_IP = int(os.getenv('HAKARI_RAFAGA_IP', '100'))
+LIMITADOR_CLAVES_MAX = int(os.getenv('HAKARI_LIMITADOR_CLAVES', '100000'))
+ADMISION_COLA_MAX = int(os.getenv('HAKARI_ADMISION_COLA', '2000'))  # escrituras pendientes; 0 = sin límite
+# Shell de la PWA servida desde memoria (ver RecursosEstaticos)
+ESTATICOS_DIR = os.getenv('HAKARI_ESTATICOS_DIR', os.path.dirname(os.path.abspath(__file__)))
+ARCHIVOS_ESTATICOS = ('index.html', 'app.js', 'style.css', 'manifest.json', 'sw.js')
+
+RUTAS_SIN_LIMITE = frozenset({'/', '/health', '/metrics', *('/' + nombre for nombre in ARCHIVOS_ESTATICOS)})
+
+# Máximo de mensajes por petición a /chat/batch
+CHAT_LOTE_MAX = int(os.getenv('HAKARI_CHAT_LOTE_MAX', '200'))
+
+# Generador de respuestas en línea ('' = solo el motor offline, 'simulado' = stub local)
+GENERADOR = os.getenv('HAKARI_GENERADOR', '')
+GENERADOR_CONCURRENCIA = int(os.getenv('HAKARI_GENERADOR_CONCURRENCIA', '8'))
+GENERADOR_TIMEOUT_MS = int(os.getenv('HAKARI_GENERADOR_TIMEOUT_MS', '3000'))
+GENERADOR_CACHE_MAX = int(os.getenv('HAKARI_GENERADOR_CACHE_MAX', '5000'))
+GENERADOR_CACHE_TTL_S = float(os.getenv('HAKARI_GENERADOR_CACHE_TTL_S', '300'))
+GENERADOR_LATENCIA_MS = int(os.getenv('HAKARI_GENERADOR_LATENCIA_MS', '200'))  # solo 'simulado'
+
+# Arranque: calentar conexiones y cachés antes de aceptar peticiones
+CALENTAR = os.getenv('HAKARI_CALENTAR', '0') == '1'
+
+# Catálogo de respuestas (se recarga solo si cambia el archivo)
+RESPUESTAS_PATH = os.getenv('HAKARI_RESPUESTAS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'respuestas.json'))
+RESPUESTAS_RECARGA_S = float(os.getenv('HAKARI_RESPUESTAS_RECARGA_S', '2'))  # 0 = no vigilar el archivo
+
+# Respuestas de / y /estado cacheadas (con ETag)
+CACHE_RESPUESTAS_MAX = int(os.getenv('HAKARI_CACHE_RESPUESTAS_MAX', '10000'))
+
+# Métricas Prometheus en /metrics
+METRICAS_ACTIVAS = os.getenv('HAKARI_METRICAS', '1') == '1'
+
+# Instrumentación
+class Histograma:
+    """Histograma con buckets fijos preasignados (formato Prometheus).
+
+    Observar es una búsqueda binaria y un incremento; los acumulados se
+    calculan recién al exportar. Puede usarse desde varios hilos.
+    """
+
+    LIMITES = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    __slots__ = ('conteos', 'suma', '_lock')
+
+    def __init__(self):
+        self.conteos = [0] * (len(self.LIMITES) + 1)  # el último es +Inf
+        self.suma = 0.0
+        self._lock = threading.Lock()
+
+    def observar(self, valor: float):
+        indice = bisect.bisect_left(self.LIMITES, valor)
+        with self._lock:
+            self.conteos[indice] += 1
+            self.suma += valor
+
+    def exportar(self, nombre: str, etiquetas: str) -> List[str]:
+        lineas = []
+        acumulado = 0
+        for limite, conteo in zip(self.LIMITES + ('+Inf',), self.conteos):
+            acumulado += conteo
+            lineas.append(f'{nombre}_bucket{{{etiquetas},le="{limite}"}} {acumulado}')
+        lineas.append(f'{nombre}_sum{{{etiquetas}}} {self.suma}')
+        lineas.append(f'{nombre}_count{{{etiquetas}}} {acumulado}')
+        return lineas
+
+class Metricas:
+    """Contadores e histogramas por ruta HTTP y por sentencia SQL"""
+
+    def __init__(self):
+        self.http = {}  # (metodo, ruta) -> [peticiones, errores, Histograma]
+        self.sql = {}  # etiqueta -> Histograma
+        self._etiquetas_sql = {}  # texto SQL -> etiqueta (p. ej. "SELECT usuarios")
+        self._patron_verbo = re.compile(r'\s*(\w+)')
+        self._patron_tabla = re.compile(r'\b(?:FROM|INTO|UPDATE|ON)\s+(\w+)', re.IGNORECASE)
+
+    def observar_http(self, metodo: str, ruta: str, segundos: float, error: bool):
+        entrada = self.http.get((metodo, ruta))
+        if entrada is None:
+            entrada = self.http[(metodo, ruta)] = [0, 0, Histograma()]
+        entrada[0] += 1
+        if error:
+            entrada[1] += 1
+        entrada[2].observar(segundos)
+
+    def etiqueta_sql(self, sql: str) -> str:
+        etiqueta = self._etiquetas_sql.get(sql)
+        if etiqueta is None:
+            verbo = self._patron_verbo.match(sql)
+            tabla = self._patron_tabla.search(sql)
+            etiqueta = ' '.join(filter(None, (
+                verbo.group(1).upper() if verbo else 'OTRA',
+                tabla.group(1) if tabla else None
+            )))
+            self._etiquetas_sql[sql] = etiqueta
+        return etiqueta
+
+    def observar_sql(self, etiqueta: str, segundos: float):
+        histograma = self.sql.get(etiqueta)
+        if histograma is None:
+            histograma = self.sql.setdefault(etiqueta, Histograma())
+        histograma.observar(segundos)
+
+    def exportar(self, medidores: Dict[str, tuple]) -> str:
+        lineas = [
+            '# HELP hakari_http_peticiones_total Peticiones HTTP por ruta',
+            '# TYPE hakari_http_peticiones_total counter'
+        ]
+        for (metodo, ruta), (peticiones, _, _) in self.http.items():
+            lineas.append(f'hakari_http_peticiones_total{{metodo="{metodo}",ruta="{ruta}"}} {peticiones}')
+        lineas += [
+            '# HELP hakari_http_errores_total Respuestas 5xx o excepciones por ruta',
+            '# TYPE hakari_http_errores_total counter'
+        ]
+        for (metodo, ruta), (_, errores, _) in self.http.items():
+            lineas.append(f'hakari_http_errores_total{{metodo="{metodo}",ruta="{ruta}"}} {errores}')
+        lineas += [
+            '# HELP hakari_http_latencia_segundos Latencia HTTP por ruta',
+            '# TYPE hakari_http_latencia_segundos histogram'
+        ]
+        for (metodo, ruta), (_, _, histograma) in self.http.items():
+            lineas += histograma.exportar('hakari_http_latencia_segundos', f'metodo="{metodo}",ruta="{ruta}"')
+        lineas += [
+            '# HELP hakari_sql_latencia_segundos Latencia de sentencias SQL y commits',
+            '# TYPE hakari_sql_latencia_segundos histogram'
+        ]
+        for etiqueta, histograma in list(self.sql.items()):
+            lineas += histograma.exportar('hakari_sql_latencia_segundos', f'sentencia="{etiqueta}"')
+        for nombre, (ayuda, valores) in medidores.items():
+            lineas += [f'# HELP {nombre} {ayuda}', f'# TYPE {nombre} gauge']
+            for etiquetas, valor in valores:
+                lineas.append(f'{nombre}{{{etiquetas}}} {valor}' if etiquetas else f'{nombre} {valor}')
+        return '\n'.join(lineas) + '\n'
+
+metricas = Metricas()
+
+class MiddlewareMetricas:
+    """Middleware ASGI: cuenta peticiones/errores y mide latencia por ruta.
+
+    Se etiqueta con la plantilla de la ruta (/estado/{session_id}), no con
+    la URL real, para que la cantidad de series quede acotada.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        estado = [500]
+
+        async def send_medido(mensaje):
+            if mensaje['type'] == 'http.response.start':
+                estado[0] = mensaje['status']
+            await send(mensaje)
+
+        inicio = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_medido)
+        finally:
+            ruta = scope.get('route')
+            metricas.observar_http(
+                scope['method'],
+                getattr(ruta, 'path', 'sin_ruta'),
+                time.perf_counter() - inicio,
+                estado[0] >= 500
+            )
+
+class CursorMedido:
+    """Envuelve un cursor sqlite3 y mide cada execute por etiqueta de sentencia"""
+
+    __slots__ = ('_cursor',)
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self._cursor = cursor
+
+    def execute(self, sql: str, params=()):
+        inicio = time.perf_counter()
+        try:
+            return self._cursor.execute(sql, params)
+        finally:
+            metricas.observar_sql(metricas.etiqueta_sql(sql), time.perf_counter() - inicio)
+
+    def executemany(self, sql: str, filas):
+        inicio = time.perf_counter()
+        try:
+            return self._cursor.executemany(sql, filas)
+        finally:
+            metricas.observar_sql(metricas.etiqueta_sql(sql), time.perf_counter() - inicio)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, nombre):
+        return getattr(self._cursor, nombre)
+
+# Límites de tasa y control de admisión
+class LimitadorTasa:
+    """Token bucket por clave con estado acotado.
+
+    Cada clave guarda (fichas, último uso) en un OrderedDict usado como LRU:
+    consumir es O(1) y, al superar `max_claves`, se descarta la clave menos
+    usada (que vuelve con el balde lleno, lo mismo que una clave nueva).
+    """
+
+    def __init__(self, tasa: float, rafaga: int, max_claves: int = LIMITADOR_CLAVES_MAX):
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self.max_claves = max_claves
+        self.rechazos = 0
+        self._baldes = OrderedDict()  # clave -> [fichas, instante]
+
+    def consumir(self, clave: str, costo: float = 1) -> float:
+        """0 si se admite; si no, los segundos hasta que haya fichas"""
+        if self.tasa <= 0:
+            return 0.0
+        ahora = time.monotonic()
+        balde = self._baldes.get(clave)
+        if balde is None:
+            balde = self._baldes[clave] = [float(self.rafaga), ahora]
+            if len(self._baldes) > self.max_claves:
+                self._baldes.popitem(last=False)
+        else:
+            self._baldes.move_to_end(clave)
+            balde[0] = min(self.rafaga, balde[0] + (ahora - balde[1]) * self.tasa)
+            balde[1] = ahora
+        
+        if balde[0] >= costo:
+            balde[0] -= costo
+            return 0.0
+        self.rechazos += 1
+        return (costo - balde[0]) / self.tasa
+
+class ControlAdmision:
+    """Decide si una petición entra antes de que llegue al escritor.
+
+    - 429 si la sesión (o la IP, ver MiddlewareAdmision) superó su tasa.
+    - 503 si la cola del escritor ya tiene demasiadas escrituras pendientes:
+      es mejor rechazar rápido que dejar que todas las peticiones esperen
+      detrás de la cola hasta el timeout.
+    Ambas respuestas llevan Retry-After.
+    """
+
+    def __init__(self):
+        self.por_sesion = LimitadorTasa(LIMITE_SESION, RAFAGA_SESION)
+        self.por_ip = LimitadorTasa(LIMITE_IP, RAFAGA_IP)
+        self.saturado = 0
+
+    def admitir(self, session_id: Optional[str] = None, escritura: bool = True):
+        if session_id is not None:
+            espera = self.por_sesion.consumir(session_id)
+            if espera:
+                raise HTTPException(status_code=429, detail="⏳ Demasiados mensajes, esperá un momento",
+                                    headers={'Retry-After': str(math.ceil(espera))})
+        if escritura and ADMISION_COLA_MAX and hakari_db.profundidad_cola() >= ADMISION_COLA_MAX:
+            self.saturado += 1
+            raise HTTPException(status_code=503, detail="🚧 Servidor saturado, reintentá en un momento",
+                                headers={'Retry-After': '1'})
+
+    def estadisticas(self) -> Dict:
+        return {
+            'rechazos_sesion': self.por_sesion.rechazos,
+            'rechazos_ip': self.por_ip.rechazos,
+            'rechazos_saturacion': self.saturado,
+            'cola_escritura': hakari_db.profundidad_cola()
+        }
+
+control_admision = ControlAdmision()
+
+class MiddlewareAdmision:
+    """Middleware ASGI: límite de tasa por IP antes de enrutar (HTTP y WebSocket).
+
+    Las rutas de RUTAS_SIN_LIMITE nunca se rechazan. Detrás de un proxy la
+    IP es la que informe uvicorn (ver --forwarded-allow-ips).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket') or scope['path'] in RUTAS_SIN_LIMITE:
+            await self.app(scope, receive, send)
+            return
+        
+        cliente = scope.get('client')
+        espera = control_admision.por_ip.consumir(cliente[0] if cliente else 'desconocido')
+        if not espera:
+            await self.app(scope, receive, send)
+            return
+        
+        if scope['type'] == 'websocket':
+            await send({'type': 'websocket.close', 'code': 1013})  # Try Again Later
+            return
+        cuerpo = _serializar({'detail': '⏳ Demasiadas peticiones, esperá un momento'})
+        await send({
+            'type': 'http.response.start',
+            'status': 429,
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(cuerpo)).encode()),
+                        (b'retry-after', str(math.ceil(espera)).encode())]
+        })
+        await send({'type': 'http.response.body', 'body': cuerpo})
+
+class InformeArranque:
+    """Cuánto tardó cada fase del arranque, en milisegundos"""
+
+    def __init__(self, inicio: float):
+        self.inicio = inicio
+        self.fases = {}
+        self.migraciones = 0
+
+    def marcar(self, fase: str):
+        """Registra el tiempo transcurrido desde el inicio hasta ahora"""
+        self.fases[fase] = round((time.perf_counter() - self.inicio) * 1000, 1)
+
+    def medir(self, fase: str, funcion: Callable) -> Any:
+        inicio = time.perf_counter()
+        try:
+            return funcion()
+        finally:
+            self.fases[fase] = round((time.perf_counter() - inicio) * 1000, 1)
+
+    def terminar(self):
+        self.marcar('total')
+        logger.info(f'Arranque ({self.migraciones} migraciones): '
+                    + ', '.join(f'{fase} {ms} ms' for fase, ms in self.fases.items()))
+
+    def resumen(self) -> Dict:
+        return {'fases_ms': self.fases, 'migraciones': self.migraciones}
+
+informe_arranque = InformeArranque(_INICIO_IMPORTACION)
+
+def _calentar():
+    """Deja listo lo que la primera petición pagaría: conexiones, páginas y regex"""
+    hakari_db.calentar()
+    hakari.obtener_respuesta_rapida('hola', {'nombre': ''})
+    _serializar({})
+
+@asynccontextmanager
+async def ciclo_de_vida(app: FastAPI):
+    # La BD y la personalidad se preparan acá y no al importar el módulo
+    inicio = informe_arranque.medir('base_de_datos', hakari_db.iniciar)
+    informe_arranque.migraciones = inicio['migraciones']
+    informe_arranque.medir('personalidad', hakari.preparar)
+    informe_arranque.medir('estaticos', recursos_estaticos.cargar)
+    if CALENTAR:
+        informe_arranque.medir('calentamiento', _calentar)
+    informe_arranque.terminar()
+    
+    tarea_mantenimiento = asyncio.create_task(mantenimiento_db.bucle())
+    tarea_catalogo = asyncio.create_task(hakari.catalogo.vigilar(RESPUESTAS_RECARGA_S))
+    yield
+    tarea_mantenimiento.cancel()
+    tarea_catalogo.cancel()
+    await estados_hakari.volcar()
+    # Cerrar el escritor y el pool de lectura al apagar
+    hakari_db.cerrar()
+
 app = FastAPI(
     title="Hakari API",
     description="Backend para la aplicación Hakari - Personalidad 90% real con ciclo menstrual",
-    version="2.0.0"
+    version="2.0.0",
+    lifespan=ciclo_de_vida
 )
 
+# El límite por IP queda dentro de métricas y CORS: los 429 se cuentan y
+# llevan las cabeceras CORS
+app.add_middleware(MiddlewareAdmision)
+
+if METRICAS_ACTIVAS:
+    app.add_middleware(MiddlewareMetricas)
+
 # CORS para app móvil
 app.add_middleware(
     CORSMiddleware,
@@ -41,63 +495,969 @@ class ChatMessage(BaseModel):
     session_id: str
     message: str
 
-# Base de datos optimizada
-class HakariDatabase:
-    def __init__(self):
-        self.conn = sqlite3.connect('hakari.db', check_same_thread=False)
-        self.conn.execute('PRAGMA journal_mode=WAL')
-        self.conn.execute('PRAGMA cache_size=10000')
-        self.init_db()
-    
-    def init_db(self):
-        cursor = self.conn.cursor()
+class MensajeStream(BaseModel):
+    message: str
+
+class ChatLote(BaseModel):
+    session_id: str
+    messages: List[str]
+
+# Resúmenes de actividad mantenidos en cada escritura
+class ResumenesActividad:
+    """Tablas de resumen para /estadisticas, actualizadas en la misma
+    transacción que el chat, el registro y los logros.
+
+    Así los paneles leen O(días) filas en vez de agrupar todas las
+    conversaciones. `reconstruir` las vuelve a calcular desde los datos
+    crudos (incluidas las conversaciones archivadas).
+    """
+
+    TABLAS = ('resumen_diario', 'resumen_estados', 'actividad_usuarios', 'resumen_logros')
+
+    def crear_tablas(self, cursor: sqlite3.Cursor) -> bool:
+        """Crea las tablas; devuelve True si no existían (hay que reconstruir)"""
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'resumen_diario'")
+        existian = cursor.fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS resumen_diario (
+                dia TEXT PRIMARY KEY,
+                mensajes INTEGER NOT NULL DEFAULT 0,
+                usuarios_activos INTEGER NOT NULL DEFAULT 0,
+                registros INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS resumen_estados (
+                dia TEXT,
+                estado TEXT,
+                mensajes INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (dia, estado)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS actividad_usuarios (
+                dia TEXT,
+                usuario_email TEXT,
+                mensajes INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (dia, usuario_email)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS resumen_logros (
+                logro_id TEXT PRIMARY KEY,
+                desbloqueos INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        ''')
+        return not existian
+
+    @staticmethod
+    def _hoy() -> str:
+        # Mismo día que date('now') de SQLite (UTC), que es lo que guarda `fecha`
+        return datetime.utcnow().strftime('%Y-%m-%d')
+
+    # --- Incrementos (dentro de la transacción del escritor) -------------
+
+    def registrar_mensajes(self, cursor: sqlite3.Cursor, email: str, estados: List[str]):
+        dia = self._hoy()
+        cantidad = len(estados)
+        
+        cursor.execute('INSERT OR IGNORE INTO actividad_usuarios (dia, usuario_email, mensajes) VALUES (?, ?, ?)',
+                       (dia, email, cantidad))
+        nuevo_activo = cursor.rowcount
+        if not nuevo_activo:
+            cursor.execute('UPDATE actividad_usuarios SET mensajes = mensajes + ? WHERE dia = ? AND usuario_email = ?',
+                           (cantidad, dia, email))
         
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS usuarios (
-                email TEXT PRIMARY KEY,
-                nombre TEXT,
-                confianza INTEGER DEFAULT 30,
-                interacciones INTEGER DEFAULT 0,
-                energia INTEGER DEFAULT 70,
-                relacion INTEGER DEFAULT 50,
-                ultima_visita DATETIME,
-                fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
+            INSERT INTO resumen_diario (dia, mensajes, usuarios_activos) VALUES (?, ?, ?)
+            ON CONFLICT(dia) DO UPDATE SET
+                mensajes = mensajes + excluded.mensajes,
+                usuarios_activos = usuarios_activos + excluded.usuarios_activos
+        ''', (dia, cantidad, nuevo_activo))
+        
+        por_estado = {}
+        for estado in estados:
+            por_estado[estado] = por_estado.get(estado, 0) + 1
+        cursor.executemany('''
+            INSERT INTO resumen_estados (dia, estado, mensajes) VALUES (?, ?, ?)
+            ON CONFLICT(dia, estado) DO UPDATE SET mensajes = mensajes + excluded.mensajes
+        ''', [(dia, estado, n) for estado, n in por_estado.items()])
+
+    def registrar_usuario(self, cursor: sqlite3.Cursor):
+        cursor.execute('''
+            INSERT INTO resumen_diario (dia, registros) VALUES (?, 1)
+            ON CONFLICT(dia) DO UPDATE SET registros = registros + 1
+        ''', (self._hoy(),))
+
+    def registrar_desbloqueo(self, cursor: sqlite3.Cursor, logro_id: str):
+        cursor.execute('''
+            INSERT INTO resumen_logros (logro_id, desbloqueos) VALUES (?, 1)
+            ON CONFLICT(logro_id) DO UPDATE SET desbloqueos = desbloqueos + 1
+        ''', (logro_id,))
+
+    def registrar_conversaciones(self, cursor: sqlite3.Cursor, filas: List[tuple]):
+        """Suma conversaciones con fecha propia (fecha, usuario_email, estado_emocional).
+
+        Pasan por una tabla temporal para agrupar con las mismas expresiones
+        que `reconstruir`.
+        """
+        cursor.execute('CREATE TEMP TABLE IF NOT EXISTS conversaciones_nuevas (fecha, usuario_email, estado_emocional)')
+        cursor.executemany('INSERT INTO temp.conversaciones_nuevas VALUES (?, ?, ?)', filas)
+        # Usuarios activos: solo los pares (día, usuario) que todavía no estaban
+        cursor.execute('''
+            INSERT INTO resumen_diario (dia, usuarios_activos)
+            SELECT n.dia, COUNT(*) FROM (
+                SELECT DISTINCT date(fecha) AS dia, usuario_email FROM temp.conversaciones_nuevas
+            ) n
+            WHERE NOT EXISTS (SELECT 1 FROM actividad_usuarios a
+                              WHERE a.dia = n.dia AND a.usuario_email = n.usuario_email)
+            GROUP BY n.dia
+            ON CONFLICT(dia) DO UPDATE SET usuarios_activos = usuarios_activos + excluded.usuarios_activos
+        ''')
+        cursor.execute('''
+            INSERT INTO actividad_usuarios (dia, usuario_email, mensajes)
+            SELECT date(fecha), usuario_email, COUNT(*) FROM temp.conversaciones_nuevas WHERE true GROUP BY 1, 2
+            ON CONFLICT(dia, usuario_email) DO UPDATE SET mensajes = mensajes + excluded.mensajes
+        ''')
+        cursor.execute('''
+            INSERT INTO resumen_estados (dia, estado, mensajes)
+            SELECT date(fecha), estado_emocional, COUNT(*) FROM temp.conversaciones_nuevas WHERE true GROUP BY 1, 2
+            ON CONFLICT(dia, estado) DO UPDATE SET mensajes = mensajes + excluded.mensajes
+        ''')
+        cursor.execute('''
+            INSERT INTO resumen_diario (dia, mensajes)
+            SELECT date(fecha), COUNT(*) FROM temp.conversaciones_nuevas WHERE true GROUP BY 1
+            ON CONFLICT(dia) DO UPDATE SET mensajes = mensajes + excluded.mensajes
+        ''')
+        cursor.execute('DELETE FROM temp.conversaciones_nuevas')
+
+    # --- Recuentos (tablas chicas: usuarios y logros) --------------------
+
+    def recontar_registros(self, cursor: sqlite3.Cursor):
+        cursor.execute('UPDATE resumen_diario SET registros = 0 WHERE registros != 0')
+        cursor.execute('''
+            INSERT INTO resumen_diario (dia, registros)
+            SELECT COALESCE(date(fecha_registro), date('now')), COUNT(*) FROM usuarios WHERE true GROUP BY 1
+            ON CONFLICT(dia) DO UPDATE SET registros = excluded.registros
+        ''')
+
+    def recontar_logros(self, cursor: sqlite3.Cursor):
+        cursor.execute('DELETE FROM resumen_logros')
+        cursor.execute('''
+            INSERT INTO resumen_logros (logro_id, desbloqueos)
+            SELECT logro_id, COUNT(*) FROM logros GROUP BY logro_id
         ''')
+
+    # --- Reconstrucción -------------------------------------------------
+
+    def reconstruir(self, cursor: sqlite3.Cursor) -> Dict[str, int]:
+        """Recalcula todo desde los datos crudos, dentro de la transacción del llamador"""
+        for tabla in self.TABLAS:
+            cursor.execute(f'DELETE FROM {tabla}')
+        
+        # Conversaciones archivadas primero (cada mes es su propio archivo)
+        cursor.execute('SELECT ruta FROM archivos_conversaciones')
+        for (ruta,) in cursor.fetchall():
+            if not os.path.exists(ruta):
+                continue
+            archivado = sqlite3.connect(f'file:{ruta}?mode=ro', uri=True)
+            try:
+                actividad = archivado.execute('''
+                    SELECT date(fecha), usuario_email, COUNT(*) FROM conversaciones GROUP BY 1, 2
+                ''').fetchall()
+                estados = archivado.execute('''
+                    SELECT date(fecha), estado_emocional, COUNT(*) FROM conversaciones GROUP BY 1, 2
+                ''').fetchall()
+            finally:
+                archivado.close()
+            cursor.executemany('''
+                INSERT INTO actividad_usuarios (dia, usuario_email, mensajes) VALUES (?, ?, ?)
+                ON CONFLICT(dia, usuario_email) DO UPDATE SET mensajes = mensajes + excluded.mensajes
+            ''', actividad)
+            cursor.executemany('''
+                INSERT INTO resumen_estados (dia, estado, mensajes) VALUES (?, ?, ?)
+                ON CONFLICT(dia, estado) DO UPDATE SET mensajes = mensajes + excluded.mensajes
+            ''', estados)
         
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversaciones (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_email TEXT,
-                mensaje_usuario TEXT,
-                mensaje_hakari TEXT,
-                estado_emocional TEXT,
-                fecha DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
+            INSERT INTO actividad_usuarios (dia, usuario_email, mensajes)
+            SELECT date(fecha), usuario_email, COUNT(*) FROM conversaciones WHERE true GROUP BY 1, 2
+            ON CONFLICT(dia, usuario_email) DO UPDATE SET mensajes = mensajes + excluded.mensajes
+        ''')
+        cursor.execute('''
+            INSERT INTO resumen_estados (dia, estado, mensajes)
+            SELECT date(fecha), estado_emocional, COUNT(*) FROM conversaciones WHERE true GROUP BY 1, 2
+            ON CONFLICT(dia, estado) DO UPDATE SET mensajes = mensajes + excluded.mensajes
         ''')
+        cursor.execute('''
+            INSERT INTO resumen_diario (dia, mensajes, usuarios_activos)
+            SELECT dia, SUM(mensajes), COUNT(*) FROM actividad_usuarios GROUP BY dia
+        ''')
+        self.recontar_registros(cursor)
+        self.recontar_logros(cursor)
         
+        cursor.execute('SELECT COUNT(*) FROM resumen_diario')
+        dias = cursor.fetchone()[0]
+        logger.info(f"Resúmenes de actividad reconstruidos ({dias} días)")
+        return {'dias': dias}
+
+resumenes_actividad = ResumenesActividad()
+
+# Base de datos optimizada
+class HakariDatabase:
+    """Acceso a SQLite fuera del event loop.
+
+    - Lecturas: pool de conexiones de solo lectura (WAL permite lectores
+      concurrentes) ejecutadas en un ThreadPoolExecutor del mismo tamaño.
+    - Escrituras: una única conexión escritora (`self.conn`) alimentada por
+      una cola acotada y consumida por un hilo dedicado, así nunca hay dos
+      escritores peleando por el lock de SQLite. El hilo agrupa las tareas
+      pendientes en una sola transacción (group commit): un fsync por lote.
+    """
+
+    def __init__(self, ruta: str = DB_PATH, lectores: int = DB_LECTORES,
+                 durabilidad: str = DB_DURABILIDAD):
+        self.ruta = ruta
+        self.durabilidad = durabilidad
+        self.max_lectores = max(1, lectores)
+        self.busqueda_activa = False
+
+        # Nada toca el disco hasta iniciar() (lo llama el lifespan de la app)
+        self.conn = None
+        self._iniciada = False
+        self._lock_inicio = threading.Lock()
+        self._lectores = queue.Queue()
+        self._pool_lectura = None
+        self._cola_escritura = queue.Queue(maxsize=DB_COLA_MAX)
+        self._escritor = None
+
+    def iniciar(self) -> Dict[str, int]:
+        """Abre la conexión escritora, migra el esquema y arranca el escritor.
+
+        Es idempotente. Las conexiones de lectura se abren a demanda.
+        """
+        with self._lock_inicio:
+            if self._iniciada:
+                return {'migraciones': 0}
+            
+            # Conexión escritora: solo la usan las migraciones y el hilo escritor
+            self.conn = self._conectar()
+            aplicadas = self.migrar()
+            self.busqueda_activa = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'conversaciones_fts'"
+            ).fetchone() is not None
+            
+            self._pool_lectura = ThreadPoolExecutor(max_workers=self.max_lectores, thread_name_prefix='hakari-lector')
+            self._escritor = threading.Thread(target=self._bucle_escritor, name='hakari-escritor', daemon=True)
+            self._escritor.start()
+            self._iniciada = True
+            return {'migraciones': aplicadas}
+
+    def calentar(self):
+        """Abre todas las conexiones de lectura y carga en caché las páginas raíz"""
+        conexiones = [self._tomar_lector() for _ in range(self.max_lectores)]
+        for conn in conexiones:
+            conn.execute("SELECT 1 FROM usuarios WHERE email = ''").fetchall()
+            conn.execute("SELECT 1 FROM conversaciones WHERE usuario_email = '' ORDER BY id DESC LIMIT 1").fetchall()
+            self._lectores.put(conn)
+
+    def _conectar(self, solo_lectura: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.ruta, check_same_thread=False)
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.execute('PRAGMA cache_size=10000')
+        if solo_lectura:
+            conn.execute('PRAGMA query_only=ON')
+        else:
+            # Solo tiene efecto en una BD nueva (antes de crear tablas)
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+    
+    def migrar(self) -> int:
+        """Aplica en orden las migraciones pendientes según PRAGMA user_version.
+
+        Con el esquema al día es una sola lectura del encabezado de la BD.
+        Cada paso corre en su propia transacción junto con el cambio de
+        versión; con varios workers el primero que toma el lock migra y los
+        demás ven la versión nueva y lo saltean.
+        """
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        aplicadas = 0
+        for numero, (descripcion, migracion) in enumerate(MIGRACIONES, start=1):
+            if numero <= version:
+                continue
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self.conn.execute('PRAGMA user_version').fetchone()[0] >= numero:
+                    self.conn.rollback()
+                    continue
+                inicio = time.perf_counter()
+                migracion(self.conn.cursor())
+                self.conn.execute(f'PRAGMA user_version = {numero}')
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            logger.info(f"Migración {numero} ({descripcion}) aplicada en {(time.perf_counter() - inicio) * 1000:.1f} ms")
+            aplicadas += 1
+        return aplicadas
+
+    @staticmethod
+    def _cursor(conn: sqlite3.Connection):
+        cursor = conn.cursor()
+        return CursorMedido(cursor) if METRICAS_ACTIVAS else cursor
+
+    def tamanos_archivos(self) -> Dict[str, int]:
+        """Bytes de la BD y de su WAL (0 si el archivo no existe)"""
+        tamanos = {}
+        for archivo, ruta in (('db', self.ruta), ('wal', self.ruta + '-wal')):
+            try:
+                tamanos[archivo] = os.path.getsize(ruta)
+            except OSError:
+                tamanos[archivo] = 0
+        return tamanos
+
+    def profundidad_cola(self) -> int:
+        return self._cola_escritura.qsize()
+
+    # --- Lecturas -------------------------------------------------------
+
+    def _tomar_lector(self) -> sqlite3.Connection:
+        # El pool de hilos tiene max_lectores hilos, así que nunca se abren más
+        # conexiones que esas; se crean la primera vez que hacen falta
+        try:
+            return self._lectores.get_nowait()
+        except queue.Empty:
+            return self._conectar(solo_lectura=True)
+
+    def _ejecutar_lectura(self, funcion: Callable, args: tuple) -> Any:
+        conn = self._tomar_lector()
+        try:
+            return funcion(self._cursor(conn), *args)
+        finally:
+            self._lectores.put(conn)
+
+    async def leer(self, funcion: Callable, *args) -> Any:
+        """Ejecuta funcion(cursor, *args) con una conexión del pool de lectura"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool_lectura, self._ejecutar_lectura, funcion, args)
+
+    # --- Escrituras -----------------------------------------------------
+
+    @property
+    def en_lotes(self) -> bool:
+        return self.durabilidad == 'lotes'
+
+    async def _poner_en_cola(self, tarea: tuple):
+        try:
+            self._cola_escritura.put_nowait(tarea)
+        except queue.Full:
+            # Cola llena: esperar turno fuera del event loop (backpressure)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._cola_escritura.put, tarea)
+
+    async def escribir(self, funcion: Callable, *args) -> Any:
+        """Encola funcion(cursor, *args) para el hilo escritor y espera el commit"""
+        loop = asyncio.get_running_loop()
+        futuro = loop.create_future()
+        await self._poner_en_cola((funcion, args, futuro, loop, None))
+        return await futuro
+
+    async def encolar(self, funcion: Callable, *args, al_confirmar: Optional[Callable] = None):
+        """Encola funcion(cursor, *args) sin esperar el commit (write-behind).
+
+        `al_confirmar` se llama en el event loop una vez hecho el commit, con
+        lo que devolvió la función.
+        """
+        loop = asyncio.get_running_loop() if al_confirmar else None
+        await self._poner_en_cola((funcion, args, None, loop, al_confirmar))
+
+    def _tomar_lote(self) -> List[Optional[tuple]]:
+        """Bloquea hasta la primera tarea y junta las que vengan detrás.
+
+        En modo 'lotes' espera hasta DB_LOTE_MS para llenar el lote; en modo
+        'estricta' solo toma lo que ya está en cola para no sumar latencia.
+        """
+        lote = [self._cola_escritura.get()]
+        limite = time.monotonic() + DB_LOTE_MS / 1000
+        while lote[-1] is not None and len(lote) < DB_LOTE_MAX:
+            try:
+                if self.en_lotes:
+                    espera = limite - time.monotonic()
+                    if espera <= 0:
+                        break
+                    lote.append(self._cola_escritura.get(timeout=espera))
+                else:
+                    lote.append(self._cola_escritura.get_nowait())
+            except queue.Empty:
+                break
+        return lote
+
+    def _bucle_escritor(self):
+        while True:
+            lote = self._tomar_lote()
+            fin = lote[-1] is None
+            tareas = lote[:-1] if fin else lote
+            if tareas:
+                self._ejecutar_lote(tareas)
+            if fin:
+                break
+
+    def _ejecutar_lote(self, tareas: List[tuple]):
+        resultados = []
+        try:
+            self.conn.execute('BEGIN IMMEDIATE')
+            for funcion, args, futuro, loop, al_confirmar in tareas:
+                # Cada tarea en su savepoint: si una falla no tumba el lote
+                self.conn.execute('SAVEPOINT tarea')
+                try:
+                    resultado = funcion(self._cursor(self.conn), *args)
+                    self.conn.execute('RELEASE tarea')
+                    resultados.append((resultado, None))
+                except Exception as e:
+                    self.conn.execute('ROLLBACK TO tarea')
+                    self.conn.execute('RELEASE tarea')
+                    resultados.append((None, e))
+            inicio = time.perf_counter()
+            self.conn.commit()
+            if METRICAS_ACTIVAS:
+                metricas.observar_sql('COMMIT', time.perf_counter() - inicio)
+        except Exception as e:
+            logger.error(f"Error en lote de escritura: {e}")
+            self.conn.rollback()
+            resultados = [(None, e)] * len(tareas)
+
+        for (funcion, args, futuro, loop, al_confirmar), (resultado, error) in zip(tareas, resultados):
+            if futuro is None:
+                if error is not None:
+                    logger.error(f"Error en escritura diferida {funcion.__name__}: {error}")
+                elif al_confirmar is not None:
+                    loop.call_soon_threadsafe(al_confirmar, resultado)
+                continue
+            loop.call_soon_threadsafe(self._resolver, futuro, resultado, error)
+
+    @staticmethod
+    def _resolver(futuro: asyncio.Future, resultado: Any, error: Optional[Exception]):
+        if futuro.cancelled():
+            return
+        if error is not None:
+            futuro.set_exception(error)
+        else:
+            futuro.set_result(resultado)
+
+    def cerrar(self):
+        """Escribe lo pendiente en la cola y cierra todas las conexiones"""
+        if not self._iniciada:
+            return
+        self._iniciada = False
+        self._cola_escritura.put(None)
+        self._escritor.join()
+        self._pool_lectura.shutdown(wait=True)
+        while not self._lectores.empty():
+            self._lectores.get_nowait().close()
+        self.conn.close()
+
+# Migraciones del esquema, en orden. Cada una es idempotente (IF NOT EXISTS)
+# para poder aplicarse sobre una BD creada antes de llevar versión.
+def _migrar_tablas_base(cursor: sqlite3.Cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usuarios (
+            email TEXT PRIMARY KEY,
+            nombre TEXT,
+            confianza INTEGER DEFAULT 30,
+            interacciones INTEGER DEFAULT 0,
+            energia INTEGER DEFAULT 70,
+            relacion INTEGER DEFAULT 50,
+            ultima_visita DATETIME,
+            fecha_registro DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversaciones (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_email TEXT,
+            mensaje_usuario TEXT,
+            mensaje_hakari TEXT,
+            estado_emocional TEXT,
+            fecha DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS logros (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            usuario_email TEXT,
+            logro_id TEXT,
+            nombre TEXT,
+            descripcion TEXT,
+            fecha_desbloqueo DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Índices para mejor rendimiento
+    # (usuario_email, id) sirve tanto para filtrar por usuario como para
+    # paginar por id sin ordenar; reemplaza al índice solo por email
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversaciones_email_id ON conversaciones(usuario_email, id)')
+    cursor.execute('DROP INDEX IF EXISTS idx_conversaciones_email')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversaciones_fecha ON conversaciones(fecha)')
+    
+    # Un logro por usuario: permite INSERT OR IGNORE sin SELECT previo.
+    # Si la BD viene de antes del índice, se eliminan duplicados una vez.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_logros_usuario'")
+    if not cursor.fetchone():
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS logros (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                usuario_email TEXT,
-                logro_id TEXT,
-                nombre TEXT,
-                descripcion TEXT,
-                fecha_desbloqueo DATETIME DEFAULT CURRENT_TIMESTAMP
+            DELETE FROM logros WHERE id NOT IN (
+                SELECT MIN(id) FROM logros GROUP BY usuario_email, logro_id
             )
         ''')
+        cursor.execute('CREATE UNIQUE INDEX idx_logros_usuario ON logros(usuario_email, logro_id)')
+
+def _migrar_estado_compartido(cursor: sqlite3.Cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sesiones (
+            session_id TEXT PRIMARY KEY,
+            email TEXT,
+            nombre TEXT,
+            inicio_sesion TEXT,
+            ultimo_acceso REAL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_sesiones_email ON sesiones(email)')
+
+def _migrar_archivo(cursor: sqlite3.Cursor):
+    # Archivos mensuales de conversaciones (ver ArchivoConversaciones)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archivos_conversaciones (
+            mes TEXT PRIMARY KEY,
+            ruta TEXT,
+            id_min INTEGER,
+            id_max INTEGER,
+            filas INTEGER,
+            compactado INTEGER DEFAULT 0
+        )
+    ''')
+    # Una sola fila: `generacion` cambia con cada cambio de la tabla de
+    # arriba (los workers releen su lista) y `archivador`/`vence` son el
+    # turno de quien archiva, para que no corran dos a la vez
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archivo_control (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            generacion INTEGER NOT NULL DEFAULT 0,
+            archivador TEXT,
+            vence REAL
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO archivo_control (id) VALUES (1)')
+
+def _migrar_busqueda(cursor: sqlite3.Cursor):
+    """Índice FTS5 sobre los mensajes, sincronizado por triggers.
+
+    Es una tabla de contenido externo: guarda solo el índice invertido y
+    lee el texto de `conversaciones`. Los triggers lo mantienen al día
+    con cualquier escritura (chat, importación, archivo). Al crearlo se
+    indexan las filas que ya existían.
+
+    Además indexa un token por usuario (`propietario`): con
+    `propietario : "u<hex>" AND ...` FTS5 cruza las listas de documentos y
+    el costo depende de las filas del usuario, no de todas. El token sale
+    de una columna generada (hex del email: un solo token, sin colisiones),
+    así 'rebuild' y los triggers indexan lo mismo.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversaciones_fts'")
+    existia = cursor.fetchone() is not None
+    cursor.execute("SELECT 1 FROM pragma_table_xinfo('conversaciones') WHERE name = 'propietario'")
+    if cursor.fetchone() is None:
+        try:
+            cursor.execute('''
+                ALTER TABLE conversaciones ADD COLUMN propietario TEXT
+                GENERATED ALWAYS AS ('u' || hex(usuario_email)) VIRTUAL
+            ''')
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite sin columnas generadas, /buscar deshabilitado: {e}")
+            return
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS conversaciones_fts USING fts5(
+                mensaje_usuario, mensaje_hakari, propietario,
+                content='conversaciones', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        logger.warning(f"SQLite sin FTS5, /buscar deshabilitado: {e}")
+        return
+    
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversaciones_fts_insertar AFTER INSERT ON conversaciones BEGIN
+            INSERT INTO conversaciones_fts (rowid, mensaje_usuario, mensaje_hakari, propietario)
+            VALUES (new.id, new.mensaje_usuario, new.mensaje_hakari, new.propietario);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversaciones_fts_borrar AFTER DELETE ON conversaciones BEGIN
+            INSERT INTO conversaciones_fts (conversaciones_fts, rowid, mensaje_usuario, mensaje_hakari, propietario)
+            VALUES ('delete', old.id, old.mensaje_usuario, old.mensaje_hakari, old.propietario);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversaciones_fts_actualizar AFTER UPDATE ON conversaciones BEGIN
+            INSERT INTO conversaciones_fts (conversaciones_fts, rowid, mensaje_usuario, mensaje_hakari, propietario)
+            VALUES ('delete', old.id, old.mensaje_usuario, old.mensaje_hakari, old.propietario);
+            INSERT INTO conversaciones_fts (rowid, mensaje_usuario, mensaje_hakari, propietario)
+            VALUES (new.id, new.mensaje_usuario, new.mensaje_hakari, new.propietario);
+        END
+    ''')
+    if not existia:
+        cursor.execute("INSERT INTO conversaciones_fts (conversaciones_fts) VALUES ('rebuild')")
+
+def _migrar_resumenes(cursor: sqlite3.Cursor):
+    # Resúmenes para /estadisticas; si son nuevos se calculan una vez
+    if resumenes_actividad.crear_tablas(cursor):
+        resumenes_actividad.reconstruir(cursor)
+
+def _migrar_personalidad_usuarios(cursor: sqlite3.Cursor):
+    # Reemplaza a la fila única de estado_hakari (un humor para todos)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS personalidad_usuarios (
+            email TEXT PRIMARY KEY,
+            estado TEXT,
+            capricho TEXT,
+            fase TEXT,
+            dolor INTEGER,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('DROP TABLE IF EXISTS estado_hakari')
+
+MIGRACIONES = [
+    ('tablas base e índices', _migrar_tablas_base),
+    ('estado compartido entre workers', _migrar_estado_compartido),
+    ('archivo mensual de conversaciones', _migrar_archivo),
+    ('búsqueda de texto completo', _migrar_busqueda),
+    ('resúmenes de actividad', _migrar_resumenes),
+    ('estado de Hakari por usuario', _migrar_personalidad_usuarios),
+]
+
+hakari_db = HakariDatabase()
+
+# Sesiones en memoria
+class AlmacenSesiones:
+    """Sesiones activas con expiración por inactividad y tope LRU.
+
+    El OrderedDict se mantiene en orden de último acceso, así las sesiones
+    más viejas están siempre al principio: expirar y desalojar es O(1) por
+    sesión. Un índice email -> session_ids evita recorrer todas las sesiones
+    para saber si un email ya tiene sesión.
+    """
+
+    def __init__(self, ttl: int = SESION_TTL, maximo: int = SESIONES_MAX):
+        self.ttl = ttl
+        self.maximo = maximo
+        self._sesiones = OrderedDict()  # session_id -> (datos, ultimo_acceso)
+        self._por_email = {}  # email -> set(session_id)
+        self.expiradas = 0
+        self.desalojadas = 0
+
+    def __len__(self) -> int:
+        return len(self._sesiones)
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.obtener(session_id) is not None
+
+    def crear(self, email: str, nombre: str) -> str:
+        session_id = secrets.token_urlsafe(16)
+        self.adoptar(session_id, {
+            'email': email,
+            'nombre': nombre,
+            'inicio_sesion': datetime.now().isoformat()
+        })
+        return session_id
+
+    def adoptar(self, session_id: str, datos: Dict):
+        """Agrega una sesión (nueva o creada por otro worker) respetando el tope"""
+        ahora = time.monotonic()
+        self._purgar_expiradas(ahora)
+        self._sesiones[session_id] = (datos, ahora)
+        self._sesiones.move_to_end(session_id)
+        self._por_email.setdefault(datos['email'], set()).add(session_id)
+        while len(self._sesiones) > self.maximo:
+            viejo_id, (viejos, _) = self._sesiones.popitem(last=False)
+            self._quitar_de_indice(viejo_id, viejos['email'])
+            self.desalojadas += 1
+
+    def obtener(self, session_id: str) -> Optional[Dict]:
+        """Datos de la sesión (y renueva su TTL), o None si no existe o expiró"""
+        entrada = self._sesiones.get(session_id)
+        if entrada is None:
+            return None
+        ahora = time.monotonic()
+        if ahora - entrada[1] > self.ttl:
+            self._purgar_expiradas(ahora)
+            return None
+        self._sesiones[session_id] = (entrada[0], ahora)
+        self._sesiones.move_to_end(session_id)
+        return entrada[0]
+
+    def tiene_email(self, email: str) -> bool:
+        self._purgar_expiradas(time.monotonic())
+        return email in self._por_email
+
+    def estadisticas(self) -> Dict:
+        return {
+            'activas': len(self._sesiones),
+            'expiradas': self.expiradas,
+            'desalojadas': self.desalojadas
+        }
+
+    def _purgar_expiradas(self, ahora: float):
+        while self._sesiones:
+            session_id, (datos, ultimo_acceso) = next(iter(self._sesiones.items()))
+            if ahora - ultimo_acceso <= self.ttl:
+                break
+            del self._sesiones[session_id]
+            self._quitar_de_indice(session_id, datos['email'])
+            self.expiradas += 1
+
+    def _quitar_de_indice(self, session_id: str, email: str):
+        ids = self._por_email.get(email)
+        if ids is not None:
+            ids.discard(session_id)
+            if not ids:
+                del self._por_email[email]
+
+sesiones_activas = AlmacenSesiones()
+
+# Detector de intenciones compilado una sola vez
+class IndiceIntenciones:
+    """Encuentra todas las intenciones de un mensaje en una sola pasada.
+
+    Compila todas las palabras clave en una regex de lookahead, ordenadas de
+    más larga a más corta, así en cada posición se encuentra la palabra más
+    larga; las palabras que son prefijo de ella se agregan desde una tabla
+    precalculada. El resultado equivale a `palabra in mensaje` para cada
+    palabra, pero recorriendo el texto una sola vez.
+    """
+
+    def __init__(self, palabras_clave: Dict[str, List[str]]):
+        intenciones_de = {}
+        for intencion, palabras in palabras_clave.items():
+            for palabra in palabras:
+                intenciones_de.setdefault(palabra, set()).add(intencion)
+
+        # Para cada palabra: sus intenciones más las de sus prefijos
+        self._intenciones_por_palabra = {
+            palabra: frozenset().union(*(
+                intenciones_de[otra] for otra in intenciones_de if palabra.startswith(otra)
+            ))
+            for palabra in intenciones_de
+        }
+        ordenadas = sorted(intenciones_de, key=len, reverse=True)
+        self._patron = re.compile('(?=(' + '|'.join(map(re.escape, ordenadas)) + '))')
+
+    def detectar(self, mensaje: str) -> FrozenSet[str]:
+        """Devuelve todas las intenciones presentes en el mensaje"""
+        mensaje_lower = mensaje.lower()
+        encontradas = {m.group(1) for m in self._patron.finditer(mensaje_lower)}
+        if not encontradas:
+            return frozenset()
+        return frozenset().union(*(self._intenciones_por_palabra[p] for p in encontradas))
+
+    @staticmethod
+    def primera(intenciones: FrozenSet[str], prioridad: List[str]) -> Optional[str]:
+        """La intención de mayor prioridad presente (mismo orden que los if/elif)"""
+        for intencion in prioridad:
+            if intencion in intenciones:
+                return intencion
+        return None
+
+# Datos del calendario que solo cambian una vez por día
+class DiaHakari(NamedTuple):
+    fecha: date
+    edad: int
+    es_cumpleanos: bool
+    fase_ciclo: str
+    vence: float  # time.time() de la próxima medianoche
+
+# Catálogo de respuestas cargado desde un archivo de datos
+class CatalogoRespuestas:
+    """Plantillas de respuesta indexadas por (intención, estado, fase, relación).
+
+    Cada entrada del archivo fija una intención y, opcionalmente, `estado`,
+    `fase` y `relacion` (banda); lo que no fija vale para todos los valores.
+    Al cargar se expanden todas las combinaciones a un dict plano, así elegir
+    una respuesta es una búsqueda más un format. Si varias entradas cubren la
+    misma combinación gana la que fija más dimensiones (a igualdad, la primera).
+
+    Recargar arma un índice nuevo y lo reemplaza con una sola asignación: las
+    peticiones en curso terminan con el índice anterior. Si el archivo nuevo
+    tiene errores se conserva el anterior.
+    """
+
+    FASES = ('menstruacion', 'folicular', 'ovulacion', 'lutea')
+    CAMPOS = frozenset({'nombre', 'edad', 'gato', 'anime', 'ciudad', 'capricho', 'estado', 'fase'})
+
+    def __init__(self, ruta: str, estados: List[str]):
+        self.ruta = ruta
+        self.estados = tuple(estados)
+        self.recargas = 0
+        self._mtime = None
+        self._hash = None  # del último contenido visto, válido o no
+        self._indice, self._limites, self._bandas = self._cargar(self._leer())
+
+    def _leer(self) -> bytes:
+        self._mtime = os.stat(self.ruta).st_mtime_ns
+        with open(self.ruta, 'rb') as f:
+            contenido = f.read()
+        self._hash = hashlib.sha1(contenido).digest()
+        return contenido
+
+    def _cargar(self, contenido: bytes) -> tuple:
+        datos = json.loads(contenido.decode('utf-8'))
         
-        # Índices para mejor rendimiento
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversaciones_email ON conversaciones(usuario_email)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversaciones_fecha ON conversaciones(fecha)')
+        bandas = tuple(datos['bandas_relacion']['nombres'])
+        limites = tuple(datos['bandas_relacion']['limites'])
+        if len(bandas) != len(limites) + 1 or list(limites) != sorted(limites):
+            raise ValueError('bandas_relacion: se esperan n nombres y n-1 límites crecientes')
         
-        self.conn.commit()
+        dimensiones = (self.estados, self.FASES, bandas)
+        indice = {}
+        especificidad = {}
+        for entrada in datos['respuestas']:
+            fijas = (entrada.get('estado'), entrada.get('fase'), entrada.get('relacion'))
+            for valor, posibles in zip(fijas, dimensiones):
+                if valor is not None and valor not in posibles:
+                    raise ValueError(f"{entrada['intencion']}: valor desconocido {valor!r}")
+            plantillas = tuple(self._compilar(texto) for texto in entrada['plantillas'])
+            if not plantillas:
+                raise ValueError(f"{entrada['intencion']}: sin plantillas")
+            
+            nivel = sum(valor is not None for valor in fijas)
+            for combinacion in itertools.product(*(
+                (valor,) if valor is not None else posibles
+                for valor, posibles in zip(fijas, dimensiones)
+            )):
+                clave = (entrada['intencion'],) + combinacion
+                if especificidad.get(clave, -1) < nivel:
+                    indice[clave] = plantillas
+                    especificidad[clave] = nivel
+        
+        return indice, limites, bandas
 
-hakari_db = HakariDatabase()
-sesiones_activas = {}
+    def _compilar(self, texto: str) -> Callable[[Callable[[], Dict]], str]:
+        """Valida la plantilla una vez; las que no tienen campos son constantes
+        y ni siquiera piden los valores"""
+        campos = {campo for _, campo, _, _ in string.Formatter().parse(texto) if campo is not None}
+        desconocidos = campos - self.CAMPOS
+        if desconocidos:
+            raise ValueError(f"Campos desconocidos en {texto!r}: {', '.join(sorted(desconocidos))}")
+        if not campos:
+            return lambda valores: texto
+        return lambda valores: texto.format_map(valores())
+
+    def recargar(self) -> bool:
+        """Vuelve a leer el archivo si cambió. Devuelve True si se recargó.
+
+        Solo se registra algo cuando cambia el contenido: un archivo tocado
+        pero igual, o uno con errores que sigue igual, no vuelve a loguearse.
+        """
+        try:
+            if os.stat(self.ruta).st_mtime_ns == self._mtime:
+                return False
+            anterior = self._hash
+            contenido = self._leer()
+            if self._hash == anterior:
+                return False
+            nuevo = self._cargar(contenido)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"No se pudo recargar el catálogo de respuestas: {e}")
+            return False
+        self._indice, self._limites, self._bandas = nuevo  # se reemplaza de una vez
+        self.recargas += 1
+        logger.info(f"Catálogo de respuestas recargado ({len(nuevo[0])} combinaciones)")
+        return True
+
+    async def vigilar(self, intervalo: float):
+        """Comprueba el archivo periódicamente (la lectura corre fuera del event loop)"""
+        if intervalo <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(intervalo)
+            await loop.run_in_executor(None, self.recargar)
+
+    def banda(self, relacion: float) -> str:
+        return self._bandas[bisect.bisect_left(self._limites, relacion)]
+
+    def elegir(self, intencion: str, estado: str, fase: str, relacion: float,
+               valores: Callable[[], Dict[str, Any]]) -> Optional[str]:
+        """Una respuesta al azar para la combinación, o None si no hay"""
+        plantillas = self._indice.get((intencion, estado, fase, self.banda(relacion)))
+        if plantillas is None:
+            return None
+        return random.choice(plantillas)(valores)
+
+# Estado de Hakari con un usuario
+class EstadoHakari:
+    """Humor, capricho y ciclo de Hakari con un usuario en particular.
+
+    Usa __slots__ (sin __dict__) porque hay uno por usuario activo; los
+    textos apuntan a las cadenas compartidas de PersonalidadHakari, así cada
+    registro ocupa solo sus referencias. `version` sale de un contador
+    global que no se repite, para usarla en ETags aunque el registro se
+    desaloje y se vuelva a cargar. `revision` es la versión de la fila en
+    la BD sobre la que se hizo el registro (0 si todavía no existe).
+    """
+
+    __slots__ = ('estado', 'capricho', 'fase', 'dolor', 'version', 'revision', 'sucio', 'cargado')
+
+    _versiones = itertools.count(1)
+
+    def __init__(self, estado: str, capricho: str, fase: str, dolor: int, revision: int = 0,
+                 sucio: bool = False):
+        self.estado = estado
+        self.capricho = capricho
+        self.fase = fase
+        self.dolor = dolor
+        self.version = next(self._versiones)
+        self.revision = revision
+        self.sucio = sucio  # cambió y todavía no se guardó en la BD
+        self.cargado = time.monotonic()
+
+    def tocar(self):
+        self.version = next(self._versiones)
+        self.sucio = True
+
+    def cargar(self, estado: str, capricho: str, fase: str, dolor: int, revision: int):
+        """Toma los valores leídos de la BD (los dejó otro worker)"""
+        if (estado, capricho, fase, dolor) != self.fila():
+            self.estado, self.capricho, self.fase, self.dolor = estado, capricho, fase, dolor
+            self.version = next(self._versiones)
+        self.revision = revision
+        self.sucio = False
+        self.cargado = time.monotonic()
+
+    def copia(self) -> 'EstadoHakari':
+        """Foto del estado en este momento (no se guarda en la BD)"""
+        return EstadoHakari(self.estado, self.capricho, self.fase, self.dolor)
+
+    @property
+    def ciclo_menstrual(self) -> Dict:
+        return {'fase_actual': self.fase, 'dolor': self.dolor}
+
+    def fila(self) -> tuple:
+        return (self.estado, self.capricho, self.fase, self.dolor)
 
 # Sistema de personalidad de Hakari
 class PersonalidadHakari:
+    """Lo que Hakari es para todos: historia, estados, intenciones y catálogo.
+
+    Lo que cambia con cada conversación vive en un EstadoHakari por usuario;
+    `base` es el estado que se muestra sin sesión (no lo cambia ningún
+    mensaje).
+    """
+
+
     def __init__(self):
         self.historia = {
             'nombre': 'Hakari',
@@ -117,19 +1477,66 @@ class PersonalidadHakari:
             "nostalgica": {"emoji": "📚", "color": "#6366f1", "desc": "Recordando el pasado"}
         }
         
-        self.estado_actual = "reflexiva"
+        # Palabras clave por intención (coincidencia por subcadena, en minúsculas)
+        self.palabras_clave = {
+            'saludo': ['hola', 'hi', 'hey', 'buenas'],
+            'como_estas': ['cómo estás', 'qué tal', 'como vas'],
+            'edad': ['cuantos años', 'edad', 'años tienes'],
+            'mochi': ['mochi', 'gato'],
+            'anime': ['anime'],
+            'amor': ['te quiero', 'te amo'],
+            'feliz': ['jaja', 'lindo', 'gracias', 'divertido'],
+            'triste': ['triste', 'mal', 'llorar', 'depre'],
+            'enojada': ['molesto', 'enojado', 'odio']
+        }
+        # Orden en que se evalúan (equivale a la cadena de if/elif)
+        self.prioridad_respuesta = ['saludo', 'como_estas', 'edad', 'mochi', 'anime', 'amor']
+        self.prioridad_estado = ['feliz', 'triste', 'enojada']
+        
+        self._dia = self._calcular_dia(date.today())
+        
         self.caprichos = ["helado de matcha", "bubble tea", "leer en el parque", "ver anime"]
-        self.capricho_actual = random.choice(self.caprichos)
+        self._lista_estados = tuple(self.estados)
+        # Para que los estados leídos de la BD compartan las mismas cadenas
+        self._canonicas = {texto: texto for texto in (*self.estados, *self.caprichos, *CatalogoRespuestas.FASES)}
         
+        self.base = self.nuevo_estado()
+        self.base.sucio = False
+
+    def nuevo_estado(self) -> EstadoHakari:
+        """Estado inicial con un usuario nuevo"""
         # Sistema de ciclo menstrual simplificado
-        self.ciclo_menstrual = {
-            'fase_actual': self.calcular_fase_actual(),
-            'dolor': random.randint(0, 5)
-        }
+        return EstadoHakari("reflexiva", random.choice(self.caprichos), self.calcular_fase_actual(),
+                            random.randint(0, 5), sucio=True)
 
-    def calcular_edad(self) -> int:
-        """Calcula la edad actual de Hakari (cumpleaños: 1 de mayo)"""
-        hoy = date.today()
+    def _canonizar(self, fila: tuple) -> tuple:
+        """(estado, capricho, fase, dolor, revision) con los textos compartidos"""
+        canonica = self._canonicas.get
+        estado, capricho, fase, dolor, revision = fila
+        return canonica(estado, estado), canonica(capricho, capricho), canonica(fase, fase), dolor, revision
+
+    def estado_desde_fila(self, fila: tuple) -> EstadoHakari:
+        return EstadoHakari(*self._canonizar(fila))
+
+    def refrescar(self, estado: EstadoHakari, fila: tuple):
+        """Actualiza en el lugar un estado ya cargado con la fila de la BD"""
+        estado.cargar(*self._canonizar(fila))
+
+    # Lo pesado se arma al primer uso; el lifespan lo fuerza con preparar()
+    @cached_property
+    def intenciones(self) -> IndiceIntenciones:
+        return IndiceIntenciones(self.palabras_clave)
+
+    @cached_property
+    def catalogo(self) -> CatalogoRespuestas:
+        return CatalogoRespuestas(RESPUESTAS_PATH, list(self.estados))
+
+    def preparar(self):
+        """Compila el índice de intenciones y carga el catálogo de respuestas"""
+        self.intenciones
+        self.catalogo
+
+    def _calcular_dia(self, hoy: date) -> DiaHakari:
         cumple = self.historia['fecha_nacimiento']
         
         edad = hoy.year - cumple.year
@@ -137,156 +1544,1334 @@ class PersonalidadHakari:
         # Verificar si ya pasó el cumpleaños este año
         if (hoy.month, hoy.day) < (cumple.month, cumple.day):
             edad -= 1
-            
-        return edad
+        
+        # Fase del ciclo menstrual
+        dia_ciclo = (hoy.day - 1) % 28 + 1
+        if 1 <= dia_ciclo <= 5:
+            fase = "menstruacion"
+        elif 6 <= dia_ciclo <= 13:
+            fase = "folicular"
+        elif 14 <= dia_ciclo <= 16:
+            fase = "ovulacion"
+        else:
+            fase = "lutea"
+        
+        manana = datetime.combine(hoy + timedelta(days=1), datetime.min.time())
+        return DiaHakari(hoy, edad, hoy.month == cumple.month and hoy.day == cumple.day,
+                         fase, manana.timestamp())
+
+    def dia(self) -> DiaHakari:
+        """Calendario de hoy, recalculado solo al pasar la medianoche"""
+        dia = self._dia
+        if time.time() >= dia.vence:
+            # Se reemplaza entero: quien lo esté leyendo ve el viejo o el nuevo
+            dia = self._dia = self._calcular_dia(date.today())
+        return dia
+
+    def calcular_edad(self) -> int:
+        """Calcula la edad actual de Hakari (cumpleaños: 1 de mayo)"""
+        return self.dia().edad
 
     def es_su_cumpleanos(self) -> bool:
         """Verifica si hoy es el cumpleaños de Hakari"""
-        hoy = date.today()
-        cumple = self.historia['fecha_nacimiento']
-        return hoy.month == cumple.month and hoy.day == cumple.day
+        return self.dia().es_cumpleanos
 
     def calcular_fase_actual(self) -> str:
         """Calcula la fase actual del ciclo menstrual"""
-        hoy = date.today()
-        dia_ciclo = (hoy.day - 1) % 28 + 1
+        return self.dia().fase_ciclo
+
+    def obtener_respuesta_rapida(self, mensaje: str, usuario_data: Dict,
+                                 intenciones: Optional[FrozenSet[str]] = None,
+                                 estado: Optional[EstadoHakari] = None) -> Optional[str]:
+        """Respuestas predefinidas para ahorrar procesamiento"""
+        dia = self.dia()
+        
+        # 🎂 Respuesta especial si es su cumpleaños
+        if dia.es_cumpleanos:
+            intencion = 'cumpleanos'
+        else:
+            # Respuestas contextuales rápidas
+            if intenciones is None:
+                intenciones = self.intenciones.detectar(mensaje)
+            intencion = self.intenciones.primera(intenciones, self.prioridad_respuesta)
+            if intencion is None:
+                return None
+        return self.responder(intencion, usuario_data, dia, estado)
+
+    def responder(self, intencion: str, usuario_data: Dict, dia: Optional[DiaHakari] = None,
+                  estado: Optional[EstadoHakari] = None) -> Optional[str]:
+        """Respuesta del catálogo para la intención según el estado con el usuario"""
+        if dia is None:
+            dia = self.dia()
+        if estado is None:
+            estado = self.base
+        return self.catalogo.elegir(intencion, estado.estado, estado.fase, usuario_data.get('relacion', 50), lambda: {
+            'nombre': usuario_data.get('nombre', ''),
+            'edad': dia.edad,
+            'gato': self.historia['gato'],
+            'anime': self.historia['anime_favorito'],
+            'ciudad': self.historia['ciudad'],
+            'capricho': estado.capricho,
+            'estado': estado.estado,
+            'fase': estado.fase
+        })
+
+    def actualizar_estado_dinamico(self, estado: EstadoHakari, mensaje: str,
+                                   intenciones: Optional[FrozenSet[str]] = None) -> str:
+        """Actualiza el estado emocional con el usuario basado en el mensaje"""
+        if intenciones is None:
+            intenciones = self.intenciones.detectar(mensaje)
+        disparador = self.intenciones.primera(intenciones, self.prioridad_estado)
+        hora_actual = datetime.now().hour
+        anterior = estado.fila()
+        
+        if random.random() < 0.1:
+            estado.capricho = random.choice(self.caprichos)
+            estado.fase = self.calcular_fase_actual()
+            estado.dolor = random.randint(0, 5)
+        
+        # Lógica simple de estados
+        if disparador is not None:
+            estado.estado = disparador
+        elif hora_actual > 23 or hora_actual < 6:
+            estado.estado = "cansada"
+        elif random.random() < 0.3:
+            estado.estado = random.choice(self._lista_estados)
+        
+        if anterior != estado.fila():
+            estado.tocar()
+            
+        return estado.estado
+
+hakari = PersonalidadHakari()
+
+# Estado compartido entre workers
+def _leer_sesion(cursor: sqlite3.Cursor, session_id: str, desde: float):
+    cursor.execute('''
+        SELECT email, nombre, inicio_sesion FROM sesiones
+        WHERE session_id = ? AND ultimo_acceso >= ?
+    ''', (session_id, desde))
+    return cursor.fetchone()
+
+def _leer_email_con_sesion(cursor: sqlite3.Cursor, email: str, desde: float) -> bool:
+    cursor.execute(
+        'SELECT 1 FROM sesiones WHERE email = ? AND ultimo_acceso >= ? LIMIT 1',
+        (email, desde)
+    )
+    return cursor.fetchone() is not None
+
+def _guardar_sesion(cursor: sqlite3.Cursor, session_id: str, datos: Dict, ahora: float):
+    cursor.execute('''
+        INSERT OR REPLACE INTO sesiones (session_id, email, nombre, inicio_sesion, ultimo_acceso)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (session_id, datos['email'], datos['nombre'], datos['inicio_sesion'], ahora))
+
+def _tocar_sesion(cursor: sqlite3.Cursor, session_id: str, ahora: float):
+    cursor.execute('UPDATE sesiones SET ultimo_acceso = ? WHERE session_id = ?', (ahora, session_id))
+
+def _purgar_sesiones(cursor: sqlite3.Cursor, desde: float):
+    cursor.execute('DELETE FROM sesiones WHERE ultimo_acceso < ?', (desde,))
+
+def _leer_personalidad(cursor: sqlite3.Cursor, email: str):
+    cursor.execute('''
+        SELECT estado, capricho, fase, dolor, version FROM personalidad_usuarios WHERE email = ?
+    ''', (email,))
+    return cursor.fetchone()
+
+def _guardar_personalidades(cursor: sqlite3.Cursor, filas: List[tuple]):
+    """filas: (email, estado, capricho, fase, dolor). Write-back de un solo worker"""
+    cursor.executemany('''
+        INSERT INTO personalidad_usuarios (email, estado, capricho, fase, dolor, version)
+        VALUES (?, ?, ?, ?, ?, 1)
+        ON CONFLICT(email) DO UPDATE SET
+            estado = excluded.estado,
+            capricho = excluded.capricho,
+            fase = excluded.fase,
+            dolor = excluded.dolor,
+            version = version + 1
+    ''', filas)
+
+def _guardar_personalidad(cursor: sqlite3.Cursor, email: str, fila: tuple, revision: int):
+    """Compare-and-set: escribe solo si la fila sigue en `revision`.
+
+    Devuelve (escrita, fila vigente con su versión).
+    """
+    if revision:
+        cursor.execute('''
+            UPDATE personalidad_usuarios SET estado = ?, capricho = ?, fase = ?, dolor = ?, version = version + 1
+            WHERE email = ? AND version = ?
+        ''', (*fila, email, revision))
+    else:
+        cursor.execute('''
+            INSERT OR IGNORE INTO personalidad_usuarios (email, estado, capricho, fase, dolor, version)
+            VALUES (?, ?, ?, ?, ?, 1)
+        ''', (email, *fila))
+    escrita = cursor.rowcount > 0
+    return escrita, _leer_personalidad(cursor, email)
+
+class EstadoCompartido:
+    """Sesiones visibles para todos los workers.
+
+    Con un solo worker todo queda en memoria como siempre. En modo
+    compartido las sesiones se escriben también en la tabla `sesiones` y
+    un worker que no conoce un session_id lo busca ahí antes de rechazarlo.
+    El estado de Hakari con cada usuario lo maneja EstadosHakari.
+    """
+
+    def __init__(self, db: HakariDatabase, sesiones: AlmacenSesiones, activo: bool = ESTADO_COMPARTIDO):
+        self.db = db
+        self.sesiones = sesiones
+        self.activo = activo
+        self._ultima_purga = 0.0
+        self._persistidas = {}  # session_id -> último ultimo_acceso escrito en la BD
+
+    # --- Sesiones -------------------------------------------------------
+
+    async def crear_sesion(self, email: str, nombre: str) -> str:
+        session_id = self.sesiones.crear(email, nombre)
+        if self.activo:
+            ahora = time.time()
+            await self.db.escribir(_guardar_sesion, session_id, self.sesiones.obtener(session_id), ahora)
+            self._persistidas[session_id] = ahora
+            if ahora - self._ultima_purga > 60:
+                self._ultima_purga = ahora
+                await self.db.encolar(_purgar_sesiones, ahora - self.sesiones.ttl)
+        return session_id
+
+    async def obtener_sesion(self, session_id: str) -> Optional[Dict]:
+        datos = self.sesiones.obtener(session_id)
+        if not self.activo:
+            return datos
+
+        ahora = time.time()
+        if datos is None:
+            fila = await self.db.leer(_leer_sesion, session_id, ahora - self.sesiones.ttl)
+            if fila is None:
+                return None
+            datos = {'email': fila[0], 'nombre': fila[1], 'inicio_sesion': fila[2]}
+            self.sesiones.adoptar(session_id, datos)
+
+        # Renovar el TTL en la BD de vez en cuando, no en cada request
+        if ahora - self._persistidas.get(session_id, 0) > self.sesiones.ttl / 4:
+            self._persistidas[session_id] = ahora
+            await self.db.encolar(_tocar_sesion, session_id, ahora)
+            if len(self._persistidas) > 2 * len(self.sesiones) + 1024:
+                self._persistidas = {
+                    sid: t for sid, t in self._persistidas.items() if sid in self.sesiones
+                }
+        return datos
+
+    async def email_con_sesion(self, email: str) -> bool:
+        if self.sesiones.tiene_email(email):
+            return True
+        if not self.activo:
+            return False
+        return await self.db.leer(_leer_email_con_sesion, email, time.time() - self.sesiones.ttl)
+
+estado_compartido = EstadoCompartido(hakari_db, sesiones_activas)
+
+# Estado de Hakari por usuario
+class EstadosHakari:
+    """EstadoHakari de cada usuario, cargado de la BD al primer uso.
+
+    Un OrderedDict hace de LRU acotado a `maximo` usuarios. Con un solo
+    worker los cambios se escriben al desalojar al usuario (write-back) y
+    al apagar; en modo compartido se escriben en cada cambio con
+    compare-and-set sobre la versión de la fila y una copia local se relee
+    si tiene más de ESTADO_REFRESCO_MS, así otro worker ve el humor que
+    dejó la última conversación y ninguno pisa el cambio de otro.
+    """
+
+    def __init__(self, db: HakariDatabase, personalidad: PersonalidadHakari, maximo: int = PERSONALIDADES_MAX,
+                 compartido: bool = ESTADO_COMPARTIDO, refresco_ms: int = ESTADO_REFRESCO_MS):
+        self.db = db
+        self.personalidad = personalidad
+        self.maximo = maximo
+        self.compartido = compartido
+        self.refresco = refresco_ms / 1000
+        self.cargas = 0
+        self.desalojados = 0
+        self._registros = OrderedDict()  # email -> EstadoHakari
+        self._en_curso = {}  # email -> [asyncio.Lock, pedidos esperando] (modo compartido)
+
+    def __len__(self) -> int:
+        return len(self._registros)
+
+    async def obtener(self, email: str) -> EstadoHakari:
+        estado = self._registros.get(email)
+        if estado is not None:
+            if not self.compartido or time.monotonic() - estado.cargado < self.refresco:
+                self._registros.move_to_end(email)
+                return estado
+        
+        fila = await self.db.leer(_leer_personalidad, email)
+        self.cargas += 1
+        # Otra carga del mismo usuario pudo terminar durante el await. Todos
+        # los pedidos tienen que cambiar el mismo registro: el cambio hecho
+        # sobre una copia huérfana no se guardaría nunca
+        actual = self._registros.get(email)
+        if actual is not None:
+            if actual is estado and fila and not actual.sucio:
+                self.personalidad.refrescar(actual, fila)
+            self._registros.move_to_end(email)
+            return actual
+        
+        estado = self.personalidad.estado_desde_fila(fila) if fila else self.personalidad.nuevo_estado()
+        self._registros[email] = estado
+        self._registros.move_to_end(email)
+        
+        desalojados = []
+        while len(self._registros) > self.maximo:
+            viejo_email, viejo = self._registros.popitem(last=False)
+            self.desalojados += 1
+            if viejo.sucio and not self.compartido:
+                desalojados.append((viejo_email, *viejo.fila()))
+        if desalojados:
+            await self.db.encolar(_guardar_personalidades, desalojados)
+        return estado
+
+    async def actualizar(self, email: str, cambio: Callable[[EstadoHakari], Any]) -> Tuple[EstadoHakari, Any]:
+        """Aplica `cambio` al estado del usuario; devuelve el estado y lo que devolvió `cambio`.
+
+        Con un solo worker el cambio queda en memoria hasta el write-back.
+        En modo compartido se escribe ya, condicionado a la versión leída:
+        si otro worker escribió antes se toma su fila y se vuelve a aplicar
+        el cambio encima (hasta ESTADO_REINTENTOS veces). Dentro del worker
+        los cambios de un mismo usuario van de a uno.
+        """
+        if not self.compartido:
+            estado = await self.obtener(email)
+            return estado, cambio(estado)
+        
+        entrada = self._en_curso.get(email)
+        if entrada is None:
+            entrada = self._en_curso[email] = [asyncio.Lock(), 0]
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                return await self._actualizar_compartido(email, cambio)
+        finally:
+            entrada[1] -= 1
+            if not entrada[1]:
+                del self._en_curso[email]
+
+    async def _actualizar_compartido(self, email: str, cambio: Callable[[EstadoHakari], Any]) -> Tuple[EstadoHakari, Any]:
+        estado = await self.obtener(email)
+        resultado = cambio(estado)
+        for _ in range(ESTADO_REINTENTOS):
+            if not estado.sucio:
+                return estado, resultado
+            escrita, vigente = await self.db.escribir(_guardar_personalidad, email, estado.fila(), estado.revision)
+            if escrita:
+                self.personalidad.refrescar(estado, vigente)
+                return estado, resultado
+            if vigente is None:
+                estado.revision = 0
+                continue
+            # Ganó otro worker: su fila y, encima, este cambio
+            self.personalidad.refrescar(estado, vigente)
+            resultado = cambio(estado)
+        logger.warning(f"Estado de Hakari de {email} sin guardar tras {ESTADO_REINTENTOS} intentos")
+        return estado, resultado
+
+    async def volcar(self):
+        """Escribe todos los estados pendientes (al apagar)"""
+        if self.compartido:
+            return  # cada cambio ya se escribió en actualizar()
+        filas = [(email, *estado.fila()) for email, estado in self._registros.items() if estado.sucio]
+        if filas:
+            await self.db.escribir(_guardar_personalidades, filas)
+            for estado in self._registros.values():
+                estado.sucio = False
+        logger.info(f"Estados de Hakari guardados: {len(filas)}")
+
+    def _bytes_registro(self, email: str, estado: EstadoHakari) -> int:
+        """Clave, registro y los valores que no son compartidos"""
+        canonicas = self.personalidad._canonicas
+        tamano = sys.getsizeof(email) + sys.getsizeof(estado)
+        tamano += sys.getsizeof(estado.version) + sys.getsizeof(estado.revision)
+        tamano += sys.getsizeof(estado.cargado) + sys.getsizeof(estado.dolor)
+        for texto in (estado.estado, estado.capricho, estado.fase):
+            if canonicas.get(texto) is not texto:
+                tamano += sys.getsizeof(texto)
+        return tamano
+
+    def bytes_por_usuario(self, muestra: int = 1000) -> float:
+        """Memoria de un usuario en caché, promediada sobre una muestra.
+
+        Suma la clave, el registro con sus valores propios (los textos
+        compartidos con PersonalidadHakari no cuentan) y la parte del
+        OrderedDict que le toca: su tabla y los nodos de la lista del LRU.
+        """
+        n = len(self._registros)
+        if not n:
+            return 0.0
+        elegidos = list(itertools.islice(self._registros.items(), muestra))
+        registros = sum(self._bytes_registro(email, estado) for email, estado in elegidos) / len(elegidos)
+        return round(registros + sys.getsizeof(self._registros) / n, 1)
+
+    def estadisticas(self) -> Dict:
+        return {
+            'en_memoria': len(self._registros),
+            'maximo': self.maximo,
+            'cargas': self.cargas,
+            'desalojados': self.desalojados,
+            'bytes_por_usuario': self.bytes_por_usuario()
+        }
+
+estados_hakari = EstadosHakari(hakari_db, hakari)
+
+# Respuestas cacheadas con ETag
+class VersionesUsuario:
+    """Versión en memoria de los datos de cada usuario (estadísticas y logros).
+
+    Las versiones salen de un contador global que nunca se repite, así un
+    usuario desalojado del LRU recibe una versión nueva y ningún ETag viejo
+    vuelve a coincidir.
+    """
+
+    def __init__(self, maximo: int = CACHE_RESPUESTAS_MAX):
+        self.maximo = maximo
+        self._versiones = OrderedDict()
+        self._contador = itertools.count(1)
+
+    def version(self, email: str) -> int:
+        version = self._versiones.get(email)
+        if version is None:
+            return self.tocar(email)
+        self._versiones.move_to_end(email)
+        return version
+
+    def limpiar(self):
+        """Invalida todas las versiones (p. ej. tras una importación)"""
+        self._versiones.clear()
+
+    def tocar(self, email: str) -> int:
+        """Marca que los datos del usuario cambiaron"""
+        version = self._versiones[email] = next(self._contador)
+        self._versiones.move_to_end(email)
+        while len(self._versiones) > self.maximo:
+            self._versiones.popitem(last=False)
+        return version
+
+class CacheRespuestas:
+    """Cuerpos JSON ya serializados por clave, válidos para una versión dada.
+
+    El ETag se arma con un identificador de arranque del proceso más la
+    versión, así no hace falta hashear el cuerpo para validarlo.
+    """
+
+    def __init__(self, maximo: int = CACHE_RESPUESTAS_MAX):
+        self.maximo = maximo
+        self._entradas = OrderedDict()  # clave -> (version, etag, cuerpo)
+        self._arranque = secrets.token_hex(4)
+
+    def obtener(self, clave: str, version: tuple) -> Optional[tuple]:
+        entrada = self._entradas.get(clave)
+        if entrada is None or entrada[0] != version:
+            return None
+        self._entradas.move_to_end(clave)
+        return entrada[1], entrada[2]
+
+    def guardar(self, clave: str, version: tuple, contenido: Dict) -> tuple:
+        etag = f'W/"{self._arranque}-' + '-'.join(map(str, version)) + '"'
+        cuerpo = _serializar(contenido)
+        self._entradas[clave] = (version, etag, cuerpo)
+        self._entradas.move_to_end(clave)
+        while len(self._entradas) > self.maximo:
+            self._entradas.popitem(last=False)
+        return etag, cuerpo
+
+def _serializar(contenido: Dict) -> bytes:
+    # Mismo formato que JSONResponse
+    return json.dumps(contenido, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def _etag_coincide(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    sin_debil = etag[2:] if etag.startswith('W/') else etag
+    for candidato in if_none_match.split(','):
+        candidato = candidato.strip()
+        if (candidato[2:] if candidato.startswith('W/') else candidato) == sin_debil:
+            return True
+    return False
+
+def _respuesta_con_etag(etag: str, cuerpo: bytes, if_none_match: Optional[str]) -> Response:
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if _etag_coincide(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=cuerpo, media_type='application/json', headers=headers)
+
+versiones_usuario = VersionesUsuario()
+cache_respuestas = CacheRespuestas()
+
+# Archivos estáticos de la PWA
+class RecursoEstatico(NamedTuple):
+    tipo: str
+    hash: str
+    variantes: Dict[str, bytes]  # codificación ('identity', 'gzip', 'br') -> cuerpo
+    etags: Dict[str, str]
+
+class RecursosEstaticos:
+    """El shell de la PWA cargado y comprimido una vez, al arrancar.
+
+    Cada archivo se guarda en memoria tal cual, en gzip y (si está el
+    paquete brotli) en br, con un ETag fuerte derivado de su contenido.
+    `app.js`, `style.css` y `manifest.json` son direccionables por
+    contenido: index.html y sw.js se reescriben para pedirlos como
+    `/app.js?v=<hash>`, y esa URL se sirve como immutable. index.html y
+    sw.js se revalidan siempre (no-cache + ETag → 304). El CACHE_NAME del
+    service worker sale del hash de todo lo demás, así un deploy que
+    cambia cualquier archivo instala un service worker nuevo.
+    """
+
+    TIPOS = {
+        '.html': 'text/html; charset=utf-8',
+        '.js': 'application/javascript; charset=utf-8',
+        '.css': 'text/css; charset=utf-8',
+        '.json': 'application/manifest+json'
+    }
+    VERSIONADOS = ('app.js', 'style.css', 'manifest.json')
+    INMUTABLE = 'public, max-age=31536000, immutable'
+
+    def __init__(self, directorio: str = ESTATICOS_DIR, nombres: Iterable[str] = ARCHIVOS_ESTATICOS):
+        self.directorio = directorio
+        self.nombres = tuple(nombres)
+        self.recursos = {}  # nombre -> RecursoEstatico
+
+    def cargar(self) -> Dict[str, RecursoEstatico]:
+        contenidos = {}
+        for nombre in self.nombres:
+            ruta = os.path.join(self.directorio, nombre)
+            if os.path.isfile(ruta):
+                with open(ruta, 'rb') as f:
+                    contenidos[nombre] = f.read()
+        
+        hashes = {nombre: self._hash(contenidos[nombre]) for nombre in self.VERSIONADOS if nombre in contenidos}
+        referencia = re.compile(r'''(['"])/(%s)\1''' % '|'.join(re.escape(nombre) for nombre in hashes))
+        
+        def versionar(texto: bytes) -> bytes:
+            if not hashes:
+                return texto
+            return referencia.sub(lambda m: f'{m[1]}/{m[2]}?v={hashes[m[2]]}{m[1]}', texto.decode('utf-8')).encode('utf-8')
+        
+        if 'index.html' in contenidos:
+            contenidos['index.html'] = versionar(contenidos['index.html'])
+        if 'sw.js' in contenidos:
+            version = self._hash(b''.join(contenidos[nombre] for nombre in sorted(contenidos) if nombre != 'sw.js'))
+            contenidos['sw.js'] = re.sub(rb'''(CACHE_NAME\s*=\s*)(['"])[^'"]*\2''',
+                                         lambda m: m[1] + m[2] + b'hakari-' + version.encode() + m[2],
+                                         versionar(contenidos['sw.js']), count=1)
+        
+        recursos = {nombre: self._preparar(nombre, contenido) for nombre, contenido in contenidos.items()}
+        self.recursos = recursos
+        logger.info("Estáticos cargados: " + ', '.join(
+            f"{nombre} ({'/'.join(f'{len(v)}' for v in r.variantes.values())} B)" for nombre, r in recursos.items()))
+        return recursos
+
+    @staticmethod
+    def _hash(contenido: bytes) -> str:
+        return hashlib.sha256(contenido).hexdigest()[:16]
+
+    def _preparar(self, nombre: str, contenido: bytes) -> RecursoEstatico:
+        digesto = self._hash(contenido)
+        variantes = {'identity': contenido}
+        # Solo se guarda la versión comprimida si ahorra algo
+        comprimido = gzip.compress(contenido, compresslevel=9, mtime=0)
+        if len(comprimido) < len(contenido):
+            variantes['gzip'] = comprimido
+        if brotli is not None:
+            comprimido = brotli.compress(contenido, quality=11)
+            if len(comprimido) < len(contenido):
+                variantes['br'] = comprimido
+        etags = {codificacion: f'"{digesto}"' if codificacion == 'identity' else f'"{digesto}-{codificacion}"'
+                 for codificacion in variantes}
+        tipo = self.TIPOS.get(os.path.splitext(nombre)[1], 'application/octet-stream')
+        return RecursoEstatico(tipo, digesto, variantes, etags)
+
+    @staticmethod
+    def _codificacion(recurso: RecursoEstatico, accept_encoding: Optional[str]) -> str:
+        aceptadas = set()
+        for parte in (accept_encoding or '').split(','):
+            codificacion, _, parametros = parte.strip().partition(';')
+            if parametros.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                continue
+            aceptadas.add(codificacion.strip().lower())
+        for codificacion in ('br', 'gzip'):
+            if codificacion in recurso.variantes and (codificacion in aceptadas or '*' in aceptadas):
+                return codificacion
+        return 'identity'
+
+    def respuesta(self, nombre: str, version: Optional[str], accept_encoding: Optional[str],
+                  if_none_match: Optional[str]) -> Response:
+        recurso = self.recursos.get(nombre)
+        if recurso is None:
+            raise HTTPException(status_code=404, detail="Not Found")
+        
+        codificacion = self._codificacion(recurso, accept_encoding)
+        # Con ?v= de otro contenido (un deploy en medio) se sirve lo actual,
+        # pero sin prometer que no cambia
+        inmutable = nombre in self.VERSIONADOS and version == recurso.hash
+        headers = {
+            'ETag': recurso.etags[codificacion],
+            'Cache-Control': self.INMUTABLE if inmutable else 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+        # Cualquier codificación del mismo contenido vale para el 304
+        if any(_etag_coincide(if_none_match, etag) for etag in recurso.etags.values()):
+            return Response(status_code=304, headers=headers)
+        if codificacion != 'identity':
+            headers['Content-Encoding'] = codificacion
+        return Response(content=recurso.variantes[codificacion], media_type=recurso.tipo, headers=headers)
+
+recursos_estaticos = RecursosEstaticos()
+
+# Archivo y mantenimiento de la base de datos
+class ArchivoConversaciones:
+    """Mueve conversaciones viejas a una base SQLite por mes.
+
+    Cada archivo (archivo/conversaciones-AAAA-MM.db) tiene la misma tabla
+    `conversaciones` con su índice (usuario_email, id). La tabla
+    `archivos_conversaciones` de la BD principal guarda el rango de ids de
+    cada mes, así el historial solo abre los archivos que pueden tener la
+    página pedida. Las filas se copian primero al archivo (INSERT OR IGNORE)
+    y recién después se borran de la principal: un corte a mitad de camino
+    deja duplicados que la siguiente pasada resuelve, nunca pérdidas.
+
+    Cada worker tiene MantenimientoDB, pero solo archiva, compacta o purga
+    el que toma el turno en `archivo_control`. Cada bloque archivado sube
+    la generación de esa fila y la lista de meses en memoria se relee
+    cuando cambia, así ningún worker pierde de vista filas ya movidas.
+    """
+
+    def __init__(self, directorio: str = ARCHIVO_DIR, dias: int = ARCHIVAR_DIAS,
+                 retencion_meses: int = RETENCION_MESES):
+        self.directorio = directorio
+        self.dias = dias
+        self.retencion_meses = retencion_meses
+        self._meses = []  # (mes, ruta, id_min, id_max) ordenados por mes
+        self._generacion = None
+        self._token = secrets.token_hex(8)
+        self._con_turno = False
+
+    @property
+    def activo(self) -> bool:
+        return self.dias > 0
+
+    def ruta_mes(self, mes: str) -> str:
+        return os.path.join(self.directorio, f'conversaciones-{mes}.db')
+
+    # --- Escritura (conexión de mantenimiento en modo autocommit) -------
+
+    def tomar_turno(self, conn: sqlite3.Connection) -> bool:
+        """True si este worker puede archivar (nadie más tiene el turno vigente)"""
+        ahora = time.time()
+        self._con_turno = conn.execute('''
+            UPDATE archivo_control SET archivador = ?, vence = ?
+            WHERE id = 1 AND (archivador IS NULL OR archivador = ? OR vence < ?)
+        ''', (self._token, ahora + ARCHIVO_TURNO_S, self._token, ahora)).rowcount == 1
+        return self._con_turno
+
+    def soltar_turno(self, conn: sqlite3.Connection):
+        conn.execute('UPDATE archivo_control SET archivador = NULL, vence = NULL WHERE id = 1 AND archivador = ?',
+                     (self._token,))
+        self._con_turno = False
+
+    def archivar(self, conn: sqlite3.Connection) -> int:
+        """Archiva las conversaciones con más de `dias` días, de a bloques"""
+        os.makedirs(self.directorio, exist_ok=True)
+        movidas = 0
+        while True:
+            filas = conn.execute('''
+                SELECT id, usuario_email, mensaje_usuario, mensaje_hakari, estado_emocional, fecha
+                FROM conversaciones
+                WHERE fecha < datetime('now', ?)
+                ORDER BY fecha
+                LIMIT ?
+            ''', (f'-{self.dias} days', ARCHIVO_BLOQUE)).fetchall()
+            if not filas:
+                break
+            
+            por_mes = {}
+            for fila in filas:
+                por_mes.setdefault(fila[5][:7], []).append(fila)
+            
+            for mes, filas_mes in por_mes.items():
+                ruta = self.ruta_mes(mes)
+                copiadas = self._copiar(ruta, filas_mes)
+                ids = [fila[0] for fila in filas_mes]
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.executemany('DELETE FROM conversaciones WHERE id = ?', [(i,) for i in ids])
+                    conn.execute('''
+                        INSERT INTO archivos_conversaciones (mes, ruta, id_min, id_max, filas)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(mes) DO UPDATE SET
+                            id_min = MIN(id_min, excluded.id_min),
+                            id_max = MAX(id_max, excluded.id_max),
+                            filas = filas + excluded.filas,
+                            compactado = 0
+                    ''', (mes, ruta, min(ids), max(ids), copiadas))
+                    self._nueva_generacion(conn)
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+                movidas += len(ids)
+            # Un archivado largo no debe perder el turno (ni seguir si lo perdió)
+            if self._con_turno and not self.tomar_turno(conn):
+                logger.warning("Turno de archivado perdido: otro worker sigue")
+                break
+        
+        return movidas
+
+    @staticmethod
+    def _nueva_generacion(conn: sqlite3.Connection):
+        conn.execute('UPDATE archivo_control SET generacion = generacion + 1 WHERE id = 1')
+
+    def _copiar(self, ruta: str, filas: List[tuple]) -> int:
+        """Copia las filas al archivo; devuelve las que no estaban (un corte previo deja repetidas)"""
+        destino = sqlite3.connect(ruta)
+        try:
+            destino.execute('''
+                CREATE TABLE IF NOT EXISTS conversaciones (
+                    id INTEGER PRIMARY KEY,
+                    usuario_email TEXT,
+                    mensaje_usuario TEXT,
+                    mensaje_hakari TEXT,
+                    estado_emocional TEXT,
+                    fecha DATETIME
+                )
+            ''')
+            destino.execute('CREATE INDEX IF NOT EXISTS idx_conversaciones_email_id ON conversaciones(usuario_email, id)')
+            copiadas = destino.executemany('INSERT OR IGNORE INTO conversaciones VALUES (?, ?, ?, ?, ?, ?)',
+                                           filas).rowcount
+            destino.commit()
+            return copiadas
+        finally:
+            destino.close()
+
+    def compactar(self, conn: sqlite3.Connection) -> int:
+        """VACUUM de los meses ya cerrados (no van a recibir más filas)"""
+        mes_corte = conn.execute("SELECT strftime('%Y-%m', 'now', ?)", (f'-{self.dias} days',)).fetchone()[0]
+        pendientes = conn.execute(
+            'SELECT mes, ruta FROM archivos_conversaciones WHERE compactado = 0 AND mes < ?', (mes_corte,)
+        ).fetchall()
+        for mes, ruta in pendientes:
+            archivo = sqlite3.connect(ruta)
+            try:
+                archivo.execute('VACUUM')
+            finally:
+                archivo.close()
+            conn.execute('UPDATE archivos_conversaciones SET compactado = 1 WHERE mes = ?', (mes,))
+        return len(pendientes)
+
+    def purgar(self, conn: sqlite3.Connection) -> int:
+        """Borra los archivos más viejos que la retención configurada"""
+        mes_limite = conn.execute("SELECT strftime('%Y-%m', 'now', ?)",
+                                  (f'-{self.retencion_meses} months',)).fetchone()[0]
+        viejos = conn.execute('SELECT mes, ruta FROM archivos_conversaciones WHERE mes < ?',
+                              (mes_limite,)).fetchall()
+        for mes, ruta in viejos:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM archivos_conversaciones WHERE mes = ?', (mes,))
+            self._nueva_generacion(conn)
+            conn.execute('COMMIT')
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+        return len(viejos)
+
+    # --- Lectura (pool de lectores) -------------------------------------
+
+    def meses(self, cursor) -> List[tuple]:
+        # Se relee solo si cambió la generación (este u otro worker archivó o purgó)
+        cursor.execute('SELECT generacion FROM archivo_control WHERE id = 1')
+        generacion = cursor.fetchone()[0]
+        if generacion != self._generacion:
+            cursor.execute('SELECT mes, ruta, id_min, id_max FROM archivos_conversaciones ORDER BY mes')
+            self._meses = cursor.fetchall()
+            self._generacion = generacion
+        return self._meses
+
+    def _consultar(self, ruta: str, email: str, limite: int,
+                   before_id: Optional[int], after_id: Optional[int]) -> List[tuple]:
+        try:
+            conn = sqlite3.connect(f'file:{ruta}?mode=ro', uri=True)
+        except sqlite3.Error as e:
+            logger.warning(f"Archivo no disponible {ruta}: {e}")
+            return []
+        try:
+            return _consultar_historial(conn.cursor(), email, limite, before_id, after_id)
+        finally:
+            conn.close()
+
+    def leer_historial(self, cursor, email: str, limite: int,
+                       before_id: Optional[int], after_id: Optional[int]) -> List[tuple]:
+        """Página del historial mezclando la tabla principal y los archivos.
+
+        Los rangos de ids de los meses pueden solaparse (el ON CONFLICT de
+        `archivar` ensancha el rango de un mes que recibe filas tarde), así
+        que se consultan todos los que cortan la ventana y se mezclan por id.
+        Se recorren en orden y se corta cuando ninguno de los que quedan
+        puede entrar en la página.
+        """
+        ascendente = after_id is not None
+        # Lista de meses y tabla principal en la misma instantánea: las filas
+        # se copian al archivo antes de borrarse, así no quedan en ningún hueco
+        cursor.execute('BEGIN')
+        try:
+            meses = self.meses(cursor)
+            filas = {fila[0]: fila for fila in _consultar_historial(cursor, email, limite, before_id, after_id)}
+        finally:
+            cursor.execute('COMMIT')
+        if ascendente:
+            meses = sorted(meses, key=lambda mes: mes[2])
+        else:
+            meses = sorted(meses, key=lambda mes: mes[3], reverse=True)
+        
+        for _, ruta, id_min, id_max in meses:
+            if (after_id is not None and id_max <= after_id) or (before_id is not None and id_min >= before_id):
+                continue
+            if len(filas) >= limite:
+                ids = sorted(filas)
+                if (id_min > ids[limite - 1]) if ascendente else (id_max < ids[-limite]):
+                    break
+            # Un archivado interrumpido deja la fila también en la principal: el id la deduplica
+            for fila in self._consultar(ruta, email, limite, before_id, after_id):
+                filas[fila[0]] = fila
+        
+        ids = sorted(filas)
+        return [filas[i] for i in (ids[:limite] if ascendente else ids[-limite:])]
+
+class MantenimientoDB:
+    """Tareas periódicas sobre hakari.db en momentos de poco tráfico.
+
+    Cada MANTENIMIENTO_S segundos, y solo si no hubo mensajes en los
+    últimos MANTENIMIENTO_INACTIVIDAD_S segundos ni hay escrituras en cola
+    (o si ya se atrasó cuatro intervalos), archiva, aplica la retención,
+    hace vacuum incremental y un wal_checkpoint(TRUNCATE). Usa su propia
+    conexión en un hilo aparte, con transacciones cortas. El archivo y la
+    retención los corre un solo worker a la vez (el que toma el turno).
+    """
+
+    def __init__(self, db: HakariDatabase, archivo: ArchivoConversaciones,
+                 intervalo: int = MANTENIMIENTO_S, inactividad: float = MANTENIMIENTO_INACTIVIDAD_S):
+        self.db = db
+        self.archivo = archivo
+        self.intervalo = intervalo
+        self.inactividad = inactividad
+        self.ultima_actividad = time.monotonic()
+        self.ultima_ejecucion = time.monotonic()
+        self.ultimo_reporte = {}
+
+    def registrar_actividad(self):
+        self.ultima_actividad = time.monotonic()
+
+    def ejecutar(self) -> Dict:
+        conn = self.db._conectar()
+        conn.isolation_level = None  # transacciones explícitas
+        try:
+            reporte = {'fecha': datetime.now().isoformat(timespec='seconds')}
+            if self.archivo.activo or self.archivo.retencion_meses > 0:
+                if self.archivo.tomar_turno(conn):
+                    try:
+                        if self.archivo.activo:
+                            reporte['archivadas'] = self.archivo.archivar(conn)
+                            reporte['archivos_compactados'] = self.archivo.compactar(conn)
+                        if self.archivo.retencion_meses > 0:
+                            reporte['archivos_borrados'] = self.archivo.purgar(conn)
+                    finally:
+                        self.archivo.soltar_turno(conn)
+                else:
+                    reporte['archivo'] = 'lo está corriendo otro worker'
+            reporte['paginas_liberadas'] = self._vacuum_incremental(conn)
+            bloqueado, paginas_wal, copiadas = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+            reporte['checkpoint'] = {'bloqueado': bool(bloqueado), 'paginas_wal': paginas_wal,
+                                     'paginas_copiadas': copiadas}
+        finally:
+            conn.close()
+        self.ultimo_reporte = reporte
+        logger.info(f"Mantenimiento de BD: {reporte}")
+        return reporte
+
+    def _vacuum_incremental(self, conn: sqlite3.Connection) -> int:
+        libres = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # BD creada sin auto_vacuum: se convierte una sola vez con VACUUM,
+            # solo si vale la pena (más de 10% de páginas libres)
+            paginas = conn.execute('PRAGMA page_count').fetchone()[0]
+            if libres > 100 and libres > paginas // 10:
+                conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                conn.execute('VACUUM')
+                return libres
+            return 0
+        if libres:
+            # executescript corre el pragma hasta el final (execute libera una sola página)
+            conn.executescript(f'PRAGMA incremental_vacuum({int(libres)});')
+        return libres
+
+    async def bucle(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(max(1.0, self.inactividad))
+            ahora = time.monotonic()
+            transcurrido = ahora - self.ultima_ejecucion
+            if transcurrido < self.intervalo:
+                continue
+            tranquilo = (ahora - self.ultima_actividad >= self.inactividad
+                         and self.db.profundidad_cola() == 0)
+            if not tranquilo and transcurrido < 4 * self.intervalo:
+                continue
+            self.ultima_ejecucion = ahora
+            try:
+                await loop.run_in_executor(None, self.ejecutar)
+            except Exception as e:
+                logger.error(f"Error en mantenimiento de BD: {e}")
+
+archivo_conversaciones = ArchivoConversaciones()
+mantenimiento_db = MantenimientoDB(hakari_db, archivo_conversaciones)
+
+# Exportación e importación masiva
+class TransferenciaDatos:
+    """Exporta e importa usuarios, conversaciones y logros como NDJSON.
+
+    La primera línea es una cabecera con las columnas de cada tabla y cada
+    línea siguiente es {"tabla": ..., "fila": [...]}. La exportación lee una
+    instantánea consistente (una transacción de lectura en WAL, sin frenar
+    al escritor) de a bloques por rowid, incluidas las conversaciones
+    archivadas. La importación inserta con executemany sobre su propia
+    conexión, en transacciones de unos TRANSFERENCIA_MS_POR_TRANSACCION ms,
+    y suma los resúmenes de actividad de cada lote en la misma transacción;
+    opcionalmente borra los índices de conversaciones y los reconstruye al
+    final. Las conversaciones viajan
+    con su id y se saltean las que ya están (en la tabla principal o en el
+    archivo), así importar dos veces el mismo export no duplica filas.
+    """
+
+    FORMATO = 'hakari-export'
+    COLUMNAS = {
+        'usuarios': ['email', 'nombre', 'confianza', 'interacciones', 'energia', 'relacion',
+                     'ultima_visita', 'fecha_registro'],
+        'conversaciones': ['id', 'usuario_email', 'mensaje_usuario', 'mensaje_hakari', 'estado_emocional', 'fecha'],
+        'logros': ['usuario_email', 'logro_id', 'nombre', 'descripcion', 'fecha_desbloqueo']
+    }
+    INDICES_DIFERIBLES = {
+        'idx_conversaciones_email_id': 'CREATE INDEX IF NOT EXISTS idx_conversaciones_email_id ON conversaciones(usuario_email, id)',
+        'idx_conversaciones_fecha': 'CREATE INDEX IF NOT EXISTS idx_conversaciones_fecha ON conversaciones(fecha)'
+    }
+
+    def __init__(self, db: HakariDatabase, archivo: ArchivoConversaciones):
+        self.db = db
+        self.archivo = archivo
+
+    # --- Exportación ----------------------------------------------------
+
+    def exportar(self, tablas: List[str], incluir_archivo: bool = True) -> Iterator[str]:
+        """Genera bloques de texto NDJSON; la memoria no depende del tamaño de la BD"""
+        desconocidas = set(tablas) - set(self.COLUMNAS)
+        if desconocidas:
+            raise ValueError(f"Tablas desconocidas: {', '.join(sorted(desconocidas))}")
+
+        conn = self.db._conectar(solo_lectura=True)
+        conn.isolation_level = None
+        try:
+            conn.execute('BEGIN')  # misma instantánea para todas las tablas
+            yield json.dumps({
+                'formato': self.FORMATO,
+                'version': 1,
+                'fecha': datetime.now().isoformat(timespec='seconds'),
+                'tablas': {tabla: self.COLUMNAS[tabla] for tabla in tablas}
+            }, ensure_ascii=False) + '\n'
+
+            for tabla in tablas:
+                if tabla == 'conversaciones' and incluir_archivo:
+                    meses = conn.execute('SELECT ruta FROM archivos_conversaciones ORDER BY mes').fetchall()
+                    for (ruta,) in meses:
+                        if not os.path.exists(ruta):
+                            continue
+                        archivado = sqlite3.connect(f'file:{ruta}?mode=ro', uri=True, check_same_thread=False)
+                        try:
+                            yield from self._exportar_tabla(archivado, tabla)
+                        finally:
+                            archivado.close()
+                yield from self._exportar_tabla(conn, tabla)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def _exportar_tabla(self, conn: sqlite3.Connection, tabla: str) -> Iterator[str]:
+        columnas = ', '.join(self.COLUMNAS[tabla])
+        ultimo = 0
+        while True:
+            filas = conn.execute(
+                f'SELECT rowid, {columnas} FROM {tabla} WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                (ultimo, TRANSFERENCIA_BLOQUE)
+            ).fetchall()
+            if not filas:
+                return
+            ultimo = filas[-1][0]
+            yield ''.join(
+                json.dumps({'tabla': tabla, 'fila': list(fila[1:])}, ensure_ascii=False) + '\n'
+                for fila in filas
+            )
+
+    # --- Importación ----------------------------------------------------
+
+    def importar(self, lineas: Iterable[str], reemplazar: bool = False,
+                 diferir_indices: bool = False) -> Dict[str, int]:
+        """Carga un export. Devuelve las filas insertadas por tabla.
+
+        `reemplazar` pisa usuarios existentes (si no, se conservan).
+        `diferir_indices` conviene solo con la API detenida: sin índices
+        las consultas por usuario recorren toda la tabla.
+        """
+        sentencias = {
+            'usuarios': f"INSERT OR {'REPLACE' if reemplazar else 'IGNORE'} INTO usuarios",
+            'conversaciones': 'INSERT OR IGNORE INTO conversaciones',
+            'logros': 'INSERT OR IGNORE INTO logros'
+        }
+        iterador = iter(lineas)
+        cabecera = json.loads(next(iterador, '{}') or '{}')
+        if cabecera.get('formato') != self.FORMATO:
+            raise ValueError('El archivo no es una exportación de Hakari')
+
+        sql = {}
+        for tabla, columnas in cabecera['tablas'].items():
+            if tabla not in sentencias or set(columnas) - set(self.COLUMNAS[tabla]):
+                raise ValueError(f'Tabla o columnas no soportadas: {tabla}')
+            sql[tabla] = (f"{sentencias[tabla]} ({', '.join(columnas)}) "
+                          f"VALUES ({', '.join('?' * len(columnas))})")
+
+        # Exports viejos sin ids: las conversaciones se insertan siempre
+        columnas_conversaciones = cabecera['tablas'].get('conversaciones', [])
+        if columnas_conversaciones:
+            try:
+                i_fecha, i_email, i_estado = (columnas_conversaciones.index(columna) for columna in
+                                              ('fecha', 'usuario_email', 'estado_emocional'))
+            except ValueError:
+                raise ValueError('Faltan columnas de conversaciones: fecha, usuario_email, estado_emocional')
+
+        conn = self.db._conectar()
+        conn.isolation_level = None
+        contadores = {tabla: 0 for tabla in sql}
+        meses = conn.execute('SELECT ruta, id_min, id_max FROM archivos_conversaciones').fetchall()
+        
+        def insertar(tabla: str, lote: List[list]):
+            if tabla == 'conversaciones' and 'id' in columnas_conversaciones:
+                lote = self._nuevas(conn, meses, lote, columnas_conversaciones)
+            contadores[tabla] += conn.executemany(sql[tabla], lote).rowcount
+            if tabla == 'conversaciones':
+                # Lo importado no pasa por el camino de escritura del chat
+                resumenes_actividad.registrar_conversaciones(
+                    conn.cursor(), [(fila[i_fecha], fila[i_email], fila[i_estado]) for fila in lote])
+        try:
+            if diferir_indices:
+                for indice in self.INDICES_DIFERIBLES:
+                    conn.execute(f'DROP INDEX IF EXISTS {indice}')
+
+            pendientes = {tabla: [] for tabla in sql}
+            conn.execute('BEGIN IMMEDIATE')
+            inicio = time.monotonic()
+            for linea in iterador:
+                if not linea.strip():
+                    continue
+                registro = json.loads(linea)
+                tabla = registro.get('tabla') if isinstance(registro, dict) else None
+                if tabla not in pendientes:
+                    raise ValueError(f'Tabla no declarada en la cabecera: {tabla}')
+                fila = registro.get('fila')
+                if not isinstance(fila, list) or len(fila) != len(cabecera['tablas'][tabla]):
+                    raise ValueError(f'Fila mal formada en {tabla}')
+                lote = pendientes[tabla]
+                lote.append(fila)
+                if len(lote) >= TRANSFERENCIA_FILAS_POR_INSERCION:
+                    insertar(tabla, lote)
+                    lote.clear()
+                    # Transacciones cortas y una pausa entre ellas: el escritor
+                    # de la API intercala las suyas sin agotar su busy_timeout
+                    if (time.monotonic() - inicio) * 1000 >= TRANSFERENCIA_MS_POR_TRANSACCION:
+                        conn.execute('COMMIT')
+                        if not diferir_indices:
+                            time.sleep(TRANSFERENCIA_PAUSA_S)
+                        conn.execute('BEGIN IMMEDIATE')
+                        inicio = time.monotonic()
+            for tabla, lote in pendientes.items():
+                if lote:
+                    insertar(tabla, lote)
+            conn.execute('COMMIT')
+            
+            # Usuarios y logros son pocas filas: se recuentan enteros
+            if 'usuarios' in sql or 'logros' in sql:
+                conn.execute('BEGIN IMMEDIATE')
+                if 'usuarios' in sql:
+                    resumenes_actividad.recontar_registros(conn.cursor())
+                if 'logros' in sql:
+                    resumenes_actividad.recontar_logros(conn.cursor())
+                conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            if diferir_indices:
+                for ddl in self.INDICES_DIFERIBLES.values():
+                    conn.execute(ddl)
+            conn.close()
+
+        logger.info(f"Importación completada: {contadores}")
+        return contadores
+
+    @staticmethod
+    def limpiar_caches():
+        """Lo cacheado en memoria puede no coincidir con lo importado.
+
+        Esos cachés son del event loop: se llama desde él, no desde el hilo
+        que corre `importar`.
+        """
+        sistema_logros.limpiar()
+        versiones_usuario.limpiar()
+        memoria_conversaciones.limpiar()
+
+    @staticmethod
+    def _presentes(conn: sqlite3.Connection, columnas: List[str], ids: List[int]) -> Dict[int, tuple]:
+        """Las filas (con las columnas del export) que ya ocupan esos ids"""
+        presentes = {}
+        for i in range(0, len(ids), 500):
+            parte = ids[i:i + 500]
+            for fila in conn.execute(f"SELECT {', '.join(columnas)} FROM conversaciones "
+                                     f"WHERE id IN ({', '.join('?' * len(parte))})", parte):
+                presentes[fila[columnas.index('id')]] = fila
+        return presentes
+
+    def _nuevas(self, conn: sqlite3.Connection, meses: List[tuple], filas: List[list],
+                columnas: List[str]) -> List[list]:
+        """Descarta las conversaciones que ya están en la BD o en un archivo mensual.
+
+        Si el id lo ocupa otra conversación (la API siguió escribiendo
+        mientras tanto) la importada entra con un id nuevo, salvo que ya
+        se haya importado así antes.
+        """
+        posicion_id = columnas.index('id')
+        por_id = {fila[posicion_id]: fila for fila in filas}
+        presentes = self._presentes(conn, columnas, list(por_id))
+        for ruta, id_min, id_max in meses:
+            candidatos = [i for i in por_id if id_min <= i <= id_max and i not in presentes]
+            if not candidatos or not os.path.exists(ruta):
+                continue
+            archivado = sqlite3.connect(f'file:{ruta}?mode=ro', uri=True)
+            try:
+                presentes.update(self._presentes(archivado, columnas, candidatos))
+            finally:
+                archivado.close()
+        
+        nuevas, movidas = [], []
+        for i, fila in por_id.items():
+            if i not in presentes:
+                nuevas.append(fila)
+            elif presentes[i] != tuple(fila) and not self._repetida(conn, columnas, fila):
+                movidas.append([None if c == 'id' else valor for c, valor in zip(columnas, fila)])
+        # Las de id nuevo van al final: toman max(id) + 1 y podrían pisar uno del lote
+        return nuevas + movidas
+
+    @staticmethod
+    def _repetida(conn: sqlite3.Connection, columnas: List[str], fila: list) -> bool:
+        """Si la conversación ya está con otro id (usa el índice por usuario)"""
+        condiciones = [(c, valor) for c, valor in zip(columnas, fila) if c != 'id']
+        return conn.execute(
+            f"SELECT 1 FROM conversaciones WHERE {' AND '.join(f'{c} IS ?' for c, _ in condiciones)} LIMIT 1",
+            [valor for _, valor in condiciones]
+        ).fetchone() is not None
+
+transferencia_datos = TransferenciaDatos(hakari_db, archivo_conversaciones)
+
+# Generadores de respuestas en línea
+class GeneradorRespuestas(ABC):
+    """Backend que genera una respuesta para un mensaje (un modelo remoto).
+
+    `generar` es async y no debe bloquear el loop; ChatEngine se encarga de
+    limitar la concurrencia, cortar por timeout y cachear. Para enchufar un
+    modelo real basta con una subclase registrada en GENERADORES.
+    """
+
+    nombre = 'base'
+
+    @abstractmethod
+    async def generar(self, mensaje: str, contexto: Dict) -> str:
+        ...
+
+class GeneradorSimulado(GeneradorRespuestas):
+    """Stub local con latencia configurable, para pruebas y benchmarks sin red"""
+
+    nombre = 'simulado'
+
+    def __init__(self, latencia_ms: int = GENERADOR_LATENCIA_MS):
+        self.latencia = latencia_ms / 1000
+        self.llamadas = 0
+
+    async def generar(self, mensaje: str, contexto: Dict) -> str:
+        self.llamadas += 1
+        await asyncio.sleep(self.latencia)
+        return f"Mmm... \"{mensaje[:40]}\"... hoy estoy {contexto['estado']}, dejame pensarlo 💭"
+
+GENERADORES = {'simulado': GeneradorSimulado}
+
+def _crear_generador(nombre: str) -> Optional[GeneradorRespuestas]:
+    if not nombre:
+        return None
+    if nombre not in GENERADORES:
+        logger.warning(f"Generador desconocido '{nombre}', se usa solo el motor offline")
+        return None
+    return GENERADORES[nombre]()
+
+# Motor de conversación
+class ChatEngine:
+    """Responde con el catálogo y, si hay un generador, con él para lo demás.
+
+    Las llamadas al generador pasan por un semáforo (a lo sumo `concurrencia`
+    a la vez) y tienen un timeout que incluye la espera del semáforo; si se
+    vence o falla se responde con el motor offline. Mensajes iguales en
+    curso comparten una sola llamada, y las respuestas se cachean en un LRU
+    con TTL por (mensaje normalizado, estado emocional, fase del ciclo). El
+    generador recibe además los últimos turnos del usuario; cuando los hay,
+    la clave suma el email y un hash de esos turnos, así una respuesta que
+    depende de la historia de un usuario nunca se comparte con otro.
+    """
+
+    TURNOS_CONTEXTO = 6
+
+    def __init__(self, generador: Optional[GeneradorRespuestas] = None,
+                 concurrencia: int = GENERADOR_CONCURRENCIA, timeout_ms: int = GENERADOR_TIMEOUT_MS,
+                 cache_max: int = GENERADOR_CACHE_MAX, cache_ttl_s: float = GENERADOR_CACHE_TTL_S):
+        self.generador = generador
+        self.concurrencia = concurrencia
+        self.timeout = timeout_ms / 1000
+        self.cache_max = cache_max
+        self.cache_ttl = cache_ttl_s
+        self._semaforo = None  # se crea dentro del loop
+        self._cache = OrderedDict()  # clave -> (vence, respuesta)
+        self._en_curso = {}  # clave -> asyncio.Task
+        self.contadores = dict.fromkeys(('llamadas', 'aciertos_cache', 'compartidas', 'timeouts', 'errores'), 0)
+
+    @staticmethod
+    def _clave(mensaje: str, estado: EstadoHakari, email: Optional[str], recientes: List[tuple]) -> tuple:
+        clave = (' '.join(mensaje.lower().split()), estado.estado, estado.fase)
+        if recientes:
+            clave += (email, hash(tuple(recientes)))
+        return clave
+
+    async def generar_respuesta(self, mensaje: str, usuario_data: Dict,
+                                intenciones: Optional[FrozenSet[str]] = None,
+                                estado: Optional[EstadoHakari] = None) -> str:
+        """Respuesta del catálogo si la hay; si no, del generador o del motor offline"""
+        if self.generador is None:
+            return self.generar_respuesta_oflline(mensaje, usuario_data, intenciones, estado)
+        if estado is None:
+            estado = hakari.base
+        respuesta = hakari.obtener_respuesta_rapida(mensaje, usuario_data, intenciones, estado)
+        if respuesta:
+            return respuesta
         
-        if 1 <= dia_ciclo <= 5:
-            return "menstruacion"
-        elif 6 <= dia_ciclo <= 13:
-            return "folicular"
-        elif 14 <= dia_ciclo <= 16:
-            return "ovulacion"
+        recientes = []
+        email = usuario_data.get('email')
+        if email and await memoria_conversaciones.obtener(email) is not None:
+            recientes = [(turno.mensaje_usuario, turno.mensaje_hakari)
+                         for turno in memoria_conversaciones.recientes(email, self.TURNOS_CONTEXTO)]
+        
+        clave = self._clave(mensaje, estado, email, recientes)
+        entrada = self._cache.get(clave)
+        if entrada is not None:
+            if entrada[0] > time.monotonic():
+                self._cache.move_to_end(clave)
+                self.contadores['aciertos_cache'] += 1
+                return entrada[1]
+            del self._cache[clave]
+        
+        tarea = self._en_curso.get(clave)
+        if tarea is None:
+            tarea = asyncio.create_task(self._consultar(clave, mensaje, {
+                'estado': estado.estado,
+                'fase': estado.fase,
+                'capricho': estado.capricho,
+                'recientes': recientes
+            }))
+            self._en_curso[clave] = tarea
+            tarea.add_done_callback(lambda _: self._en_curso.pop(clave, None))
         else:
-            return "lutea"
-
-    def obtener_respuesta_rapida(self, mensaje: str, usuario_data: Dict) -> Optional[str]:
-        """Respuestas predefinidas para ahorrar procesamiento"""
-        mensaje_lower = mensaje.lower()
-        nombre = usuario_data.get('nombre', '')
-        edad = self.calcular_edad()
+            self.contadores['compartidas'] += 1
         
-        # 🎂 Respuesta especial si es su cumpleaños
-        if self.es_su_cumpleanos():
-            return random.choice([
-                f"¡Hoy es mi cumpleaños! 🎂 Tengo {edad} años... ¿me felicitas?",
-                f"Es mi día especial... cumplo {edad} años hoy 💫",
-                f"{edad} años hoy... me siento mayor 🎁"
-            ])
-        
-        # Respuestas contextuales rápidas
-        if any(palabra in mensaje_lower for palabra in ['hola', 'hi', 'hey', 'buenas']):
-            return random.choice([
-                f"Hola {nombre}... ¿qué tal? 💫",
-                f"Hey {nombre}, vos de nuevo ✨", 
-                f"Hola... espero que estés bien 🌙"
-            ])
-            
-        if any(palabra in mensaje_lower for palabra in ['cómo estás', 'qué tal', 'como vas']):
-            if self.ciclo_menstrual['fase_actual'] == "menstruacion":
-                return random.choice([
-                    "Con la regla... no preguntes 😫",
-                    "Mal... cólicos terribles",
-                    "Sobreviviendo a mis días 🩸"
-                ])
-            else:
-                return random.choice([
-                    "Bien... supongo",
-                    "Más o menos, la verdad", 
-                    "Estoy... no sé, rara"
-                ])
-                
-        if any(palabra in mensaje_lower for palabra in ['cuantos años', 'edad', 'años tienes']):
-            return f"Tengo {edad} años... ¿por qué? 👀"
-            
-        if 'mochi' in mensaje_lower or 'gato' in mensaje_lower:
-            return random.choice([
-                "Mi gato Mochi es un traidor... hoy rompió mi libro favorito 😾",
-                "Mochi está durmiendo... como siempre",
-                "Los gatos son mejores que las personas, creo"
-            ])
-            
-        if 'anime' in mensaje_lower:
-            return random.choice([
-                "¡Me encanta el anime! Evangelion es mi favorito 📺",
-                "El anime tiene historias tan emocionantes ✨",
-                "¡Tema interesante! Hay mucho que explorar ahí 💫"
-            ])
-            
-        if any(palabra in mensaje_lower for palabra in ['te quiero', 'te amo']):
-            relacion = usuario_data.get('relacion', 50)
-            if relacion > 60:
-                return random.choice([
-                    "Ay... no sé qué decir 😳",
-                    "Eso es... lindo. Gracias 💫",
-                    "Me haces sonrojar..."
-                ])
-            else:
-                return "No digas eso tan pronto..."
-                
-        return None
+        # shield: si este cliente se va, los demás que esperan la misma
+        # respuesta no pierden la llamada
+        respuesta = await asyncio.shield(tarea)
+        return respuesta or self.generar_respuesta_oflline(mensaje, usuario_data, intenciones, estado)
 
-    def actualizar_estado_dinamico(self, mensaje: str) -> str:
-        """Actualiza el estado emocional basado en el mensaje"""
-        mensaje_lower = mensaje.lower()
-        hora_actual = datetime.now().hour
-        
-        if random.random() < 0.1:
-            self.capricho_actual = random.choice(self.caprichos)
-            self.ciclo_menstrual['fase_actual'] = self.calcular_fase_actual()
-            self.ciclo_menstrual['dolor'] = random.randint(0, 5)
+    async def _consultar(self, clave: tuple, mensaje: str, contexto: Dict) -> Optional[str]:
+        if self._semaforo is None:
+            self._semaforo = asyncio.Semaphore(self.concurrencia)
+        try:
+            respuesta = await asyncio.wait_for(self._con_semaforo(mensaje, contexto), self.timeout)
+        except asyncio.TimeoutError:
+            self.contadores['timeouts'] += 1
+            return None
+        except Exception as e:
+            self.contadores['errores'] += 1
+            logger.warning(f"Generador {self.generador.nombre} falló: {e}")
+            return None
         
-        # Lógica simple de estados
-        if any(palabra in mensaje_lower for palabra in ['jaja', 'lindo', 'gracias', 'divertido']):
-            self.estado_actual = "feliz"
-        elif any(palabra in mensaje_lower for palabra in ['triste', 'mal', 'llorar', 'depre']):
-            self.estado_actual = "triste"
-        elif any(palabra in mensaje_lower for palabra in ['molesto', 'enojado', 'odio']):
-            self.estado_actual = "enojada"
-        elif hora_actual > 23 or hora_actual < 6:
-            self.estado_actual = "cansada"
-        elif random.random() < 0.3:
-            self.estado_actual = random.choice(list(self.estados.keys()))
-            
-        return self.estado_actual
+        if respuesta and self.cache_max > 0:
+            self._cache[clave] = (time.monotonic() + self.cache_ttl, respuesta)
+            self._cache.move_to_end(clave)
+            while len(self._cache) > self.cache_max:
+                self._cache.popitem(last=False)
+        return respuesta
 
-hakari = PersonalidadHakari()
+    async def _con_semaforo(self, mensaje: str, contexto: Dict) -> str:
+        async with self._semaforo:
+            self.contadores['llamadas'] += 1
+            return await self.generador.generar(mensaje, contexto)
 
-# Motor de conversación
-class ChatEngine:
-    def __init__(self):
-        self.respuestas_fallback = [
-            "Interesante... ¿puedes contarme más?",
-            "No estoy segura de entender completamente",
-            "Eso suena fascinante, ¿cómo te sientes?",
-            "Sigo aprendiendo, gracias por tu paciencia",
-            "Podrías explicar eso de otra manera",
-            "No tengo una respuesta clara para eso"
-        ]
-    
-    def generar_respuesta_oflline(self, mensaje: str, usuario_data: Dict) -> str:
+    def estadisticas(self) -> Dict:
+        return {
+            'generador': self.generador.nombre if self.generador else None,
+            'en_curso': len(self._en_curso),
+            'en_cache': len(self._cache),
+            **self.contadores
+        }
+
+    def generar_respuesta_oflline(self, mensaje: str, usuario_data: Dict,
+                                  intenciones: Optional[FrozenSet[str]] = None,
+                                  estado: Optional[EstadoHakari] = None) -> str:
         """Genera respuesta cuando no hay conexión a Gemini"""
-        respuesta_rapida = hakari.obtener_respuesta_rapida(mensaje, usuario_data)
+        respuesta_rapida = hakari.obtener_respuesta_rapida(mensaje, usuario_data, intenciones, estado)
         if respuesta_rapida:
             return respuesta_rapida
             
         # Respuesta basada en análisis simple del mensaje
-        mensaje_lower = mensaje.lower()
-        
         if len(mensaje) < 3:
-            return "¿Eso es todo?"
+            intencion = 'fallback_corto'
         elif len(mensaje) > 50:
-            return "Eso es mucho para procesar... ¿puedes resumir?"
+            intencion = 'fallback_largo'
         elif '?' in mensaje:
-            return "No estoy segura de saber la respuesta..."
+            intencion = 'fallback_pregunta'
         else:
-            return random.choice(self.respuestas_fallback)
+            intencion = 'fallback'
+        return hakari.responder(intencion, usuario_data, estado=estado) or "..."
 
-chat_engine = ChatEngine()
+chat_engine = ChatEngine(_crear_generador(GENERADOR))
 
 # Sistema de logros
 class SistemaLogros:
-    def __init__(self):
+    """Logros con un bitmap en memoria por usuario.
+
+    Cada logro tiene un bit; el bitmap de un usuario se carga de la BD la
+    primera vez que se necesita y se guarda en un LRU acotado, así los
+    logros ya desbloqueados se descartan sin consultar la tabla.
+    """
+
+    def __init__(self, max_usuarios: int = LOGROS_CACHE_MAX):
         self.logros = {
             'primer_conversacion': {'nombre': '🌟 Primer Contacto', 'descripcion': 'Primera conversación con Hakari'},
             '10_interacciones': {'nombre': '🎯 Conversador', 'descripcion': '10 interacciones completadas'},
@@ -294,52 +2879,85 @@ class SistemaLogros:
             'descubrir_anime': {'nombre': '📺 Anime Fan', 'descripcion': 'Hablaste sobre anime'},
             'cumpleanos': {'nombre': '🎂 Feliz Cumpleaños', 'descripcion': 'Estuviste en su cumpleaños'}
         }
+        self.bits = {logro_id: 1 << i for i, logro_id in enumerate(self.logros)}
+        self.max_usuarios = max_usuarios
+        self._cache = OrderedDict()  # email -> bitmap de logros desbloqueados
+    
+    def mascara(self, logro_ids) -> int:
+        mascara = 0
+        for logro_id in logro_ids:
+            mascara |= self.bits.get(logro_id, 0)
+        return mascara
+    
+    def mascara_cacheada(self, usuario_email: str) -> Optional[int]:
+        mascara = self._cache.get(usuario_email)
+        if mascara is not None:
+            self._cache.move_to_end(usuario_email)
+        return mascara
     
-    def verificar_logros(self, usuario_email: str, estadisticas: Dict, mensaje: str):
+    def cachear(self, usuario_email: str, logro_ids) -> int:
+        """Guarda en el LRU los logros leídos de la BD y devuelve el bitmap"""
+        mascara = self.mascara(logro_ids) | self._cache.get(usuario_email, 0)
+        self._cache[usuario_email] = mascara
+        self._cache.move_to_end(usuario_email)
+        while len(self._cache) > self.max_usuarios:
+            self._cache.popitem(last=False)
+        return mascara
+    
+    def marcar(self, usuario_email: str, logro_ids: List[str]):
+        """Marca logros recién desbloqueados (solo si el usuario está en caché)"""
+        if logro_ids and usuario_email in self._cache:
+            self._cache[usuario_email] |= self.mascara(logro_ids)
+    
+    def olvidar(self, usuario_email: str):
+        self._cache.pop(usuario_email, None)
+    
+    def limpiar(self):
+        self._cache.clear()
+    
+    def verificar_logros(self, estadisticas: Dict, mensaje: str, mascara: int, nuevas: int = 1) -> List[str]:
+        """Decide qué logros se desbloquean sin tocar la BD.
+
+        `mascara` es el bitmap de logros que el usuario ya tiene; la
+        inserción la hace registrar_logro dentro de la transacción del chat.
+        `nuevas` es cuántas interacciones sumaron estas estadísticas (más de
+        una cuando se procesa un lote de mensajes).
+        """
         logros_desbloqueados = []
-        cursor = hakari_db.conn.cursor()
+        interacciones = estadisticas.get('interacciones', 0)
         
         # Verificar logro de primera conversación
-        if estadisticas.get('interacciones', 0) == 1:
-            if self.registrar_logro(usuario_email, 'primer_conversacion'):
-                logros_desbloqueados.append('primer_conversacion')
+        if interacciones - nuevas < 1 <= interacciones:
+            logros_desbloqueados.append('primer_conversacion')
         
         # Verificar 10 interacciones
-        if estadisticas.get('interacciones', 0) >= 10:
-            if self.registrar_logro(usuario_email, '10_interacciones'):
-                logros_desbloqueados.append('10_interacciones')
+        if interacciones >= 10:
+            logros_desbloqueados.append('10_interacciones')
         
         # Verificar confianza
         if estadisticas.get('confianza', 0) >= 50:
-            if self.registrar_logro(usuario_email, 'confianza_50'):
-                logros_desbloqueados.append('confianza_50')
+            logros_desbloqueados.append('confianza_50')
         
         # Verificar anime
         if 'anime' in mensaje.lower():
-            if self.registrar_logro(usuario_email, 'descubrir_anime'):
-                logros_desbloqueados.append('descubrir_anime')
+            logros_desbloqueados.append('descubrir_anime')
         
         # Verificar cumpleaños
         if hakari.es_su_cumpleanos():
-            if self.registrar_logro(usuario_email, 'cumpleanos'):
-                logros_desbloqueados.append('cumpleanos')
+            logros_desbloqueados.append('cumpleanos')
         
-        return logros_desbloqueados
+        return [logro_id for logro_id in logros_desbloqueados if not mascara & self.bits[logro_id]]
     
-    def registrar_logro(self, usuario_email: str, logro_id: str) -> bool:
+    def registrar_logro(self, cursor: sqlite3.Cursor, usuario_email: str, logro_id: str) -> bool:
+        """Inserta el logro si no existe; el commit lo hace el hilo escritor"""
         try:
-            cursor = hakari_db.conn.cursor()
-            cursor.execute(
-                'SELECT id FROM logros WHERE usuario_email = ? AND logro_id = ?',
-                (usuario_email, logro_id)
-            )
-            if not cursor.fetchone():
-                logro_data = self.logros[logro_id]
-                cursor.execute('''
-                    INSERT INTO logros (usuario_email, logro_id, nombre, descripcion)
-                    VALUES (?, ?, ?, ?)
-                ''', (usuario_email, logro_id, logro_data['nombre'], logro_data['descripcion']))
-                hakari_db.conn.commit()
+            logro_data = self.logros[logro_id]
+            cursor.execute('''
+                INSERT OR IGNORE INTO logros (usuario_email, logro_id, nombre, descripcion)
+                VALUES (?, ?, ?, ?)
+            ''', (usuario_email, logro_id, logro_data['nombre'], logro_data['descripcion']))
+            if cursor.rowcount > 0:
+                resumenes_actividad.registrar_desbloqueo(cursor, logro_id)
                 return True
             return False
         except Exception as e:
@@ -348,30 +2966,391 @@ class SistemaLogros:
 
 sistema_logros = SistemaLogros()
 
+# Operaciones de base de datos usadas por los endpoints.
+# Reciben un cursor: las de lectura corren en el pool de lectores y las de
+# escritura en el hilo escritor (que hace el commit).
+def _leer_usuario_login(cursor: sqlite3.Cursor, email: str):
+    cursor.execute(
+        'SELECT nombre, confianza, interacciones FROM usuarios WHERE email = ?',
+        (email,)
+    )
+    return cursor.fetchone()
+
+def _leer_estadisticas(cursor: sqlite3.Cursor, email: str):
+    cursor.execute('''
+        SELECT confianza, interacciones, energia, relacion 
+        FROM usuarios WHERE email = ?
+    ''', (email,))
+    return cursor.fetchone()
+
+def _leer_contexto_chat(cursor: sqlite3.Cursor, email: str):
+    """Estadísticas más logros del usuario (cuando su bitmap no está en caché)"""
+    result = _leer_estadisticas(cursor, email)
+    cursor.execute('SELECT logro_id FROM logros WHERE usuario_email = ?', (email,))
+    return result, [row[0] for row in cursor.fetchall()]
+
+def _leer_estado(cursor: sqlite3.Cursor, email: str):
+    result = _leer_estadisticas(cursor, email)
+    cursor.execute('''
+        SELECT nombre FROM logros 
+        WHERE usuario_email = ? 
+        ORDER BY fecha_desbloqueo DESC 
+        LIMIT 5
+    ''', (email,))
+    logros = [row[0] for row in cursor.fetchall()]
+    return result, logros
+
+def _leer_historial(cursor: sqlite3.Cursor, email: str, limite: int,
+                    before_id: Optional[int] = None, after_id: Optional[int] = None):
+    """Página de conversaciones en orden cronológico (paginación por id).
+
+    Sin after_id devuelve las `limite` más recientes anteriores a before_id;
+    con after_id, las `limite` siguientes a after_id. Si hay archivo
+    mensual, la página sigue en él cuando la tabla principal no alcanza.
+    """
+    if archivo_conversaciones.activo:
+        return archivo_conversaciones.leer_historial(cursor, email, limite, before_id, after_id)
+    return _consultar_historial(cursor, email, limite, before_id, after_id)
+
+def _consultar_historial(cursor, email: str, limite: int,
+                         before_id: Optional[int] = None, after_id: Optional[int] = None):
+    """Consulta una tabla `conversaciones` (la principal o la de un archivo).
+
+    Recorre el índice (usuario_email, id) sin ordenar.
+    """
+    condiciones = ['usuario_email = ?']
+    params = [email]
+    if before_id is not None:
+        condiciones.append('id < ?')
+        params.append(before_id)
+    if after_id is not None:
+        condiciones.append('id > ?')
+        params.append(after_id)
+    orden = 'ASC' if after_id is not None else 'DESC'
+    params.append(limite)
+    
+    cursor.execute(f'''
+        SELECT id, mensaje_usuario, mensaje_hakari, fecha 
+        FROM conversaciones 
+        WHERE {' AND '.join(condiciones)} 
+        ORDER BY id {orden} 
+        LIMIT ?
+    ''', params)
+    filas = cursor.fetchall()
+    return filas if orden == 'ASC' else filas[::-1]
+
+def _leer_turnos_recientes(cursor: sqlite3.Cursor, email: str, limite: int) -> List[tuple]:
+    cursor.execute('''
+        SELECT id, mensaje_usuario, mensaje_hakari, fecha, estado_emocional
+        FROM conversaciones
+        WHERE usuario_email = ?
+        ORDER BY id DESC
+        LIMIT ?
+    ''', (email, limite))
+    return cursor.fetchall()[::-1]
+
+# Memoria de conversaciones
+class Turno(NamedTuple):
+    # Mismo orden que las filas de _consultar_historial, más el estado
+    id: int
+    mensaje_usuario: str
+    mensaje_hakari: str
+    fecha: str
+    estado_emocional: str
+
+class MemoriaUsuario:
+    __slots__ = ('turnos', 'bytes', 'completa')
+
+    def __init__(self, turnos: deque, completa: bool):
+        self.turnos = turnos
+        self.bytes = 0
+        self.completa = completa  # los turnos son toda la historia del usuario
+
+class MemoriaConversaciones:
+    """Últimos `por_usuario` turnos de cada usuario, en un deque acotado.
+
+    La memoria de un usuario se carga de `conversaciones` la primera vez que
+    se pide y después se mantiene con lo que escribe /chat (tras el commit),
+    así siempre son sus turnos más recientes sin huecos. Los usuarios están
+    en un LRU con un tope de memoria total estimada en `max_bytes`.
+
+    Con varios workers otro proceso puede agregar turnos sin que este se
+    entere, así que en modo compartido la memoria no se usa.
+    """
+
+    def __init__(self, db: HakariDatabase, por_usuario: int = MEMORIA_TURNOS, max_mb: float = MEMORIA_MB,
+                 activa: bool = not ESTADO_COMPARTIDO):
+        self.db = db
+        self.por_usuario = por_usuario
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.activa = activa and por_usuario > 0
+        self.bytes = 0
+        self.aciertos = 0
+        self.consultas = 0
+        self.desalojados = 0
+        self._usuarios = OrderedDict()  # email -> MemoriaUsuario
+
+    @staticmethod
+    def _tamano(turno: Turno) -> int:
+        return sys.getsizeof(turno) + sum(sys.getsizeof(campo) for campo in turno)
+
+    def _sumar(self, memoria: MemoriaUsuario, turno: Turno):
+        if len(memoria.turnos) == memoria.turnos.maxlen:
+            tamano = self._tamano(memoria.turnos[0])
+            memoria.bytes -= tamano
+            self.bytes -= tamano
+            memoria.completa = False
+        memoria.turnos.append(turno)
+        tamano = self._tamano(turno)
+        memoria.bytes += tamano
+        self.bytes += tamano
+
+    def _recortar(self):
+        while self.bytes > self.max_bytes and len(self._usuarios) > 1:
+            _, memoria = self._usuarios.popitem(last=False)
+            self.bytes -= memoria.bytes
+            self.desalojados += 1
+
+    async def obtener(self, email: str, cargar: bool = True) -> Optional[MemoriaUsuario]:
+        """La memoria del usuario, cargándola si hace falta (None si no se puede usar)"""
+        if not self.activa:
+            return None
+        memoria = self._usuarios.get(email)
+        if memoria is not None:
+            self._usuarios.move_to_end(email)
+            return memoria
+        if not cargar:
+            return None
+        
+        # Si se confirma un chat mientras se lee, lo leído puede no incluirlo
+        version = versiones_usuario.version(email)
+        filas = await self.db.leer(_leer_turnos_recientes, email, self.por_usuario)
+        self.consultas += 1
+        if versiones_usuario.version(email) != version or email in self._usuarios:
+            return self._usuarios.get(email)
+        
+        # Lo archivado no está en `conversaciones`: con archivo no se sabe si es todo
+        memoria = MemoriaUsuario(deque(maxlen=self.por_usuario),
+                                 len(filas) < self.por_usuario and not archivo_conversaciones.activo)
+        for fila in filas:
+            self._sumar(memoria, Turno(*fila))
+        self._usuarios[email] = memoria
+        self._recortar()
+        return memoria
+
+    def agregar(self, email: str, ids: List[int], turnos: List[tuple], fecha: str):
+        """Suma turnos ya confirmados; si el usuario no está cargado no hace nada"""
+        memoria = self._usuarios.get(email)
+        if memoria is None:
+            return
+        for id_turno, (mensaje, respuesta, estado) in zip(ids, turnos):
+            turno = Turno(id_turno, mensaje, respuesta, fecha, estado)
+            if memoria.turnos and id_turno <= memoria.turnos[-1].id:
+                # Ya estaba (se cargó después del commit) o llegó fuera de orden
+                if any(t.id == id_turno for t in memoria.turnos):
+                    continue
+                ordenados = sorted([*memoria.turnos, turno])
+                memoria.turnos.clear()
+                self.bytes -= memoria.bytes
+                memoria.bytes = 0
+                for t in ordenados:
+                    self._sumar(memoria, t)
+                continue
+            self._sumar(memoria, turno)
+        self._recortar()
+
+    def recientes(self, email: str, cantidad: int) -> List[Turno]:
+        """Últimos turnos que ya están en memoria, sin consultar la BD"""
+        memoria = self._usuarios.get(email)
+        if memoria is None or cantidad <= 0:
+            return []
+        turnos = memoria.turnos
+        return [turnos[i] for i in range(max(0, len(turnos) - cantidad), len(turnos))]
+
+    def historial(self, memoria: MemoriaUsuario, limite: int, before_id: Optional[int] = None,
+                  after_id: Optional[int] = None) -> Optional[List[Turno]]:
+        """La misma página que _leer_historial, o None si la memoria no alcanza"""
+        turnos = memoria.turnos
+        if after_id is not None:
+            # Todo lo posterior a after_id está en memoria si el más viejo no es posterior
+            if not memoria.completa and (not turnos or turnos[0].id > after_id):
+                return None
+            pagina = [t for t in turnos if t.id > after_id and (before_id is None or t.id < before_id)]
+            self.aciertos += 1
+            return pagina[:limite]
+        
+        candidatos = [t for t in turnos if before_id is None or t.id < before_id]
+        if len(candidatos) < limite and not memoria.completa:
+            return None
+        self.aciertos += 1
+        return candidatos[-limite:]
+
+    def limpiar(self):
+        self._usuarios.clear()
+        self.bytes = 0
+
+    def estadisticas(self) -> Dict:
+        return {
+            'activa': self.activa,
+            'usuarios': len(self._usuarios),
+            'turnos': sum(len(memoria.turnos) for memoria in self._usuarios.values()),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'aciertos': self.aciertos,
+            'consultas': self.consultas,
+            'desalojados': self.desalojados
+        }
+
+memoria_conversaciones = MemoriaConversaciones(hakari_db)
+
+def _consulta_fts(texto: str) -> Optional[str]:
+    """Convierte lo que escribe el usuario en una consulta FTS5 segura.
+
+    Cada palabra va entre comillas (sin operadores ni sintaxis que pueda
+    fallar) y todas deben aparecer; la última también como prefijo.
+    """
+    palabras = re.findall(r'\w+', texto)
+    if not palabras:
+        return None
+    terminos = [f'"{palabra}"' for palabra in palabras]
+    terminos[-1] += '*'
+    return ' '.join(terminos)
+
+_MARCA_INICIO, _MARCA_FIN = '\x02', '\x03'
+
+def _resaltar(fragmento: str) -> str:
+    # Se escapa el texto del usuario y recién después se ponen las marcas
+    return html.escape(fragmento).replace(_MARCA_INICIO, '<mark>').replace(_MARCA_FIN, '</mark>')
+
+def _buscar_conversaciones(cursor, email: str, consulta: str, limite: int, offset: int):
+    """Coincidencias del usuario ordenadas por relevancia (bm25).
+
+    El MATCH ya está acotado al token del usuario (ver
+    _migrar_busqueda); el filtro por email del JOIN queda como
+    resguardo. La columna `propietario` pesa 0 en bm25.
+    """
+    propietario = 'u' + email.encode('utf-8').hex().upper()
+    cursor.execute(f'''
+        SELECT c.id,
+               snippet(conversaciones_fts, 0, '{_MARCA_INICIO}', '{_MARCA_FIN}', '…', 16),
+               snippet(conversaciones_fts, 1, '{_MARCA_INICIO}', '{_MARCA_FIN}', '…', 16),
+               c.estado_emocional, c.fecha
+        FROM conversaciones_fts
+        JOIN conversaciones c ON c.id = conversaciones_fts.rowid
+        WHERE conversaciones_fts MATCH ? AND c.usuario_email = ?
+        ORDER BY bm25(conversaciones_fts, 1.0, 1.0, 0.0)
+        LIMIT ? OFFSET ?
+    ''', (f'propietario : "{propietario}" AND {{mensaje_usuario mensaje_hakari}} : ({consulta})',
+          email, limite, offset))
+    return cursor.fetchall()
+
+def _leer_resumenes(cursor, desde: str) -> Dict:
+    """Solo lee las tablas de resumen: O(días), no O(mensajes)"""
+    cursor.execute('''
+        SELECT dia, mensajes, usuarios_activos, registros
+        FROM resumen_diario WHERE dia >= ? ORDER BY dia
+    ''', (desde,))
+    dias = {fila[0]: {"dia": fila[0], "mensajes": fila[1], "usuarios_activos": fila[2],
+                      "registros": fila[3], "estados": {}} for fila in cursor.fetchall()}
+    
+    cursor.execute('SELECT dia, estado, mensajes FROM resumen_estados WHERE dia >= ?', (desde,))
+    for dia, estado, mensajes in cursor.fetchall():
+        if dia in dias:
+            dias[dia]["estados"][estado] = mensajes
+    
+    cursor.execute('SELECT COALESCE(SUM(registros), 0) FROM resumen_diario')
+    usuarios_totales = cursor.fetchone()[0]
+    cursor.execute('SELECT logro_id, desbloqueos FROM resumen_logros')
+    logros = cursor.fetchall()
+    return {"dias": list(dias.values()), "usuarios_totales": usuarios_totales, "logros": logros}
+
+def _guardar_registro(cursor: sqlite3.Cursor, email: str, nombre: str):
+    cursor.execute('SELECT 1 FROM usuarios WHERE email = ?', (email,))
+    if cursor.fetchone() is None:
+        resumenes_actividad.registrar_usuario(cursor)
+    
+    cursor.execute('''
+        INSERT OR REPLACE INTO usuarios 
+        (email, nombre, ultima_visita) 
+        VALUES (?, ?, datetime('now'))
+    ''', (email, nombre))
+    
+    # Registrar logro de primera conversación
+    sistema_logros.registrar_logro(cursor, email, 'primer_conversacion')
+
+def _guardar_chat_lote(cursor: sqlite3.Cursor, email: str, turnos: List[tuple], fecha: str,
+                       logros_nuevos: List[str]) -> tuple:
+    """Guarda uno o varios turnos (mensaje, respuesta, estado) de un usuario.
+
+    Devuelve los ids de las conversaciones (para la memoria de
+    conversaciones) y los logros que de verdad se insertaron.
+    """
+    # Guardar conversaciones
+    ids = []
+    for mensaje, respuesta, estado in turnos:
+        cursor.execute('''
+            INSERT INTO conversaciones (usuario_email, mensaje_usuario, mensaje_hakari, estado_emocional, fecha)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (email, mensaje, respuesta, estado, fecha))
+        ids.append(cursor.lastrowid)
+    resumenes_actividad.registrar_mensajes(cursor, email, [estado for _, _, estado in turnos])
+    
+    # Actualizar estadísticas del usuario una sola vez (relativo, así dos
+    # mensajes simultáneos del mismo usuario no se pisan)
+    n = len(turnos)
+    cursor.execute('''
+        UPDATE usuarios 
+        SET confianza = MIN(100, confianza + ?),
+            interacciones = interacciones + ?,
+            energia = MAX(0, energia - ?),
+            relacion = MIN(100, relacion + ?),
+            ultima_visita = datetime('now')
+        WHERE email = ?
+    ''', (n, n, n, n, email))
+    
+    # Logros en la misma transacción; el bitmap pudo estar viejo (otro chat
+    # simultáneo u otro worker), así que cuenta solo lo que se insertó
+    desbloqueados = [logro_id for logro_id in logros_nuevos
+                     if sistema_logros.registrar_logro(cursor, email, logro_id)]
+    return ids, desbloqueados
+
+async def _escribir_chat(email: str, turnos: List[tuple], logros_nuevos: List[str]) -> List[str]:
+    """Guarda los turnos y devuelve los logros realmente desbloqueados.
+
+    En modo 'lotes' se responde sin esperar el commit, salvo que haya logros
+    candidatos: esos (pocos) chats esperan para informar solo los que la BD
+    insertó. La versión del usuario y su memoria de conversaciones se
+    actualizan recién tras el commit, para que /estado no cachee datos
+    previos con la versión nueva y /historial no muestre algo que todavía
+    no está en la BD.
+    """
+    fecha = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')  # igual que CURRENT_TIMESTAMP
+    
+    def confirmar(resultado: tuple):
+        versiones_usuario.tocar(email)
+        memoria_conversaciones.agregar(email, resultado[0], turnos, fecha)
+    
+    args = (email, turnos, fecha, logros_nuevos)
+    if hakari_db.en_lotes and not logros_nuevos:
+        await hakari_db.encolar(_guardar_chat_lote, *args, al_confirmar=confirmar)
+        return []
+    resultado = await hakari_db.escribir(_guardar_chat_lote, *args)
+    confirmar(resultado)
+    return resultado[1]
+
 # Endpoints de la API
 @app.post("/registrar")
 async def registrar_usuario(user: UserRegister):
-    if user.email in [s['email'] for s in sesiones_activas.values()]:
+    if await estado_compartido.email_con_sesion(user.email):
         raise HTTPException(status_code=400, detail="❌ Usuario ya registrado")
+    control_admision.admitir()
     
     try:
-        cursor = hakari_db.conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO usuarios 
-            (email, nombre, ultima_visita) 
-            VALUES (?, ?, datetime('now'))
-        ''', (user.email, user.nombre))
-        hakari_db.conn.commit()
-        
-        session_id = secrets.token_urlsafe(16)
-        sesiones_activas[session_id] = {
-            'email': user.email,
-            'nombre': user.nombre,
-            'inicio_sesion': datetime.now().isoformat()
-        }
+        await hakari_db.escribir(_guardar_registro, user.email, user.nombre)
+        sistema_logros.olvidar(user.email)
+        versiones_usuario.tocar(user.email)
         
-        # Registrar logro de primera conversación
-        sistema_logros.registrar_logro(user.email, 'primer_conversacion')
+        session_id = await estado_compartido.crear_sesion(user.email, user.nombre)
         
         logger.info(f"Usuario registrado: {user.email}")
         return {
@@ -388,22 +3367,12 @@ async def registrar_usuario(user: UserRegister):
 @app.post("/login")
 async def login_usuario(user: UserLogin):
     try:
-        cursor = hakari_db.conn.cursor()
-        cursor.execute(
-            'SELECT nombre, confianza, interacciones FROM usuarios WHERE email = ?',
-            (user.email,)
-        )
-        result = cursor.fetchone()
+        result = await hakari_db.leer(_leer_usuario_login, user.email)
         
         if not result:
             raise HTTPException(status_code=404, detail="❌ Usuario no encontrado")
         
-        session_id = secrets.token_urlsafe(16)
-        sesiones_activas[session_id] = {
-            'email': user.email,
-            'nombre': result[0],
-            'inicio_sesion': datetime.now().isoformat()
-        }
+        session_id = await estado_compartido.crear_sesion(user.email, result[0])
         
         logger.info(f"Usuario logueado: {user.email}")
         return {
@@ -419,107 +3388,335 @@ async def login_usuario(user: UserLogin):
         logger.error(f"Error en login: {e}")
         raise HTTPException(status_code=500, detail="Error interno del servidor")
 
+async def procesar_mensaje(usuario_data: Dict, mensaje: str) -> Dict:
+    """Procesa un mensaje del usuario: estado, respuesta, logros y guardado.
+
+    Lo comparten /chat y los canales de streaming (WebSocket y SSE).
+    """
+    # Obtener datos actuales del usuario (y sus logros si no están en caché)
+    mascara_logros = sistema_logros.mascara_cacheada(usuario_data['email'])
+    if mascara_logros is None:
+        result, logros_usuario = await hakari_db.leer(_leer_contexto_chat, usuario_data['email'])
+        mascara_logros = sistema_logros.cachear(usuario_data['email'], logros_usuario)
+    else:
+        result = await hakari_db.leer(_leer_estadisticas, usuario_data['email'])
+    
+    if not result:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado en BD")
+    
+    estadisticas = {
+        'confianza': result[0],
+        'interacciones': result[1],
+        'energia': result[2],
+        'relacion': result[3]
+    }
+    
+    mantenimiento_db.registrar_actividad()
+    
+    # Detectar intenciones una sola vez para estado y respuesta
+    intenciones = hakari.intenciones.detectar(mensaje)
+    
+    # Actualizar el estado de Hakari con este usuario
+    email = usuario_data['email']
+    estado, estado_hakari = await estados_hakari.actualizar(
+        email, lambda estado: hakari.actualizar_estado_dinamico(estado, mensaje, intenciones))
+    
+    # Generar respuesta
+    respuesta = await chat_engine.generar_respuesta(mensaje, {
+        **usuario_data,
+        **estadisticas
+    }, intenciones, estado)
+    
+    # Verificar logros con las estadísticas que quedan tras este mensaje
+    logros_nuevos = sistema_logros.verificar_logros(
+        {'interacciones': estadisticas['interacciones'] + 1,
+         'confianza': min(100, estadisticas['confianza'] + 1)},
+        mensaje,
+        mascara_logros
+    )
+    sistema_logros.marcar(usuario_data['email'], logros_nuevos)
+    
+    # Guardar conversación, estadísticas y logros en una sola transacción
+    logros_nuevos = await _escribir_chat(email, [(mensaje, respuesta, estado_hakari)], logros_nuevos)
+    
+    logger.info(f"Chat procesado para {usuario_data['email']}")
+    return {
+        "respuesta": respuesta,
+        "estado_emocional": estado_hakari,
+        "estado_info": hakari.estados[estado_hakari],
+        "logros_nuevos": logros_nuevos,
+        "capricho_actual": estado.capricho,
+        "edad_hakari": hakari.calcular_edad(),
+        "es_cumpleanos": hakari.es_su_cumpleanos()
+    }
+
 @app.post("/chat")
 async def enviar_mensaje(chat: ChatMessage):
-    if chat.session_id not in sesiones_activas:
+    usuario_data = await estado_compartido.obtener_sesion(chat.session_id)
+    if usuario_data is None:
         raise HTTPException(status_code=401, detail="❌ Sesión inválida")
-    
-    usuario_data = sesiones_activas[chat.session_id]
+    control_admision.admitir(chat.session_id)
     
     try:
-        # Obtener datos actuales del usuario
-        cursor = hakari_db.conn.cursor()
-        cursor.execute('''
-            SELECT confianza, interacciones, energia, relacion 
-            FROM usuarios WHERE email = ?
-        ''', (usuario_data['email'],))
-        result = cursor.fetchone()
-        
-        if not result:
-            raise HTTPException(status_code=404, detail="Usuario no encontrado en BD")
-        
-        estadisticas = {
-            'confianza': result[0],
-            'interacciones': result[1],
-            'energia': result[2],
-            'relacion': result[3]
-        }
-        
-        # Actualizar estado de Hakari
-        estado_hakari = hakari.actualizar_estado_dinamico(chat.message)
+        return await procesar_mensaje(usuario_data, chat.message)
         
-        # Generar respuesta
-        respuesta = chat_engine.generar_respuesta_oflline(chat.message, {
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error en chat: {e}")
+        raise HTTPException(status_code=500, detail="Error procesando mensaje")
+
+async def procesar_lote(usuario_data: Dict, mensajes: List[str]) -> Dict:
+    """Procesa en orden varios mensajes de un usuario (p. ej. escritos sin conexión).
+
+    Cada mensaje actualiza el estado de Hakari y recibe su respuesta con las
+    estadísticas que tendría en ese punto, pero a la BD va una sola
+    transacción: todas las conversaciones, un UPDATE con los deltas sumados
+    y los logros evaluados una vez sobre las estadísticas finales.
+    """
+    email = usuario_data['email']
+    mascara_logros = sistema_logros.mascara_cacheada(email)
+    if mascara_logros is None:
+        result, logros_usuario = await hakari_db.leer(_leer_contexto_chat, email)
+        mascara_logros = sistema_logros.cachear(email, logros_usuario)
+    else:
+        result = await hakari_db.leer(_leer_estadisticas, email)
+    
+    if not result:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado en BD")
+    
+    confianza, interacciones, energia, relacion = result[:4]
+    mantenimiento_db.registrar_actividad()
+    
+    # El estado y las estadísticas avanzan en orden; las respuestas se piden
+    # todas juntas (el semáforo de ChatEngine limita las llamadas al generador)
+    detectadas = [hakari.intenciones.detectar(mensaje) for mensaje in mensajes]
+    
+    def avanzar(estado: EstadoHakari) -> List[EstadoHakari]:
+        # Una foto del estado después de cada mensaje, para su respuesta
+        pasos = []
+        for mensaje, intenciones in zip(mensajes, detectadas):
+            hakari.actualizar_estado_dinamico(estado, mensaje, intenciones)
+            pasos.append(estado.copia())
+        return pasos
+    
+    _, pasos = await estados_hakari.actualizar(email, avanzar)
+    estados = [paso.estado for paso in pasos]
+    pendientes = []
+    for mensaje, intenciones, paso in zip(mensajes, detectadas, pasos):
+        pendientes.append(chat_engine.generar_respuesta(mensaje, {
             **usuario_data,
-            **estadisticas
-        })
-        
-        # Guardar conversación
-        cursor.execute('''
-            INSERT INTO conversaciones (usuario_email, mensaje_usuario, mensaje_hakari, estado_emocional)
-            VALUES (?, ?, ?, ?)
-        ''', (usuario_data['email'], chat.message, respuesta, estado_hakari))
-        
-        # Actualizar estadísticas del usuario
-        nueva_confianza = min(100, estadisticas['confianza'] + 1)
-        nuevas_interacciones = estadisticas['interacciones'] + 1
-        nueva_energia = max(0, estadisticas['energia'] - 1)
-        nueva_relacion = min(100, estadisticas['relacion'] + 1)
+            'confianza': confianza,
+            'interacciones': interacciones,
+            'energia': energia,
+            'relacion': relacion
+        }, intenciones, paso))
         
-        cursor.execute('''
-            UPDATE usuarios 
-            SET confianza = ?, interacciones = ?, energia = ?, relacion = ?, ultima_visita = datetime('now')
-            WHERE email = ?
-        ''', (nueva_confianza, nuevas_interacciones, nueva_energia, nueva_relacion, usuario_data['email']))
-        
-        hakari_db.conn.commit()
-        
-        # Verificar logros
-        logros_nuevos = sistema_logros.verificar_logros(
-            usuario_data['email'],
-            {'interacciones': nuevas_interacciones, 'confianza': nueva_confianza},
-            chat.message
-        )
+        # Lo mismo que hace el UPDATE, para el siguiente mensaje
+        confianza = min(100, confianza + 1)
+        interacciones += 1
+        energia = max(0, energia - 1)
+        relacion = min(100, relacion + 1)
+    
+    if chat_engine.generador is not None:
+        await memoria_conversaciones.obtener(email)  # una carga, no una por mensaje
+    generadas = await asyncio.gather(*pendientes)
+    turnos = list(zip(mensajes, generadas, estados))
+    respuestas = [{"respuesta": respuesta, "estado_emocional": estado_mensaje}
+                  for respuesta, estado_mensaje in zip(generadas, estados)]
+    estado_hakari = estados[-1]
+    
+    logros_nuevos = sistema_logros.verificar_logros(
+        {'interacciones': interacciones, 'confianza': confianza},
+        '\n'.join(mensajes),
+        mascara_logros,
+        nuevas=len(mensajes)
+    )
+    sistema_logros.marcar(email, logros_nuevos)
+    
+    logros_nuevos = await _escribir_chat(email, turnos, logros_nuevos)
+    
+    logger.info(f"Lote de {len(mensajes)} mensajes procesado para {email}")
+    return {
+        "respuestas": respuestas,
+        "estado_emocional": estado_hakari,
+        "estado_info": hakari.estados[estado_hakari],
+        "logros_nuevos": logros_nuevos,
+        "capricho_actual": pasos[-1].capricho,
+        "edad_hakari": hakari.calcular_edad(),
+        "es_cumpleanos": hakari.es_su_cumpleanos()
+    }
+
+@app.post("/chat/batch")
+async def enviar_lote(lote: ChatLote):
+    """Sincroniza mensajes escritos sin conexión: una petición y un commit por dispositivo"""
+    usuario_data = await estado_compartido.obtener_sesion(lote.session_id)
+    if usuario_data is None:
+        raise HTTPException(status_code=401, detail="❌ Sesión inválida")
+    if not lote.messages:
+        raise HTTPException(status_code=400, detail="❌ El lote está vacío")
+    if len(lote.messages) > CHAT_LOTE_MAX:
+        raise HTTPException(status_code=413, detail=f"❌ Máximo {CHAT_LOTE_MAX} mensajes por lote")
+    control_admision.admitir(lote.session_id)
+    
+    try:
+        return await procesar_lote(usuario_data, lote.messages)
         
-        logger.info(f"Chat procesado para {usuario_data['email']}")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error en chat por lotes: {e}")
+        raise HTTPException(status_code=500, detail="Error procesando mensajes")
+
+# Chat por streaming: WebSocket y, como alternativa, Server-Sent Events
+class CanalChat:
+    """Conversación persistente ligada a una sesión ya validada.
+
+    La sesión se resuelve una sola vez al abrir la conexión. Por cada
+    mensaje se emiten eventos: fragmentos de la respuesta, el estado de
+    Hakari solo cuando `estado_emocional` o `capricho_actual` cambian
+    respecto a lo último enviado, los logros nuevos si hay y un `fin`.
+    """
+
+    def __init__(self, session_id: str, usuario_data: Dict):
+        self.session_id = session_id
+        self.usuario_data = usuario_data
+        self._estado_enviado = None
+        self._capricho_enviado = None
+
+    def evento_estado(self, estado: str, capricho: str, forzar: bool = False) -> Optional[Dict]:
+        if not forzar and (estado, capricho) == (self._estado_enviado, self._capricho_enviado):
+            return None
+        self._estado_enviado, self._capricho_enviado = estado, capricho
         return {
-            "respuesta": respuesta,
-            "estado_emocional": estado_hakari,
-            "estado_info": hakari.estados[estado_hakari],
-            "logros_nuevos": logros_nuevos,
-            "capricho_actual": hakari.capricho_actual,
+            "tipo": "estado",
+            "estado_emocional": estado,
+            "estado_info": hakari.estados[estado],
+            "capricho_actual": capricho,
             "edad_hakari": hakari.calcular_edad(),
             "es_cumpleanos": hakari.es_su_cumpleanos()
         }
+
+    async def procesar(self, mensaje: str) -> List[Dict]:
+        try:
+            control_admision.admitir(self.session_id)
+            resultado = await procesar_mensaje(self.usuario_data, mensaje)
+        except HTTPException as e:
+            evento = {"tipo": "error", "detail": e.detail}
+            if e.headers and 'Retry-After' in e.headers:
+                evento["retry_after"] = int(e.headers['Retry-After'])
+            return [evento]
+        except Exception as e:
+            logger.error(f"Error en chat por streaming: {e}")
+            return [{"tipo": "error", "detail": "Error procesando mensaje"}]
         
-    except Exception as e:
-        logger.error(f"Error en chat: {e}")
-        raise HTTPException(status_code=500, detail="Error procesando mensaje")
+        eventos = [{"tipo": "fragmento", "texto": fragmento}
+                   for fragmento in re.findall(r'\S+\s*', resultado["respuesta"])]
+        estado = self.evento_estado(resultado["estado_emocional"], resultado["capricho_actual"])
+        if estado:
+            eventos.append(estado)
+        if resultado["logros_nuevos"]:
+            eventos.append({"tipo": "logros", "logros_nuevos": resultado["logros_nuevos"]})
+        eventos.append({"tipo": "fin", "respuesta": resultado["respuesta"]})
+        return eventos
 
-@app.get("/estado/{session_id}")
-async def obtener_estado(session_id: str):
-    if session_id not in sesiones_activas:
+@app.websocket("/ws/{session_id}")
+async def chat_websocket(websocket: WebSocket, session_id: str):
+    """Cada texto recibido es un mensaje; cada evento se envía como JSON"""
+    usuario_data = await estado_compartido.obtener_sesion(session_id)
+    if usuario_data is None:
+        await websocket.close(code=4401)
+        return
+    
+    canal = CanalChat(session_id, usuario_data)
+    estado = await estados_hakari.obtener(usuario_data['email'])
+    await websocket.accept()
+    await websocket.send_json(canal.evento_estado(estado.estado, estado.capricho, forzar=True))
+    try:
+        while True:
+            mensaje = await websocket.receive_text()
+            for evento in await canal.procesar(mensaje):
+                await websocket.send_json(evento)
+    except WebSocketDisconnect:
+        pass
+
+# Canales SSE abiertos: session_id -> (canal, cola de eventos)
+canales_sse = {}
+
+def _formato_sse(evento: Dict) -> str:
+    return f"event: {evento['tipo']}\ndata: {json.dumps(evento, ensure_ascii=False)}\n\n"
+
+@app.get("/sse/{session_id}")
+async def abrir_sse(session_id: str):
+    """Abre el stream de eventos; los mensajes se envían con POST /sse/{session_id}"""
+    usuario_data = await estado_compartido.obtener_sesion(session_id)
+    if usuario_data is None:
         raise HTTPException(status_code=401, detail="❌ Sesión inválida")
     
-    usuario_data = sesiones_activas[session_id]
+    canal = CanalChat(session_id, usuario_data)
+    cola = asyncio.Queue()
+    # Una conexión por sesión: la nueva reemplaza a la anterior
+    anterior = canales_sse.get(session_id)
+    if anterior:
+        anterior[1].put_nowait(None)
+    canales_sse[session_id] = (canal, cola)
+    estado = await estados_hakari.obtener(usuario_data['email'])
+    cola.put_nowait(canal.evento_estado(estado.estado, estado.capricho, forzar=True))
+    
+    async def generar():
+        try:
+            while True:
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"  # mantiene viva la conexión en proxies
+                    continue
+                if evento is None:
+                    break
+                yield _formato_sse(evento)
+        finally:
+            if canales_sse.get(session_id, (None,))[0] is canal:
+                del canales_sse[session_id]
+    
+    return StreamingResponse(generar(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/sse/{session_id}")
+async def enviar_sse(session_id: str, chat: MensajeStream):
+    """Procesa un mensaje y publica sus eventos en el stream abierto de la sesión"""
+    abierto = canales_sse.get(session_id)
+    if abierto is None:
+        raise HTTPException(status_code=409, detail="No hay un stream abierto para esta sesión")
+    
+    canal, cola = abierto
+    for evento in await canal.procesar(chat.message):
+        cola.put_nowait(evento)
+    return {"ok": True}
+
+@app.get("/estado/{session_id}")
+async def obtener_estado(session_id: str, if_none_match: Optional[str] = Header(None)):
+    usuario_data = await estado_compartido.obtener_sesion(session_id)
+    if usuario_data is None:
+        raise HTTPException(status_code=401, detail="❌ Sesión inválida")
     
     try:
-        cursor = hakari_db.conn.cursor()
-        cursor.execute('''
-            SELECT confianza, interacciones, energia, relacion 
-            FROM usuarios WHERE email = ?
-        ''', (usuario_data['email'],))
-        result = cursor.fetchone()
+        estado = await estados_hakari.obtener(usuario_data['email'])
         
-        cursor.execute('''
-            SELECT nombre FROM logros 
-            WHERE usuario_email = ? 
-            ORDER BY fecha_desbloqueo DESC 
-            LIMIT 5
-        ''', (usuario_data['email'],))
-        logros = [row[0] for row in cursor.fetchall()]
+        # La versión se toma antes de leer: si algo cambia durante la lectura,
+        # la entrada queda con la versión vieja y se descarta en la próxima.
+        # Con varios workers otro proceso puede cambiar al usuario sin que
+        # este se entere, así que ahí el ETag sale del hash del cuerpo.
+        version = None
+        if not estado_compartido.activo:
+            version = (estado.version, hakari.dia().fecha.toordinal(),
+                       versiones_usuario.version(usuario_data['email']))
+            cacheada = cache_respuestas.obtener(session_id, version)
+            if cacheada:
+                return _respuesta_con_etag(*cacheada, if_none_match)
         
-        return {
+        result, logros = await hakari_db.leer(_leer_estado, usuario_data['email'])
+        
+        contenido = {
             "usuario": usuario_data,
             "estadisticas": {
                 "confianza": result[0],
@@ -528,68 +3725,375 @@ async def obtener_estado(session_id: str):
                 "relacion": result[3]
             },
             "hakari": {
-                "estado_actual": hakari.estado_actual,
-                "estado_info": hakari.estados[hakari.estado_actual],
+                "estado_actual": estado.estado,
+                "estado_info": hakari.estados[estado.estado],
                 "edad": hakari.calcular_edad(),
                 "es_cumpleanos": hakari.es_su_cumpleanos(),
-                "capricho_actual": hakari.capricho_actual,
-                "ciclo_menstrual": hakari.ciclo_menstrual
+                "capricho_actual": estado.capricho,
+                "ciclo_menstrual": estado.ciclo_menstrual
             },
             "logros": logros
         }
+        if version is not None:
+            return _respuesta_con_etag(*cache_respuestas.guardar(session_id, version, contenido), if_none_match)
+        
+        cuerpo = _serializar(contenido)
+        etag = f'W/"{hashlib.sha1(cuerpo).hexdigest()[:16]}"'
+        return _respuesta_con_etag(etag, cuerpo, if_none_match)
         
     except Exception as e:
         logger.error(f"Error obteniendo estado: {e}")
         raise HTTPException(status_code=500, detail="Error obteniendo estado")
 
+def _fila_historial(row) -> Dict:
+    return {
+        "id": row[0],
+        "usuario": row[1],
+        "hakari": row[2],
+        "fecha": row[3]
+    }
+
 @app.get("/historial/{session_id}")
-async def obtener_historial(session_id: str, limite: int = 20):
-    if session_id not in sesiones_activas:
+async def obtener_historial(session_id: str, limite: int = Query(20, ge=1),
+                            before_id: Optional[int] = None, after_id: Optional[int] = None):
+    usuario_data = await estado_compartido.obtener_sesion(session_id)
+    if usuario_data is None:
         raise HTTPException(status_code=401, detail="❌ Sesión inválida")
     
-    usuario_data = sesiones_activas[session_id]
-    
+    limite = min(limite, HISTORIAL_MAX_PAGINA)
     try:
-        cursor = hakari_db.conn.cursor()
-        cursor.execute('''
-            SELECT mensaje_usuario, mensaje_hakari, fecha 
-            FROM conversaciones 
-            WHERE usuario_email = ? 
-            ORDER BY fecha DESC 
-            LIMIT ?
-        ''', (usuario_data['email'], limite))
-        
-        conversaciones = []
-        for row in cursor.fetchall():
-            conversaciones.append({
-                "usuario": row[0],
-                "hakari": row[1],
-                "fecha": row[2]
-            })
-        
-        return {"historial": conversaciones[::-1]}  # Orden cronológico
+        filas = None
+        # Una página vieja de un usuario sin cargar no justifica cargarlo
+        memoria = await memoria_conversaciones.obtener(usuario_data['email'], cargar=before_id is None)
+        if memoria is not None:
+            filas = memoria_conversaciones.historial(memoria, limite, before_id, after_id)
+        if filas is None:
+            filas = await hakari_db.leer(_leer_historial, usuario_data['email'], limite, before_id, after_id)
+        
+        conversaciones = [_fila_historial(row) for row in filas]  # Orden cronológico
+        
+        # Cursores para pedir la página anterior/siguiente
+        return {
+            "historial": conversaciones,
+            "before_id": conversaciones[0]["id"] if conversaciones else before_id,
+            "after_id": conversaciones[-1]["id"] if conversaciones else after_id
+        }
         
     except Exception as e:
         logger.error(f"Error obteniendo historial: {e}")
         raise HTTPException(status_code=500, detail="Error obteniendo historial")
 
-@app.get("/")
-async def root():
+@app.get("/buscar/{session_id}")
+async def buscar_conversaciones(session_id: str, q: str = Query(..., min_length=1, max_length=200),
+                                limite: int = Query(20, ge=1), offset: int = Query(0, ge=0, le=1000)):
+    """Busca en las conversaciones del usuario (no incluye las archivadas)"""
+    usuario_data = await estado_compartido.obtener_sesion(session_id)
+    if usuario_data is None:
+        raise HTTPException(status_code=401, detail="❌ Sesión inválida")
+    if not hakari_db.busqueda_activa:
+        raise HTTPException(status_code=503, detail="Búsqueda no disponible")
+    
+    consulta = _consulta_fts(q)
+    if consulta is None:
+        return {"resultados": [], "siguiente_offset": None}
+    
+    limite = min(limite, BUSQUEDA_MAX_PAGINA)
+    try:
+        # Se pide una fila de más para saber si hay otra página
+        filas = await hakari_db.leer(_buscar_conversaciones, usuario_data['email'], consulta, limite + 1, offset)
+    except Exception as e:
+        logger.error(f"Error buscando conversaciones: {e}")
+        raise HTTPException(status_code=500, detail="Error buscando conversaciones")
+    
+    return {
+        "resultados": [{
+            "id": fila[0],
+            "usuario": _resaltar(fila[1]),
+            "hakari": _resaltar(fila[2]),
+            "estado": fila[3],
+            "fecha": fila[4]
+        } for fila in filas[:limite]],
+        "siguiente_offset": offset + limite if len(filas) > limite else None
+    }
+
+@app.get("/estadisticas")
+async def obtener_estadisticas(dias: int = Query(30, ge=1, le=3660)):
+    """Mensajes, usuarios activos y registros por día, estados emocionales y logros"""
+    desde = (datetime.utcnow() - timedelta(days=dias - 1)).strftime('%Y-%m-%d')
+    try:
+        resumen = await hakari_db.leer(_leer_resumenes, desde)
+    except Exception as e:
+        logger.error(f"Error obteniendo estadísticas: {e}")
+        raise HTTPException(status_code=500, detail="Error obteniendo estadísticas")
+    
+    estados = {}
+    for dia in resumen["dias"]:
+        for estado, mensajes in dia["estados"].items():
+            estados[estado] = estados.get(estado, 0) + mensajes
+    usuarios = resumen["usuarios_totales"]
+    
     return {
-        "mensaje": "Hakari API - Backend funcionando",
-        "version": "2.0.0",
-        "hakari": {
-            "nombre": hakari.historia['nombre'],
-            "edad": hakari.calcular_edad(),
-            "es_cumpleanos": hakari.es_su_cumpleanos(),
-            "estado": hakari.estado_actual
+        "desde": desde,
+        "dias": resumen["dias"],
+        "mensajes": sum(dia["mensajes"] for dia in resumen["dias"]),
+        "estados": estados,
+        "usuarios_totales": usuarios,
+        "logros": {
+            logro_id: {
+                "nombre": sistema_logros.logros.get(logro_id, {}).get('nombre', logro_id),
+                "desbloqueos": desbloqueos,
+                "tasa": round(desbloqueos / usuarios, 4) if usuarios else 0.0
+            }
+            for logro_id, desbloqueos in resumen["logros"]
         }
     }
 
+@app.get("/historial/{session_id}/stream")
+async def stream_historial(session_id: str, after_id: int = 0):
+    """Historial completo en NDJSON (una conversación por línea), de a bloques"""
+    usuario_data = await estado_compartido.obtener_sesion(session_id)
+    if usuario_data is None:
+        raise HTTPException(status_code=401, detail="❌ Sesión inválida")
+    
+    email = usuario_data['email']
+    
+    async def generar():
+        ultimo_id = after_id
+        while True:
+            filas = await hakari_db.leer(_leer_historial, email, HISTORIAL_BLOQUE_STREAM, None, ultimo_id)
+            if not filas:
+                break
+            yield ''.join(json.dumps(_fila_historial(row), ensure_ascii=False) + '\n' for row in filas)
+            if len(filas) < HISTORIAL_BLOQUE_STREAM:
+                break
+            ultimo_id = filas[-1][0]
+    
+    return StreamingResponse(generar(), media_type="application/x-ndjson")
+
+# Shell de la PWA
+def _ruta_estatica(nombre: str):
+    async def servir(v: Optional[str] = None, accept_encoding: Optional[str] = Header(None),
+                     if_none_match: Optional[str] = Header(None)):
+        return recursos_estaticos.respuesta(nombre, v, accept_encoding, if_none_match)
+    return servir
+
+for _nombre in ARCHIVOS_ESTATICOS:
+    app.add_api_route('/' + _nombre, _ruta_estatica(_nombre), methods=['GET'], include_in_schema=False)
+
+@app.get("/")
+async def root(if_none_match: Optional[str] = Header(None), accept: Optional[str] = Header(None),
+               accept_encoding: Optional[str] = Header(None)):
+    # Un navegador que navega a / recibe la PWA; los clientes de la API, el JSON
+    if 'index.html' in recursos_estaticos.recursos:
+        if accept and 'text/html' in accept:
+            respuesta = recursos_estaticos.respuesta('index.html', None, accept_encoding, if_none_match)
+            respuesta.headers['Vary'] = 'Accept, Accept-Encoding'
+            return respuesta
+    dia = hakari.dia()
+    version = (hakari.base.version, dia.fecha.toordinal())
+    cacheada = cache_respuestas.obtener('/', version)
+    if cacheada is None:
+        cacheada = cache_respuestas.guardar('/', version, {
+            "mensaje": "Hakari API - Backend funcionando",
+            "version": "2.0.0",
+            "hakari": {
+                "nombre": hakari.historia['nombre'],
+                "edad": dia.edad,
+                "es_cumpleanos": dia.es_cumpleanos,
+                "estado": hakari.base.estado
+            }
+        })
+    respuesta = _respuesta_con_etag(*cacheada, if_none_match)
+    if 'index.html' in recursos_estaticos.recursos:
+        respuesta.headers['Vary'] = 'Accept'
+    return respuesta
+
+# Administración
+def _verificar_admin(token: Optional[str]):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="❌ Token de administración inválido")
+
+@app.get("/admin/exportar")
+async def admin_exportar(tablas: str = 'usuarios,conversaciones,logros', comprimir: bool = True,
+                         incluir_archivo: bool = True, x_admin_token: Optional[str] = Header(None)):
+    """Descarga un export NDJSON (gzip por defecto) generado de a bloques"""
+    _verificar_admin(x_admin_token)
+    lista = [t.strip() for t in tablas.split(',') if t.strip()]
+    if set(lista) - set(TransferenciaDatos.COLUMNAS):
+        raise HTTPException(status_code=400, detail="Tablas desconocidas")
+    
+    bloques = transferencia_datos.exportar(lista, incluir_archivo)
+    loop = asyncio.get_running_loop()
+    
+    async def generar():
+        compresor = zlib.compressobj(wbits=31) if comprimir else None  # 31 = formato gzip
+        while True:
+            # La lectura de SQLite corre fuera del event loop
+            bloque = await loop.run_in_executor(None, next, bloques, None)
+            if bloque is None:
+                break
+            datos = bloque.encode('utf-8')
+            yield compresor.compress(datos) if compresor else datos
+        if compresor:
+            yield compresor.flush()
+    
+    nombre = f"hakari-{datetime.now():%Y%m%d-%H%M%S}.ndjson" + ('.gz' if comprimir else '')
+    return StreamingResponse(generar(), media_type='application/gzip' if comprimir else 'application/x-ndjson',
+                             headers={'Content-Disposition': f'attachment; filename="{nombre}"'})
+
+@app.post("/admin/importar")
+async def admin_importar(request: Request, reemplazar: bool = False,
+                         x_admin_token: Optional[str] = Header(None)):
+    """Importa un export NDJSON (gzip o no) recibido como cuerpo en streaming.
+
+    Los índices se mantienen: la API sigue atendiendo durante la importación.
+    """
+    _verificar_admin(x_admin_token)
+    # Se pasan trozos (listas de líneas) y nunca se bloquea el event loop:
+    # con la cola llena la espera ocurre en el executor
+    bloques = queue.Queue(maxsize=8)
+    terminado = threading.Event()
+    loop = asyncio.get_running_loop()
+    
+    def consumir():
+        try:
+            lineas = (linea for bloque in iter(bloques.get, None) for linea in bloque)
+            return transferencia_datos.importar(lineas, reemplazar=reemplazar)
+        finally:
+            terminado.set()
+    
+    def entregar(bloque) -> bool:
+        while not terminado.is_set():
+            try:
+                bloques.put(bloque, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    async def enviar(bloque) -> bool:
+        try:
+            bloques.put_nowait(bloque)
+            return True
+        except queue.Full:
+            return await loop.run_in_executor(None, entregar, bloque)
+    
+    tarea = loop.run_in_executor(None, consumir)
+    try:
+        descompresor = zlib.decompressobj(wbits=47)  # 47 = detecta gzip o zlib
+        resto = b''
+        primero = True
+        async for trozo in request.stream():
+            if primero and trozo:
+                primero = False
+                if trozo[:2] != b'\x1f\x8b':
+                    descompresor = None
+            datos = descompresor.decompress(trozo) if descompresor else trozo
+            *completas, resto = (resto + datos).split(b'\n')
+            if completas and not await enviar([linea.decode('utf-8') for linea in completas]):
+                break
+        if resto.strip():
+            await enviar([resto.decode('utf-8')])
+    finally:
+        await enviar(None)
+    
+    try:
+        return {"importadas": await tarea}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error importando: {e}")
+        raise HTTPException(status_code=500, detail="Error importando datos")
+    finally:
+        # También si falló a mitad: lo ya confirmado quedó en la BD
+        transferencia_datos.limpiar_caches()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def exportar_metricas():
+    """Métricas en formato de texto de Prometheus"""
+    tamanos = hakari_db.tamanos_archivos()
+    medidores = {
+        'hakari_sesiones_activas': ('Sesiones vivas en este worker', [('', len(sesiones_activas))]),
+        'hakari_db_bytes': ('Tamaño en disco de la base de datos',
+                            [(f'archivo="{archivo}"', tamano) for archivo, tamano in tamanos.items()]),
+        'hakari_cola_escritura': ('Escrituras pendientes en la cola del escritor',
+                                  [('', hakari_db.profundidad_cola())])
+    }
+    return PlainTextResponse(metricas.exportar(medidores), media_type='text/plain; version=0.0.4')
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "sesiones": sesiones_activas.estadisticas(),
+        "mantenimiento": mantenimiento_db.ultimo_reporte,
+        "admision": control_admision.estadisticas(),
+        "personalidades": estados_hakari.estadisticas(),
+        "generador": chat_engine.estadisticas(),
+        "memoria_conversaciones": memoria_conversaciones.estadisticas(),
+        "arranque": informe_arranque.resumen()
+    }
 
-if __name__ == "__main__":
+def _abrir_texto(ruta: str, modo: str):
+    """Abre un archivo de texto; '-' es stdin/stdout y .gz se (des)comprime"""
+    if ruta == '-':
+        return sys.stdout if 'w' in modo else sys.stdin
+    if ruta.endswith('.gz'):
+        return gzip.open(ruta, modo + 't', encoding='utf-8')
+    return open(ruta, modo, encoding='utf-8')
+
+def servir():
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if WORKERS > 1:
+        # Con varios workers uvicorn necesita importar la app por nombre
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
+
+informe_arranque.marcar('importar')
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Hakari API")
+    sub = parser.add_subparsers(dest='comando')
+    sub.add_parser('servir', help='Levanta la API (por defecto)')
+    
+    p_exportar = sub.add_parser('exportar', help='Exporta usuarios, conversaciones y logros a NDJSON')
+    p_exportar.add_argument('salida', help="Archivo de salida ('-' = stdout, .gz = comprimido)")
+    p_exportar.add_argument('--tablas', default='usuarios,conversaciones,logros')
+    p_exportar.add_argument('--sin-archivo', action='store_true', help='No incluir conversaciones archivadas')
+    
+    p_importar = sub.add_parser('importar', help='Importa un archivo generado por exportar')
+    p_importar.add_argument('entrada', help="Archivo de entrada ('-' = stdin, .gz = comprimido)")
+    p_importar.add_argument('--reemplazar', action='store_true', help='Pisar usuarios existentes')
+    p_importar.add_argument('--mantener-indices', action='store_true',
+                            help='No borrar/reconstruir índices (usar si la API está corriendo)')
+    
+    sub.add_parser('reconstruir-estadisticas', help='Recalcula las tablas de resumen desde los datos crudos')
+    
+    args = parser.parse_args()
+    if args.comando in ('exportar', 'importar', 'reconstruir-estadisticas'):
+        hakari_db.iniciar()  # migra el esquema si hace falta
+    
+    if args.comando == 'exportar':
+        with _abrir_texto(args.salida, 'w') as salida:
+            for bloque in transferencia_datos.exportar(args.tablas.split(','), not args.sin_archivo):
+                salida.write(bloque)
+        hakari_db.cerrar()
+    elif args.comando == 'importar':
+        with _abrir_texto(args.entrada, 'r') as entrada:
+            print(transferencia_datos.importar(entrada, args.reemplazar, not args.mantener_indices))
+        hakari_db.cerrar()
+    elif args.comando == 'reconstruir-estadisticas':
+        hakari_db.cerrar()  # el escritor no debe competir por el lock
+        conn = hakari_db._conectar()
+        conn.isolation_level = None
+        conn.execute('BEGIN IMMEDIATE')
+        print(resumenes_actividad.reconstruir(conn.cursor()))
+        conn.execute('COMMIT')
+        conn.close()
+    else:
+        servir()
@@ -1,6 +1,8 @@
 // Service Worker simple para PWA
+// La API reescribe CACHE_NAME y las URLs con ?v= según el hash de los
+// archivos: cada deploy que cambia algo instala un service worker nuevo.
 const CACHE_NAME = 'hakari-v1';
-const urlsToCache = ['/', '/index.html', '/style.css', '/app.js', '/manifest.json'];
+const urlsToCache = ['/index.html', '/style.css', '/app.js', '/manifest.json'];
 
 self.addEventListener('install', event => {
     event.waitUntil(
@@ -9,9 +11,21 @@ self.addEventListener('install', event => {
     );
 });
 
+// Borrar las cachés de versiones anteriores
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys().then(nombres => Promise.all(
+            nombres.filter(nombre => nombre !== CACHE_NAME).map(nombre => caches.delete(nombre))
+        ))
+    );
+});
+
 self.addEventListener('fetch', event => {
+    // En / la API responde JSON salvo a los navegadores: se usa el index.html cacheado
+    const url = new URL(event.request.url);
+    const peticion = event.request.mode === 'navigate' && url.pathname === '/' ? '/index.html' : event.request;
     event.respondWith(
-        caches.match(event.request)
+        caches.match(peticion)
             .then(response => response || fetch(event.request))
     );
-});
\ No newline at end of file
+});
@@ -0,0 +1,87 @@
+import main
+
+
+def _paginar(archivo, cursor, email, limite, ascendente):
+    ids = []
+    cursor_id = 0 if ascendente else None
+    while True:
+        if ascendente:
+            pagina = archivo.leer_historial(cursor, email, limite, None, cursor_id)
+        else:
+            pagina = archivo.leer_historial(cursor, email, limite, cursor_id, None)
+        if not pagina:
+            return ids
+        ids += [fila[0] for fila in pagina]
+        cursor_id = pagina[-1][0] if ascendente else pagina[0][0]
+
+
+def test_historial_con_rangos_de_archivo_solapados(tmp_path):
+    db = main.HakariDatabase(str(tmp_path / 'hakari.db'))
+    db.iniciar()
+    conn = db._conectar()
+    conn.isolation_level = None
+    lector = db._conectar(solo_lectura=True)
+    archivo = main.ArchivoConversaciones(directorio=str(tmp_path / 'archivo'), dias=30)
+    email = 'a@x.com'
+
+    def insertar(fechas):
+        conn.executemany('''
+            INSERT INTO conversaciones (usuario_email, mensaje_usuario, mensaje_hakari, estado_emocional, fecha)
+            VALUES (?, 'hola', 'mm', 'neutral', ?)
+        ''', [(email, fecha) for fecha in fechas])
+
+    try:
+        # Meses intercalados: los rangos de ids de enero y febrero se pisan
+        insertar([f'2025-0{1 + i % 2}-10 12:00:00' for i in range(30)])
+        assert archivo.archivar(conn) == 30
+        # Filas viejas que llegan tarde: el ON CONFLICT ensancha el rango de enero
+        insertar(['2025-01-20 12:00:00'] * 5)
+        assert archivo.archivar(conn) == 5
+        insertar(['2999-01-01 12:00:00'] * 5)
+
+        rangos = conn.execute('SELECT id_min, id_max FROM archivos_conversaciones ORDER BY mes').fetchall()
+        assert rangos == [(1, 35), (2, 30)]
+
+        cursor = lector.cursor()
+        esperados = list(range(1, 41))
+        assert sorted(_paginar(archivo, cursor, email, 4, ascendente=False)) == esperados
+        assert _paginar(archivo, cursor, email, 4, ascendente=True) == esperados
+        assert [fila[0] for fila in archivo.leer_historial(cursor, email, 7, 20, 9)] == list(range(10, 17))
+    finally:
+        lector.close()
+        conn.close()
+        db.cerrar()
+
+
+def test_otro_worker_ve_lo_archivado_y_hay_un_solo_turno(tmp_path):
+    db = main.HakariDatabase(str(tmp_path / 'hakari.db'))
+    db.iniciar()
+    conn = db._conectar()
+    conn.isolation_level = None
+    lector = db._conectar(solo_lectura=True)
+    directorio = str(tmp_path / 'archivo')
+    archivador = main.ArchivoConversaciones(directorio=directorio, dias=30)
+    otro = main.ArchivoConversaciones(directorio=directorio, dias=30)
+    email = 'a@x.com'
+
+    try:
+        conn.executemany('''
+            INSERT INTO conversaciones (usuario_email, mensaje_usuario, mensaje_hakari, estado_emocional, fecha)
+            VALUES (?, 'hola', 'mm', 'neutral', ?)
+        ''', [(email, '2025-03-01 12:00:00')] * 10)
+        cursor = lector.cursor()
+        assert len(otro.leer_historial(cursor, email, 20, None, None)) == 10  # deja la lista de meses en caché
+
+        assert archivador.tomar_turno(conn)
+        assert not otro.tomar_turno(conn)
+        assert archivador.archivar(conn) == 10
+        archivador.soltar_turno(conn)
+        assert otro.tomar_turno(conn)
+        otro.soltar_turno(conn)
+
+        assert [fila[0] for fila in otro.leer_historial(cursor, email, 20, None, None)] == list(range(1, 11))
+        assert conn.execute('SELECT filas FROM archivos_conversaciones').fetchone()[0] == 10
+    finally:
+        lector.close()
+        conn.close()
+        db.cerrar()